@@ -41,6 +41,8 @@ api.add_resource(restful_api.Intents, '/database/intents')
 api.add_resource(restful_api.UnlabeledExpressions, '/database/unlabeled_expressions')
 api.add_resource(restful_api.ArchivedExpressions, '/database/archived_expressions')
 api.add_resource(restful_api.Analyze, '/nlp/analyze')
+api.add_resource(restful_api.AnalyzeBatch, '/nlp/analyze/batch')
+api.add_resource(restful_api.AnalysisTimings, '/nlp/timings')
 api.add_resource(restful_api.Train, '/nlp/train')
 api.add_resource(restful_api.Health, '/aws-eb-health')
 
@@ -9,6 +9,10 @@ db: the NLP_Database() object used to make calls to the associated Bolt postgreS
 Classes:
     Analyze:
         post - Returns the intent classification of the query, and the entities and stopwords of the intent.
+    AnalyzeBatch:
+        post - Returns the analysis of each query in a list of queries, in order.
+    AnalysisTimings:
+        get - Returns the in process histograms of analysis phase and annotator timings and tokenization cache stats.
     Train:
         psot - Trains the existing classifier and gazetteer models.
     Expressions:
@@ -39,7 +43,10 @@ from app.validators import valid_application_type,\
                            validate_gazetteer_parameters
 from database.database import IntentsDatabaseEngine, ExpressionsDatabaseEngine
 from nlp import Analyzer, Updater
+from nlp.clf.classification import tokenization_cache
+from nlp.ner.gazetteer import gazetteer_cache, stem_cache
 from utils.exceptions import DatabaseError, DatabaseInputError, UpdaterError, AnalyzerError, GazetteerModelError
+from utils.timing import Timings, TIMING_HISTOGRAMS
 
 logger = logging.getLogger('BOLT.api')
 
@@ -69,7 +76,8 @@ class Analyze(Resource):
         'content_type': fields.Str(required=True, load_from='Content-Type', location='headers', validate=validate_application_json),
         'query': fields.Str(required=True, validate=validate.Length(min=1)),
         'key': fields.Str(required=False, validate=validate.Length(min=1)),
-        "save_expression": fields.Bool(required=False, default=False)
+        "save_expression": fields.Bool(required=False, default=False),
+        "timings": fields.Bool(required=False, missing=False)
     }
     
     @use_args(analyze_args)
@@ -77,18 +85,23 @@ class Analyze(Resource):
         """
         POST route that returns the analysis on a given query (classification results, entities etc,.)
         :param args: Incoming data from request containing the query and the access key.
-        :return: JSON response with the results of the Analyzer on the query
+        :return: JSON response with the results of the Analyzer on the query. Timings of each phase and annotator are
+                 returned in the Server-Timing header and, if requested, in the 'timings' field.
         """
         try:
             analyzer = Analyzer()
+            timings = Timings()
             key = args['key'] if 'key' in args.keys() else None
-            results = analyzer.run_analysis(args['query'], key)
+            results = analyzer.run_analysis(args['query'], key, timings)
             estimated_intent = results['classification'][0]['intent']
             estimated_confidence = results['classification'][0]['confidence']
             if(args['save_expression']):
                 db = get_db('expressions')
                 db.add_unlabeled_expression(args['query'], estimated_intent, estimated_confidence)
+            if args['timings']:
+                results['timings'] = timings.to_dict()
             resp = jsonify(results)
+            resp.headers['Server-Timing'] = timings.server_timing_header()
             return resp
         except DatabaseError as e:
             logger.exception(e.value)
@@ -102,6 +115,72 @@ class Analyze(Resource):
             return resp
 
 
+class AnalyzeBatch(Resource):
+
+    decorators = [tokenAuth.login_required]
+    validate_application_json = partial(valid_application_type, 'application/json')
+
+    analyze_batch_args = {
+        'content_type': fields.Str(required=True, load_from='Content-Type', location='headers', validate=validate_application_json),
+        'queries': fields.List(fields.Str(), required=True, validate=list_of_strings),
+        'key': fields.Str(required=False, validate=validate.Length(min=1)),
+        "save_expression": fields.Bool(required=False, default=False),
+        "timings": fields.Bool(required=False, missing=False)
+    }
+
+    @use_args(analyze_batch_args)
+    def post(self, args):
+        """
+        POST route that returns the analysis of every query in a list of queries.
+        :param args: Incoming data from request containing the queries and the access key.
+        :return: JSON response with the list of results of the Analyzer, in the same order as the queries
+        """
+        try:
+            analyzer = Analyzer()
+            timings = Timings()
+            key = args['key'] if 'key' in args.keys() else None
+            results = analyzer.run_analysis_batch(args['queries'], key, timings)
+            if args['save_expression']:
+                db = get_db('expressions')
+                for query, result in zip(args['queries'], results):
+                    db.add_unlabeled_expression(query, result['classification'][0]['intent'],
+                                                result['classification'][0]['confidence'])
+            if args['timings']:
+                resp = jsonify(results=results, timings=timings.to_dict())
+            else:
+                resp = jsonify(results=results)
+            resp.headers['Server-Timing'] = timings.server_timing_header()
+            return resp
+        except DatabaseError as e:
+            logger.exception(e.value)
+            resp = jsonify(e.value)
+            resp.status_code = 500
+            return resp
+        except AnalyzerError as e:
+            logger.exception(e.value)
+            resp = jsonify(e.value)
+            resp.status_code = 500
+            return resp
+
+
+class AnalysisTimings(Resource):
+
+    decorators = [tokenAuth.login_required]
+
+    def get(self):
+        """
+        GET route exposing the in process histograms of the wall and CPU time of analysis phases and annotators.
+        :return: JSON response with the bucket bounds, a histogram per phase/annotator name, the hit rate stats of
+                 the tokenization and gazetteer stem caches and the load/eviction counters of the gazetteer cache
+        """
+        results = TIMING_HISTOGRAMS.to_dict()
+        results['tokenization_cache'] = tokenization_cache.stats()
+        results['gazetteer_cache'] = gazetteer_cache.stats()
+        results['gazetteer_stem_cache'] = stem_cache.stats()
+        resp = jsonify(results)
+        return resp
+
+
 class Train(Resource):
 
     decorators = [tokenAuth.login_required]
@@ -135,9 +214,13 @@ class Train(Resource):
                 gazetteer:
                     {
                         all: true/false,
-                        key: XYZ
+                        key: XYZ,
+                        add: {product_name: [...], product_type: [...], vendor: [...]},
+                        remove: {product_name: [...], product_type: [...], vendor: [...]}
                     }
             }
+        A gazetteer 'add' and/or 'remove' delta updates the gazetteers of the key incrementally instead of rebuilding
+        them.
         :return: Corresponding response object containing message string.
         """
         updater = Updater()
@@ -168,6 +251,10 @@ class Train(Resource):
             if 'gazetteer' in args.keys():
                 if args['gazetteer']['all']:
                     message['gazetteer'] = updater.update_all_gazetteers()
+                elif 'add' in args['gazetteer'] or 'remove' in args['gazetteer']:
+                    message['gazetteer'] = updater.update_gazetteer_entries_by_key(args['gazetteer']['key'],
+                                                                                   args['gazetteer'].get('add'),
+                                                                                   args['gazetteer'].get('remove'))
                 else:
                     message['gazetteer'] = updater.update_gazetteers_by_key(args['gazetteer']['key'])
             resp = jsonify(message=message)
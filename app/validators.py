@@ -77,5 +77,18 @@ def validate_gazetteer_parameters(parameters):
         elif parameters['all'] in [False, 'false', 0]:
             if 'key' not in parameters.keys():
                 raise ValidationError("Parameters must have 'key' key if not training all binary_classifiers!", 400)
+        for delta in ['add', 'remove']:
+            if delta in parameters.keys():
+                if parameters['all'] not in [False, 'false', 0]:
+                    raise ValidationError("The '{0}' parameter requires 'all' to be false".format(delta), 400)
+                if not isinstance(parameters[delta], dict):
+                    raise ValidationError("The '{0}' parameter must map gazetteer types to lists of entities"
+                                          .format(delta), 400)
+                for gazetteer_type, entities in parameters[delta].items():
+                    if gazetteer_type not in ['product_name', 'product_type', 'vendor']:
+                        raise ValidationError("Unknown gazetteer type: {0}".format(gazetteer_type), 400)
+                    if not isinstance(entities, list) or not all(isinstance(x, str) for x in entities):
+                        raise ValidationError("The '{0}' entities of {1} must be a list of strings"
+                                              .format(delta, gazetteer_type), 400)
     else:
         raise ValidationError("Must be a valid JSON/dict object", 400)
\ No newline at end of file
@@ -0,0 +1,181 @@
+"""
+Benchmark of the gazetteer search engines on the fixtures of resources/product_lists. Every fixture is built with
+GramTrieBuilder and SimpleTrieBuilder into each engine (TrieNode, CompactTrie, minimized CompactTrie and
+SymSpellIndex), then a corpus of misspelled queries is replayed against it. Reports the build time, peak RSS, node
+count, estimated memory, the number of terms of every GramTrieBuilder term family and the p50/p95/p99 search latency of
+a query by edit distance. Every combination runs in a fresh worker process so that peak RSS is not inherited from the
+previous one.
+
+Usage, from the top-level Bolt directory:
+    python benchmark/gazetteer_engines.py --fixtures productList500 productList1k --output gazetteer_engines.json
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+
+from benchmark.trie_search import build_queries
+
+FIXTURES_DIR = os.path.join(ROOT_DIR, 'resources', 'product_lists')
+FIXTURES = ['productList500', 'productList1k', 'productList5k', 'productList6k', 'product_types']
+BUILDERS = ['GramTrieBuilder', 'SimpleTrieBuilder']
+ENGINES = ['trie', 'compact', 'dawg', 'symspell']
+
+
+def load_module(name):
+    """
+    Loads a module of nlp/ner by path. Importing it through the nlp package would boot every model of the application.
+    """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT_DIR, 'nlp', 'ner', name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_fixture(fixture):
+    """
+    :param fixture: name of a JSON file of resources/product_lists, without extension
+    :return: list of the non empty entries of its single list
+    """
+    with open(os.path.join(FIXTURES_DIR, fixture + '.json')) as file_:
+        data = json.load(file_)
+    entries = data['products'] if 'products' in data else data['product_types']
+    return [entry for entry in entries if entry]
+
+
+def max_rss_bytes():
+    """
+    :return: peak resident set size of the current process in bytes
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile.
+    """
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def build_engine(trie_module, symspell_module, builder, engine, entries, term_families):
+    """
+    :return: tuple of (search_multiple function, number of nodes or deletion index entries, estimated bytes, window,
+             term counts per family or None)
+    """
+    family_counts = None
+    if builder == 'GramTrieBuilder':
+        postings = trie_module.GramTrieBuilder(term_families).build_postings_from_dictionary(entries)
+        terms = list(postings.postings)
+        family_counts = postings.family_counts
+    else:
+        terms = trie_module.SimpleTrieBuilder().terms_from_dictionary(entries)
+    window = max(len(term.split(' ')) for term in terms)
+    trie = trie_module.TrieNode()
+    for term in terms:
+        trie.insert(term)
+    if engine == 'trie':
+        nodes = 0
+        stack = [trie]
+        while stack:
+            node = stack.pop()
+            nodes += 1
+            stack.extend(node.children.values())
+        return (lambda words, max_cost: trie_module.TrieNode.search_multiple(trie, words, max_cost),
+                nodes, trie_module.trie_memory_size(trie), window, family_counts)
+    if engine == 'symspell':
+        index = symspell_module.SymSpellIndex.from_trie(trie)
+        return index.search_multiple, len(index.index), index.memory_size(), window, family_counts
+    compact_trie = trie_module.CompactTrie.from_trie(trie, minimize=engine == 'dawg')
+    return (compact_trie.search_multiple, len(compact_trie.first_edge) - 1, compact_trie.memory_size(), window,
+            family_counts)
+
+
+def run_benchmark(fixture, builder, engine, queries, edit_distances, term_families):
+    """
+    Builds one engine and replays the queries against it, in a worker process.
+    :return: dict of the results
+    """
+    trie_module = load_module('trie')
+    symspell_module = load_module('symspell')
+    entries = load_fixture(fixture)
+    baseline_rss = max_rss_bytes()
+
+    start = time.perf_counter()
+    search_multiple, nodes, memory_bytes, window, family_counts = build_engine(trie_module, symspell_module, builder,
+                                                                               engine, entries, term_families)
+    build_seconds = time.perf_counter() - start
+
+    """ Queries are searched as Gazetteer.search_query does: every gram up to the longest term in a single walk """
+    dictionary_builder = trie_module.DictionaryBuilder()
+    query_grams = []
+    for query in queries:
+        tokens = query.split(' ')
+        query_grams.append(dictionary_builder.ngrammer(tokens, 1, min(window, len(tokens)) + 1))
+    latency = {}
+    for max_cost in edit_distances:
+        timings = []
+        for grams in query_grams:
+            start = time.perf_counter()
+            search_multiple(grams, max_cost)
+            timings.append((time.perf_counter() - start) * 1000)
+        latency[str(max_cost)] = {"p50": percentile(timings, 0.5), "p95": percentile(timings, 0.95),
+                                  "p99": percentile(timings, 0.99), "mean": sum(timings) / len(timings)}
+    return {"fixture": fixture, "builder": builder, "engine": engine, "entries": len(entries), "nodes": nodes,
+            "memory_bytes": memory_bytes, "build_seconds": build_seconds, "peak_rss_bytes": max_rss_bytes(),
+            "build_rss_bytes": max_rss_bytes() - baseline_rss, "term_families": family_counts, "latency_ms": latency}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures', nargs='+', default=FIXTURES, choices=FIXTURES)
+    parser.add_argument('--builders', nargs='+', default=BUILDERS, choices=BUILDERS)
+    parser.add_argument('--engines', nargs='+', default=ENGINES, choices=ENGINES)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--edit-distances', type=int, nargs='+', default=[0, 1, 2])
+    parser.add_argument('--term-families', nargs='+', default=None,
+                        help='GramTrieBuilder term families, all of them by default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='path of the JSON report, printed to stdout if omitted')
+    args = parser.parse_args()
+
+    results = []
+    print("{0:>15} {1:>17} {2:>8} {3:>9} {4:>9} {5:>10} {6:>6} {7:>9} {8:>9} {9:>9}".format(
+        'fixture', 'builder', 'engine', 'nodes', 'build (s)', 'rss (MB)', 'cost', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'),
+        file=sys.stderr)
+    for fixture in args.fixtures:
+        queries = build_queries(load_fixture(fixture), args.queries, args.seed)
+        for builder in args.builders:
+            for engine in args.engines:
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    result = executor.submit(run_benchmark, fixture, builder, engine, queries,
+                                             args.edit_distances, args.term_families).result()
+                results.append(result)
+                for max_cost in args.edit_distances:
+                    latency = result['latency_ms'][str(max_cost)]
+                    print("{0:>15} {1:>17} {2:>8} {3:>9} {4:>9.2f} {5:>10.1f} {6:>6} {7:>9.2f} {8:>9.2f} "
+                          "{9:>9.2f}".format(fixture, builder, engine, result['nodes'], result['build_seconds'],
+                                             result['peak_rss_bytes'] / 2 ** 20, max_cost, latency['p50'],
+                                             latency['p95'], latency['p99']), file=sys.stderr)
+
+    report = {"python": platform.python_version(), "platform": platform.platform(), "seed": args.seed,
+              "queries": args.queries, "edit_distances": args.edit_distances, "term_families": args.term_families,
+              "results": results}
+    if args.output:
+        with open(args.output, 'w') as file_:
+            json.dump(report, file_, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
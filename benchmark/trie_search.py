@@ -0,0 +1,118 @@
+"""
+Benchmark of the gazetteer trie search kernels: the recursive TrieNode.search against the iterative bit-parallel
+CompactTrie.search, on a product list from resources/product_lists. Results of both kernels are checked to be equal.
+
+Usage, from the top-level Bolt directory:
+    python benchmark/trie_search.py --products resources/product_lists/productList1k.json --queries 50
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import sys
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+
+
+def load_trie_module():
+    """
+    Loads nlp/ner/trie.py by path. Importing it through the nlp package would boot every model of the application.
+    """
+    spec = importlib.util.spec_from_file_location('trie', os.path.join(ROOT_DIR, 'nlp', 'ner', 'trie.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def misspell(text, edits, random_state):
+    """
+    Applies random substitutions, insertions and deletions to the text.
+    """
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    text = list(text)
+    for _ in range(edits):
+        position = random_state.randrange(len(text) + 1)
+        operation = random_state.choice(['substitute', 'insert', 'delete'])
+        if operation == 'insert' or not text:
+            text.insert(position, random_state.choice(letters))
+        elif operation == 'delete':
+            del text[min(position, len(text) - 1)]
+        else:
+            text[min(position, len(text) - 1)] = random_state.choice(letters)
+    return ''.join(text)
+
+
+def build_queries(products, count, seed):
+    """
+    Builds query strings that embed a possibly misspelled product name in a sentence.
+    """
+    random_state = random.Random(seed)
+    templates = ["do you have {0}", "what is the price of the {0}", "{0}", "i want to buy {0} today"]
+    queries = []
+    for _ in range(count):
+        product = misspell(random_state.choice(products).lower(), random_state.randint(0, 2), random_state)
+        queries.append(random_state.choice(templates).format(product))
+    return queries
+
+
+def time_kernel(search, grams, max_cost, repeat):
+    """
+    :return: tuple of (best total seconds over the repeats, results of the last run)
+    """
+    best = None
+    results = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [search(gram, max_cost) for gram in grams]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', default=os.path.join(ROOT_DIR, 'resources', 'product_lists',
+                                                           'productList1k.json'))
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--max-cost', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    trie_module = load_trie_module()
+    with open(args.products) as file_:
+        products = [product for product in json.load(file_)['products'] if product]
+
+    start = time.perf_counter()
+    trie = trie_module.GramTrieBuilder().build_trie_from_dictionary(products)
+    build_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    compact_trie = trie_module.CompactTrie.from_trie(trie)
+    compact_seconds = time.perf_counter() - start
+    print("{0} products, {1} trie words".format(len(products), len(compact_trie)))
+    print("TrieNode build {0:.2f}s, CompactTrie build {1:.2f}s".format(build_seconds, compact_seconds))
+
+    dictionary_builder = trie_module.DictionaryBuilder()
+    grams = []
+    for query in build_queries(products, args.queries, args.seed):
+        tokens = query.split(' ')
+        grams.extend(dictionary_builder.ngrammer(tokens, 1, len(tokens) + 1))
+
+    print("{0:>8} {1:>8} {2:>14} {3:>14} {4:>8}".format('max_cost', 'grams', 'TrieNode (s)', 'Compact (s)',
+                                                        'speedup'))
+    for max_cost in args.max_cost:
+        trie_seconds, trie_results = time_kernel(lambda word, cost: trie_module.TrieNode.search(trie, word, cost),
+                                                 grams, max_cost, args.repeat)
+        compact_seconds, compact_results = time_kernel(compact_trie.search, grams, max_cost, args.repeat)
+        if trie_results != compact_results:
+            raise AssertionError("CompactTrie.search results differ from TrieNode.search")
+        print("{0:>8} {1:>8} {2:>14.3f} {3:>14.3f} {4:>7.1f}x".format(max_cost, len(grams), trie_seconds,
+                                                                     compact_seconds,
+                                                                     trie_seconds / compact_seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ Database layer communicating with postgreSQL via psycopg2 that manages expressio
 import psycopg2
 import logging
 import os
+import threading
 from utils.exceptions import DatabaseError, DatabaseInputError
 from psycopg2.pool import ThreadedConnectionPool
 
@@ -57,6 +58,63 @@ class CoreDatabase:
         logger.debug("Database connection released.")
 
 
+class IntentMetadataCache:
+    """
+    In-process cache of the stopwords and entity definitions of every intent. The cache is loaded in bulk with one
+    query per table and is invalidated by the write paths of IntentsDatabaseEngine and EntitiesDatabaseEngine, so
+    intent classification does not touch the database. Invalidation is local to the current process.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.stopwords = None
+        self.entities = None
+
+    def load(self):
+        """
+        Loads the stopwords and entities of all intents from the database in bulk.
+        :return: tuple of dicts ({intent: [stopwords]}, {intent: [(id, entity_name, entity_type, regular_expressions,
+                 keywords), ...]})
+        """
+        generation = self.generation
+        db = IntentsDatabaseEngine()
+        try:
+            stopwords = db.get_all_intent_stopwords()
+            entities = db.get_all_intent_entities()
+        finally:
+            db.release_database_connection()
+        with self.lock:
+            """ Only store the results if no write invalidated the cache while they were being loaded """
+            if generation == self.generation:
+                self.stopwords = stopwords
+                self.entities = entities
+        logger.debug("Loaded intent metadata cache for {0} intents.".format(len(stopwords)))
+        return stopwords, entities
+
+    def invalidate(self):
+        """
+        Drops the cached intent metadata. The next lookup reloads it from the database.
+        """
+        with self.lock:
+            self.generation += 1
+            self.stopwords = None
+            self.entities = None
+
+    def get_intent_metadata(self, intent):
+        """
+        Returns the stopwords and entities for the given intent, loading the cache first if it is empty.
+        :param intent: name of intent
+        :return: tuple (stopwords, [(id, entity_name, entity_type, regular_expressions, keywords), ...])
+        """
+        stopwords, entities = self.stopwords, self.entities
+        if stopwords is None or entities is None:
+            stopwords, entities = self.load()
+        return stopwords.get(intent), entities.get(intent, [])
+
+
+intent_metadata = IntentMetadataCache()
+
+
 class ExternalDatabaseEngine(CoreDatabase):
     """
     CoreDatabase extending class that manages information retrieval from materialized view of Shopify data.
@@ -152,6 +210,43 @@ class ExternalDatabaseEngine(CoreDatabase):
             logger.exception(e.pgerror)
             raise DatabaseError(e.pgerror)
 
+    def iter_entities_by_key(self, itersize=100):
+        """
+        Streams the unique product names, product types and vendors of every key with a server side cursor, one row
+        per key, so that the entities of all keys are never held in memory at once. NULL values are left out and the
+        values of each list are sorted.
+        :param itersize: number of keys fetched from the server at a time
+        :return: generator of tuples (key, {'product_name': [...], 'product_type': [...], 'vendor': [...]})
+        """
+        cursor = self.conn.cursor(name='bolt_entities_by_key')
+        cursor.itersize = itersize
+        try:
+            cursor.execute("SELECT key, "
+                           "COALESCE(array_agg(DISTINCT product_name ORDER BY product_name) "
+                           "FILTER (WHERE product_name IS NOT NULL), '{}'), "
+                           "COALESCE(array_agg(DISTINCT product_type ORDER BY product_type) "
+                           "FILTER (WHERE product_type IS NOT NULL), '{}'), "
+                           "COALESCE(array_agg(DISTINCT vendor ORDER BY vendor) "
+                           "FILTER (WHERE vendor IS NOT NULL), '{}') "
+                           "FROM public.entities "
+                           "GROUP BY key "
+                           "ORDER BY key")
+            logger.debug("Streaming entities of every key from shopify database.")
+            for key, product_names, product_types, vendors in cursor:
+                yield key, {'product_name': product_names, 'product_type': product_types, 'vendor': vendors}
+        except GeneratorExit:
+            """ The caller stopped iterating, end the transaction holding the server side cursor """
+            cursor.close()
+            self.conn.rollback()
+            raise
+        except psycopg2.Error as e:
+            self.conn.rollback()
+            logger.exception(e.pgerror)
+            raise DatabaseError(e.pgerror)
+        else:
+            cursor.close()
+            self.conn.commit()
+
     # TODO: get_options_by_key()
 
 
@@ -188,6 +283,7 @@ class IntentsDatabaseEngine(CoreDatabase):
         try:
             self.cur.execute("INSERT INTO intents (intent_name) VALUES (%s);", (intent,))
             self.conn.commit()
+            intent_metadata.invalidate()
             logger.debug("Adding intent: %s", intent)
             return self.get_intents()
         except psycopg2.Error as e:
@@ -209,6 +305,7 @@ class IntentsDatabaseEngine(CoreDatabase):
             self.cur.execute("DELETE FROM intents "
                              "WHERE intents.intent_name = %s;", (intent,))
             self.conn.commit()
+            intent_metadata.invalidate()
             logger.debug("Deleting intent: %s", intent)
             return self.get_intents()
         except psycopg2.Error as e:
@@ -263,6 +360,20 @@ class IntentsDatabaseEngine(CoreDatabase):
                 logger.exception(e.pgerror)
                 raise DatabaseError(e.pgerror)
 
+    def get_all_intent_stopwords(self):
+        """
+        Retrieves the stopwords of every intent in a single query.
+        :return: dict of {intent: [stopwords]}
+        """
+        try:
+            self.cur.execute("SELECT intent_name, stopwords FROM intents;")
+            logger.debug("Retrieving stopwords for all intents")
+            return {x[0]: x[1] for x in self.cur.fetchall()}
+        except psycopg2.Error as e:
+            self.conn.rollback()
+            logger.exception(e.pgerror)
+            raise DatabaseError(e.pgerror)
+
     def add_stopwords_to_intent(self, intent, stopwords):
         """
         Adds stopwords to an intent
@@ -288,6 +399,7 @@ class IntentsDatabaseEngine(CoreDatabase):
                                          "SET stopwords = array_cat(intents.stopwords, %s) "
                                          "WHERE intents.id = %s", (stopwords, intent_id,))
                         self.conn.commit()
+                        intent_metadata.invalidate()
                         return self.get_intent_stopwords(intent)
                 else:
                     msg = "Method expects a string or non-empty list of stopwords"
@@ -321,6 +433,7 @@ class IntentsDatabaseEngine(CoreDatabase):
                                  "SET stopwords = %s "
                                  "WHERE intents.intent_name = %s", (existing_stopwords, intent))
                 self.conn.commit()
+                intent_metadata.invalidate()
                 return self.get_intent_stopwords(intent)
             else:
                 msg = "Method expects a non-null string or non-empty list of stopwords"
@@ -363,6 +476,28 @@ class IntentsDatabaseEngine(CoreDatabase):
                 logger.exception(e.pgerror)
                 raise DatabaseError(e.pgerror)
 
+    def get_all_intent_entities(self):
+        """
+        Retrieves the entities of every intent in a single query.
+        :return: dict of {intent: [(id, entity_name, entity_type, regular_expressions, keywords), ...]}
+        """
+        try:
+            self.cur.execute("SELECT "
+                             "  intents.intent_name, entities.id, entities.entity_name, entities.entity_type, "
+                             "  entities.regular_expressions, entities.keywords "
+                             "FROM intents_entities "
+                             "JOIN entities ON intents_entities.entity_id = entities.id "
+                             "JOIN intents ON intents_entities.intent_id = intents.id;")
+            logger.debug("Retrieving entities for all intents")
+            intent_entities = {}
+            for result in self.cur.fetchall():
+                intent_entities.setdefault(result[0], []).append(tuple(result[1:]))
+            return intent_entities
+        except psycopg2.Error as e:
+            self.conn.rollback()
+            logger.exception(e.pgerror)
+            raise DatabaseError(e.pgerror)
+
     def add_entities_to_intent(self, intent, entities):
         """
         Adds a entities to an intent
@@ -391,6 +526,7 @@ class IntentsDatabaseEngine(CoreDatabase):
                                              "(intent_id, entity_id) "
                                              "VALUES (%s, %s)", (intent_id, entity_id))
                     self.conn.commit()
+                    intent_metadata.invalidate()
                     return self.get_intent_entities(intent)
                 else:
                     msg = "Method expects a string or non-empty list of entities"
@@ -425,6 +561,7 @@ class IntentsDatabaseEngine(CoreDatabase):
                                          "WHERE intents_entities.entity_id = %s",
                                          (entity_id,))
                     self.conn.commit()
+                    intent_metadata.invalidate()
                 return self.get_intent_entities(intent)
             else:
                 msg = "Method expects a non-null string or non-empty list of entities"
@@ -487,6 +624,7 @@ class EntitiesDatabaseEngine(CoreDatabase):
                              "(entity_name, entity_type, regular_expressions, keywords) "
                              "VALUES (%s,%s,%s,%s)", (entity_name, entity_type, regular_expressions, keywords,))
             self.conn.commit()
+            intent_metadata.invalidate()
             return self.get_entities()
         except psycopg2.Error as e:
             self.conn.rollback()
@@ -532,6 +670,7 @@ class EntitiesDatabaseEngine(CoreDatabase):
                              "    keywords = %s "
                              "WHERE id = %s", (entity_name, entity_type, regular_expressions, keywords, entity_id,))
             self.conn.commit()
+            intent_metadata.invalidate()
             self.cur.execute("SELECT * FROM entities "
                              "WHERE id = %s", (entity_id,))
             return self.cur.fetchall()
@@ -550,6 +689,7 @@ class EntitiesDatabaseEngine(CoreDatabase):
             self.cur.execute("DELETE FROM entities "
                              "WHERE entities.entity_name = %s", (entity_name,))
             self.conn.commit()
+            intent_metadata.invalidate()
             return self.get_entities()
         except psycopg2.Error as e:
             self.conn.rollback()
@@ -604,6 +744,28 @@ class EntitiesDatabaseEngine(CoreDatabase):
             logger.exception(msg)
             raise DatabaseInputError(msg)
 
+    def get_all_binary_entity_expressions(self):
+        """
+        Get the binary entity expressions of every binary_classifier entity in a single query
+        :return: dict of {entity_name: [(expression_id, expression, boolean), ...], ...}
+        """
+        try:
+            self.cur.execute("SELECT entities.entity_name, expressions.id, expressions.expressions, "
+                             "expressions_entities.boolean_value "
+                             "FROM expressions_entities "
+                             "JOIN expressions ON expressions_entities.expression_id = expressions.id "
+                             "JOIN entities ON expressions_entities.entity_id = entities.id "
+                             "WHERE entities.entity_type = 'binary_classifier' "
+                             "ORDER BY entities.entity_name, expressions.id")
+            binary_entity_expressions = {}
+            for row in self.cur.fetchall():
+                binary_entity_expressions.setdefault(row[0], []).append((row[1], row[2], row[3]))
+            return binary_entity_expressions
+        except psycopg2.Error as e:
+            self.conn.rollback()
+            logger.exception(e.pgerror)
+            raise DatabaseError(e.pgerror)
+
     def delete_binary_entity_from_expression(self, expression_id, entity_name):
         """
         Deletes the m:n reference linking a binary classifier entity to a validated expression
@@ -9,13 +9,16 @@ I want to see it in action up close before I make use of textacy for calls to Sp
 '''
 
 from functools import partial
+from contextlib import contextmanager
 import logging
+import threading
 
 import os
 from cachetools import cached, Cache
 from cachetools.keys import hashkey
 import spacy
 import en_core_web_sm
+from utils.string_cleaners import normalize_whitespace
 
 
 logger = logging.getLogger('BOLT.spacy')
@@ -49,3 +52,62 @@ def load_spacy(name, **kwargs):
 
     logger.info('Caching "%s" language spaCy', name)
     return en_core_web_sm.load(**kwargs)
+
+
+# Lazily parsed spaCy Docs of the queries currently being analyzed, keyed by the whitespace normalized text they were
+# parsed from. Docs are only shared between identical texts, so that a Doc parsed from cased text is never used to
+# tokenize the lower-cased text the classifiers were trained on.
+SHARED_DOCS = {}
+shared_docs_lock = threading.Lock()
+
+
+def shared_doc_key(text):
+    """
+    Normalizes whitespace the way the Docs are parsed, so that a Doc is only shared with the exact text it was parsed
+    from.
+    Args:
+        text (str): raw or cleaned query text
+    Returns:
+        str: whitespace normalized text
+    """
+    return normalize_whitespace(text)
+
+
+@contextmanager
+def shared_doc(text, parse):
+    """
+    Registers a parse callable for text so that every component tokenizing the same text reuses one spaCy Doc
+    while the context is active.
+    Args:
+        text (str): the query text
+        parse (callable): returns the (lazily computed) spaCy Doc of the text
+    """
+    key = shared_doc_key(text)
+    with shared_docs_lock:
+        entry = SHARED_DOCS.get(key)
+        if entry is None:
+            SHARED_DOCS[key] = [parse, 1]
+        else:
+            entry[1] += 1
+    try:
+        yield
+    finally:
+        with shared_docs_lock:
+            entry = SHARED_DOCS[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del SHARED_DOCS[key]
+
+
+def get_shared_doc(text):
+    """
+    Returns the shared spaCy Doc registered for text, if any.
+    Args:
+        text (str): raw or cleaned query text
+    Returns:
+        :class:`spacy.tokens.Doc` or None if no Doc is shared for the text
+    """
+    entry = SHARED_DOCS.get(shared_doc_key(text))
+    if entry is None:
+        return None
+    return entry[0]()
@@ -5,17 +5,23 @@ Created on Nov 3, 2016
 @company: Lightning in a Bot, Inc
 """
 import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import ExitStack
 
 from nlp.annotation import IntentClassificationAnnotator, BinaryClassificationAnnotator, DatetimeAnnotator, \
                            GazetteerAnnotator, RegexAnnotator, BinaryRegexAnnotator, NaiveNumberAnnotator, \
                            FuzzyMatcherAnnotator, Annotation
 from nlp.clf.classification import ClassificationModelBuilder, ClassificationModelAccessor
-from nlp.ner.duckling_datetime import DucklingFactory, DucklingDatetimeParser
-from nlp.ner.gazetteer import GazetteerModelAccessor, GazetteerModelBuilder
+from nlp.ner.gazetteer import GazetteerModelAccessor, GazetteerModelBuilder, GAZETTEER_LAZY_LOADING
+from nlp.ner.shards import start_shard_pool
 from nlp.ner.number_parser import NumberExtractor
 from nlp.ner.fuzzy_matcher import FuzzyMatcher
 from nlp.ner.regexer import Regexer
+from database.database import intent_metadata
 from utils.exceptions import ClassificationModelError, GazetteerModelError, AnalyzerError, UpdaterError
+from utils.timing import Timings, TIMING_HISTOGRAMS
 
 logger = logging.getLogger('BOLT.nlp')
 
@@ -23,10 +29,92 @@ clf_builder = ClassificationModelBuilder()
 gaz_builder = GazetteerModelBuilder()
 
 clf_builder.initialize_classification_models(multiclass=True, binary_classifier=True)
-gaz_builder.initialize_gazetteer_models()
+""" Boot from gazetteer snapshots when available instead of rebuilding every gazetteer from the database, then build the
+keys that have no snapshot. With lazy loading the gazetteers of a key are built or loaded on its first analysis instead. """
+if not GAZETTEER_LAZY_LOADING:
+    if gaz_builder.load_gazetteer_snapshots():
+        gaz_builder.initialize_missing_gazetteer_models()
+    else:
+        gaz_builder.initialize_gazetteer_models()
+""" Fork the shard workers while the process is still single threaded, they inherit the shards loaded above. Importing
+duckling_datetime starts the Duckling JVM and its threads, so it is only imported once the workers are forked. """
+start_shard_pool()
+from nlp.ner.duckling_datetime import DucklingFactory, DucklingDatetimeParser
+intent_metadata.load()
 
 duckling_factory = DucklingFactory
 
+""" Concurrent entity annotation settings. The deadline is given in seconds and applies to the whole pipeline.
+Threads can not be cancelled, so an annotator overrunning the deadline keeps its executor thread until it returns. An
+annotator is not run again while it overruns, which bounds the threads held by overrunning annotators to one per
+annotator of the cached pipelines; ANNOTATOR_THREADS should leave room for them next to the concurrent requests. """
+concurrent_annotators = os.environ.get('CONCURRENT_ANNOTATORS', 'false').lower() == 'true'
+annotator_deadline = float(os.environ['ANNOTATOR_DEADLINE']) if os.environ.get('ANNOTATOR_DEADLINE') else None
+annotator_threads = int(os.environ.get('ANNOTATOR_THREADS', 8))
+annotator_executor = ThreadPoolExecutor(max_workers=annotator_threads)
+
+
+class AnalysisPipelineCache:
+    """
+    Cache of compiled AnalysisPipelines. Each pipeline is stored with the generations of the intent metadata,
+    classifiers and gazetteers of its key it was built from, and is rebuilt on lookup once any of them has changed.
+    Whenever a model changes, the stale pipelines are swept so that they do not hold on to evicted gazetteers, while
+    the pipelines of other keys are kept.
+    """
+    def __init__(self):
+        self.pipelines = {}
+        self.generation = None
+        """ Serializes lookups and updates of the pipelines. Pipelines are built outside of the lock. """
+        self.lock = threading.Lock()
+
+    def get(self, cache_key, generations, build):
+        """
+        Returns the cached pipeline for the cache key, building and caching it with build() if it is missing or stale.
+        :param cache_key: hashable key of the pipeline; (intent, key) for entity pipelines
+        :param generations: tuple of model generations the pipeline must have been built from
+        :param build: callable returning a new AnalysisPipeline
+        :return: AnalysisPipeline object
+        """
+        with self.lock:
+            cached = self.pipelines.get(cache_key)
+            if cached is not None and cached[0] == generations:
+                return cached[1]
+        pipeline = build()
+        with self.lock:
+            self.pipelines[cache_key] = (generations, pipeline)
+        return pipeline
+
+    def sweep(self, generation, get_generations):
+        """
+        Drops the stale pipelines, once per change of the global model generation.
+        :param generation: tuple of the global model generations
+        :param get_generations: callable returning the current model generations of a cache key
+        """
+        with self.lock:
+            if generation == self.generation:
+                return
+            self.generation = generation
+            for cache_key, (generations, pipeline) in list(self.pipelines.items()):
+                if generations != get_generations(cache_key):
+                    del self.pipelines[cache_key]
+
+    def invalidate(self, key=None):
+        """
+        Drops the cached entity pipelines of a key, or all cached pipelines.
+        :param key: unique identification key for the gazetteer type; usually bot key
+        """
+        with self.lock:
+            if key is None:
+                self.pipelines = {}
+                return
+            for cache_key in [cache_key for cache_key in self.pipelines
+                              if isinstance(cache_key, tuple) and cache_key[1] == key]:
+                del self.pipelines[cache_key]
+
+
+analysis_pipelines = AnalysisPipelineCache()
+
+
 class Updater:
     """
     Updater objects are used to update classification and gazetteer models based on type and key.
@@ -92,6 +180,27 @@ class Updater:
         except GazetteerModelError as error:
             raise UpdaterError(error.value)
 
+    def update_gazetteer_entries_by_key(self, key, added=None, removed=None):
+        """
+        Incrementally adds and removes entities of the gazetteers of the given key
+        :param key: unique identification key for the gazetteer type; usually bot key
+        :param added: dict of gazetteer type to list of entities to add
+        :param removed: dict of gazetteer type to list of entities to remove
+        :return: Successful message.
+        """
+        added = added or {}
+        removed = removed or {}
+        try:
+            if not self.gaz_builder.check_if_key_exists(key):
+                raise UpdaterError("Key not available in database. Cannot update/create gazetteer.")
+            for gazetteer_type in sorted(set(added.keys()) | set(removed.keys())):
+                logger.debug("Updating {0} gazetteer entries for key: {1}".format(gazetteer_type, key))
+                self.gaz_builder.update_gazetteer_entries(gazetteer_type, key, added.get(gazetteer_type),
+                                                          removed.get(gazetteer_type))
+            return "Gazetteer entries for the key {0} updated".format(key)
+        except GazetteerModelError as error:
+            raise UpdaterError(error.value)
+
 
 class Analyzer:
     """
@@ -102,38 +211,179 @@ class Analyzer:
         self.clf_accessor = ClassificationModelAccessor()
         self.duckling_factory = DucklingFactory()
 
-    def run_analysis(self, query, key=None):
+    def run_analysis(self, query, key=None, timings=None):
         """
-        Builds an AnalysisPipeline objects and the set of Annotator objects to be used in the pipeline.
-        Runs the analysis and retruns the 'results' value of the Annotation object's annotations dict.
+        Runs the analysis using the cached AnalysisPipeline objects of the intent classifier and the top intent.
+        Retruns the 'results' value of the Annotation object's annotations dict.
         :param query: The query text to be analyzed
         :param key: unique identification key for the gazetteer type; usually bot key
+        :param timings: optional Timings object collecting the wall and CPU time of each phase and annotator
         :return: dict of results
         """
         logger.info("Running analysis on query...")
         core_annotation = Annotation(query, key)
-        clf_pipeline = AnalysisPipeline()
-        entity_pipeline = AnalysisPipeline()
-        clf = self.clf_accessor.get_classification_pipeline('multiclass', 'intent_classifier')
+        if timings is not None:
+            core_annotation.timings = timings
+        try:
+            """ Share the query's spaCy Doc with every tokenizer and annotator during the analysis """
+            with core_annotation.timings.measure('analysis'), core_annotation.share_doc():
+                return self._analyze(core_annotation, key)
+        finally:
+            TIMING_HISTOGRAMS.observe(core_annotation.timings)
+
+    def _analyze(self, core_annotation, key):
+        """
+        Runs the intent classification and entity pipelines on the annotation.
+        :param core_annotation: Annotation object of the query
+        :param key: unique identification key for the gazetteer type; usually bot key
+        :return: dict of results
+        """
+        timings = core_annotation.timings
+        with timings.measure('pipeline_lookup'):
+            self._sweep_pipelines()
+            clf_pipeline = analysis_pipelines.get('intent_classifier', self._get_model_generations('intent_classifier'),
+                                                  self._build_intent_pipeline)
 
-        """ Create the IntentClassificationAnnotator using the pipeline 'clf' """
-        clf_annotator = IntentClassificationAnnotator('clf', clf)
-        clf_pipeline.add_annotator(clf_annotator)
         """ Run clf_pipeline to obtain intent classification """
-        core_annotation = clf_pipeline.analyze(core_annotation)
+        with timings.measure('intent_pipeline'):
+            core_annotation = clf_pipeline.analyze(core_annotation)
         """ Ensure classification results exists, otherwise raise AnalyzerError """
         if core_annotation.annotations['results']['classification'] is []:
             raise AnalyzerError("No intent classification results.")
-        """ Create annotators based on entity types of intent classification """
+        """ Obtain the entity pipeline for the entity types of the top intent """
+        top_intent = core_annotation.annotations['results']['classification'][0]['intent']
         entities = core_annotation.annotations['entity_types']
 
-        """ Obtain gazetteers associated with the given key """
-        gazetteers = self.gaz_accessor.get_gazeteers(key)
-
         logger.debug("Core annotation intents: {0}".format(core_annotation.annotations['results']['classification']))
         logger.debug("Core annotation entities: {0}".format(core_annotation.annotations['entity_types']))
         logger.debug("Core annotation stopwords: {0}".format(core_annotation.annotations['stopwords']))
 
+        with timings.measure('pipeline_lookup'):
+            entity_pipeline = self._get_entity_pipeline(top_intent, key, entities)
+        with timings.measure('entity_pipeline'):
+            core_annotation = entity_pipeline.analyze(core_annotation)
+        return core_annotation.annotations['results']
+
+    def run_analysis_batch(self, queries, key=None, timings=None):
+        """
+        Runs the analysis on a list of queries. All queries are classified with a single vectorized call to the intent
+        classifier and queries sharing a top intent share one entity AnalysisPipeline.
+        :param queries: list of query texts to be analyzed
+        :param key: unique identification key for the gazetteer type; usually bot key
+        :param timings: optional Timings object collecting the wall and CPU time of each phase and annotator, summed
+                        over the whole batch
+        :return: list of dicts of results in the same order as the queries
+        """
+        logger.info("Running batch analysis on {0} queries...".format(len(queries)))
+        if timings is None:
+            timings = Timings()
+        annotations = [Annotation(query, key) for query in queries]
+        for annotation in annotations:
+            annotation.timings = timings
+        try:
+            with timings.measure('analysis'), ExitStack() as stack:
+                for annotation in annotations:
+                    stack.enter_context(annotation.share_doc())
+                return self._analyze_batch(annotations, key, timings)
+        finally:
+            TIMING_HISTOGRAMS.observe(timings)
+
+    def _analyze_batch(self, annotations, key, timings):
+        """
+        Runs the batched intent classification and the grouped entity pipelines on the annotations.
+        :param annotations: list of Annotation objects, one per query
+        :param key: unique identification key for the gazetteer type; usually bot key
+        :param timings: Timings object shared by the annotations
+        :return: list of dicts of results in the same order as the annotations
+        """
+        clf = self.clf_accessor.get_classification_pipeline('multiclass', 'intent_classifier')
+        if clf is None:
+            raise AnalyzerError("No intent classifier available.")
+        try:
+            queries = [annotation.annotations['original_text'] for annotation in annotations]
+            with timings.measure('intent_pipeline'):
+                batch_classification_results = clf.classify_batch(queries, timings)
+        except ClassificationModelError as error:
+            raise AnalyzerError(error.value)
+
+        with timings.measure('pipeline_lookup'):
+            self._sweep_pipelines()
+
+        """ Group the queries by top intent so that each entity pipeline is looked up once """
+        intent_groups = {}
+        for idx, classification_results in enumerate(batch_classification_results):
+            top_intent = classification_results['intents'][0]['intent']
+            intent_groups.setdefault(top_intent, []).append(idx)
+
+        results = [None] * len(annotations)
+        for top_intent, indices in intent_groups.items():
+            entities = batch_classification_results[indices[0]]['entity_types']
+            with timings.measure('pipeline_lookup'):
+                entity_pipeline = self._get_entity_pipeline(top_intent, key, entities)
+            for idx in indices:
+                annotation = IntentClassificationAnnotator.apply_classification_results(annotations[idx],
+                                                                                        batch_classification_results[idx])
+                with timings.measure('entity_pipeline'):
+                    annotation = entity_pipeline.analyze(annotation)
+                results[idx] = annotation.annotations['results']
+        return results
+
+    def _get_model_generations(self, cache_key):
+        """
+        Returns the generations of the models a cached AnalysisPipeline is built from.
+        :param cache_key: 'intent_classifier' or (intent, key) of an entity pipeline
+        :return: tuple of (intent metadata, classifiers) generations, followed by the generation of the gazetteers of
+                 the key for entity pipelines
+        """
+        generations = intent_metadata.generation, self.clf_accessor.get_generation()
+        if isinstance(cache_key, tuple):
+            generations += (self.gaz_accessor.get_generation(cache_key[1]),)
+        return generations
+
+    def _sweep_pipelines(self):
+        """
+        Drops the cached AnalysisPipelines built from models that changed since the last analysis.
+        """
+        generation = intent_metadata.generation, self.clf_accessor.get_generation(), self.gaz_accessor.get_generation()
+        analysis_pipelines.sweep(generation, self._get_model_generations)
+
+    def _build_intent_pipeline(self):
+        """
+        Builds the AnalysisPipeline containing the IntentClassificationAnnotator.
+        :return: AnalysisPipeline object
+        """
+        clf = self.clf_accessor.get_classification_pipeline('multiclass', 'intent_classifier')
+        return AnalysisPipeline(IntentClassificationAnnotator('clf', clf))
+
+    def _get_entity_pipeline(self, intent, key, entities):
+        """
+        Returns the cached entity AnalysisPipeline for the intent and key, building it if it is missing or stale.
+        :param intent: name of the top intent
+        :param key: unique identification key for the gazetteer type; usually bot key
+        :param entities: list of entity dicts associated with the intent
+        :return: AnalysisPipeline object
+        """
+        built = []
+
+        def build():
+            """ Obtain gazetteers associated with the given key, get_gazeteers marks them recently used """
+            built.append(True)
+            gazetteers = self.gaz_accessor.get_gazeteers(key)
+            return self._build_entity_pipeline(entities, gazetteers)
+        pipeline = analysis_pipelines.get((intent, key), self._get_model_generations((intent, key)), build)
+        """ Keep the gazetteers of the key recently used when the cached pipeline is reused """
+        if not built:
+            self.gaz_accessor.touch(key)
+        return pipeline
+
+    def _build_entity_pipeline(self, entities, gazetteers):
+        """
+        Builds the AnalysisPipeline of entity Annotators for the entity types of an intent.
+        :param entities: list of entity dicts associated with the intent
+        :param gazetteers: dict of gazetteers associated with the key, or None
+        :return: AnalysisPipeline object
+        """
+        entity_pipeline = AnalysisPipeline(concurrent=concurrent_annotators, deadline=annotator_deadline)
         """ Iterate over entities and create an the appropriate Annotator based on the entity_type """
         for entity in entities:
             """ Access the binary classifier for the appropriate entity types and create BinaryClassifierAnnotator"""
@@ -185,15 +435,27 @@ class Analyzer:
                         gaz_annotator = GazetteerAnnotator(entity['entity_name'], gazetteers[entity['entity_name']])
                         entity_pipeline.add_annotator(gaz_annotator)
 
-        core_annotation = entity_pipeline.analyze(core_annotation)
-        return core_annotation.annotations['results']
+        return entity_pipeline
 
 
 class AnalysisPipeline:
     """
     AnalysisPipeline objects store a sequence of annotators that iteratively analyzes a query.
+    In concurrent mode the annotators must be independent of each other; they run on the shared annotator_executor
+    and their entity results are merged in sequence order.
     """
-    def __init__(self, *args):
+    """ Futures of the annotator runs that missed their deadline and are still running, shared by all pipelines """
+    overrunning = set()
+    overrunning_lock = threading.Lock()
+
+    def __init__(self, *args, concurrent=False, deadline=None):
+        """
+        :param args: Annotators making up the sequence
+        :param concurrent: run the annotators concurrently on the shared annotator_executor
+        :param deadline: seconds after which unfinished annotators are reported as timed out (concurrent mode only)
+        """
+        self.concurrent = concurrent
+        self.deadline = deadline
         self.sequence = list()
         if args is not None:
             for arg in args:
@@ -213,9 +475,85 @@ class AnalysisPipeline:
         :param annotation: Annotation object to collect and store annotator reulst
         :return: Returns the annotation object
         """
+        """ A single annotator still runs on the executor when a deadline is set, so that the deadline applies to it """
+        if self.concurrent and (len(self.sequence) > 1 or (self.sequence and self.deadline is not None)):
+            return self._analyze_concurrently(annotation)
+        for annotator in self.sequence:
+            annotation = self._run_annotator(annotator, annotation)
+        return annotation
+
+    def _run_annotator(self, annotator, annotation):
+        """
+        Runs a single Annotator, recording its wall and CPU time in the annotation's Timings.
+        :param annotator: Annotator to run
+        :param annotation: Annotation object to collect and store annotator reulst
+        :return: Returns the annotation object
+        """
+        with annotation.timings.measure('annotator.' + annotator.name):
+            return annotator.validate_and_annotate(annotation)
+
+    def _analyze_concurrently(self, annotation):
+        """
+        Runs every Annotator on its own fork of the annotation and merges the entity results of the forks in sequence
+        order. Annotators that do not finish before the deadline are listed by name in the 'timed_out' results, which
+        only exist if an annotator timed out; they keep running in the background but their results are discarded.
+        Until they return, they are reported as timed out without being run again.
+        :param annotation: Annotation object to collect and store annotator reulst
+        :return: Returns the annotation object
+        """
+        runs = []
         for annotator in self.sequence:
-            annotation = annotator.validate_and_annotate(annotation)
+            if self._is_overrunning(annotator):
+                runs.append((annotator, None, None))
+                continue
+            forked_annotation = annotation.fork()
+            runs.append((annotator, forked_annotation,
+                         annotator_executor.submit(self._run_annotator, annotator, forked_annotation)))
+        done, not_done = wait([future for annotator, forked_annotation, future in runs if future is not None],
+                              timeout=self.deadline)
+        entities = annotation.annotations['results']['entities']
+        for annotator, forked_annotation, future in runs:
+            if future in done:
+                forked_annotation = future.result()
+                entities.extend(forked_annotation.annotations['results']['entities'])
+                continue
+            if future is None:
+                logger.warning("Annotator {0} skipped, it still overruns a previous deadline.".format(annotator.name))
+            elif not future.cancel():
+                self._add_overrunning(annotator, future)
+                logger.warning("Annotator {0} missed the deadline of {1}s.".format(annotator.name, self.deadline))
+            else:
+                logger.warning("Annotator {0} did not start before the deadline of {1}s.".format(annotator.name,
+                                                                                                  self.deadline))
+            annotation.annotations['results'].setdefault('timed_out', []).append(annotator.name)
         return annotation
+
+    def _is_overrunning(self, annotator):
+        """
+        :param annotator: Annotator of the sequence
+        :return: True if a run of the annotator missed its deadline and has not returned yet
+        """
+        with AnalysisPipeline.overrunning_lock:
+            return any(run[0] is annotator for run in AnalysisPipeline.overrunning)
+
+    def _add_overrunning(self, annotator, future):
+        """
+        Tracks a run of the annotator that missed its deadline until it returns.
+        :param annotator: Annotator of the run
+        :param future: Future of the run
+        """
+        run = (annotator, future)
+        with AnalysisPipeline.overrunning_lock:
+            AnalysisPipeline.overrunning.add(run)
+            count = len(AnalysisPipeline.overrunning)
+        if count >= annotator_threads // 2:
+            logger.warning("Overrunning annotators hold {0} of the {1} annotator threads.".format(count,
+                                                                                                 annotator_threads))
+
+        def discard(done_future):
+            with AnalysisPipeline.overrunning_lock:
+                AnalysisPipeline.overrunning.discard(run)
+        future.add_done_callback(discard)
       
     def __str__(self):
         return [(annotator.name, annotator) for annotator in self.sequence]
\ No newline at end of file
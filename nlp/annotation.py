@@ -4,8 +4,14 @@ Created on Nov 2, 2016
 @author: Carl Mueller
 """
 from abc import abstractmethod, ABCMeta
+from contextlib import contextmanager
+from models.spacy_model import load_spacy, shared_doc
+from transformers.clean_text_transformer import cleanText
 from utils.exceptions import AnnotatorValidationError, AnnotatorAnnotateError, ClassificationModelError
+from utils.string_cleaners import normalize_whitespace
+from utils.timing import Timings
 import logging
+import threading
 
 
 class Annotation:
@@ -19,8 +25,80 @@ class Annotation:
         self.annotations['original_text'] = original_text
         self.annotations['key'] = key
         self.annotations['results'] = {"classification": [], "entities": []}
-    
-    
+        self._doc = None
+        self._clean_doc = None
+        self._doc_lock = threading.Lock()
+        self._parent = None
+        self.timings = Timings()
+
+    @property
+    def doc(self):
+        """
+        The spaCy Doc of the original text, parsed on first access and shared by all annotators and forks.
+        """
+        if self._parent is not None:
+            return self._parent.doc
+        if self._doc is None:
+            with self._doc_lock:
+                if self._doc is None:
+                    nlp = load_spacy('en')
+                    self._doc = nlp(normalize_whitespace(self.annotations['original_text']))
+        return self._doc
+
+    @property
+    def clean_doc(self):
+        """
+        The spaCy Doc of the text as cleaned by the CleanTextTransformer of the classification pipelines, parsed on
+        first access and shared by all classifiers and forks.
+        """
+        if self._parent is not None:
+            return self._parent.clean_doc
+        if self._clean_doc is None:
+            with self._doc_lock:
+                if self._clean_doc is None:
+                    nlp = load_spacy('en')
+                    self._clean_doc = nlp(self.clean_text())
+        return self._clean_doc
+
+    def clean_text(self):
+        """ The original text as tokenized inside the classification pipelines """
+        return normalize_whitespace(cleanText(self.annotations['original_text']))
+
+    def fork(self):
+        """
+        Creates an annotation sharing the text, classification results, entity types, stopwords and Doc of this
+        annotation but with its own empty list of entity results. Used to run annotators concurrently.
+        :return: forked Annotation object
+        """
+        forked = Annotation(self.annotations['original_text'], self.annotations['key'])
+        forked.annotations.update((name, value) for name, value in self.annotations.items() if name != 'results')
+        forked.annotations['results']['classification'] = self.annotations['results']['classification']
+        forked._parent = self
+        forked.timings = self.timings
+        return forked
+
+    @property
+    def tokens(self):
+        """ List of token strings of the shared Doc """
+        return [token.text for token in self.doc]
+
+    @property
+    def lemmas(self):
+        """ List of lower-cased lemmas of the shared Doc """
+        return [token.lemma_.lower().strip() if token.lemma_ != "-PRON-" else token.lower_ for token in self.doc]
+
+    @contextmanager
+    def share_doc(self):
+        """
+        Context manager registering the shared Docs of the original and the cleaned text so that tokenizers inside
+        sklearn pipelines reuse them instead of parsing the text again. Tokenizers only get the Doc of the exact text
+        they tokenize.
+        """
+        with shared_doc(self.annotations['original_text'], lambda: self.doc), \
+                shared_doc(self.clean_text(), lambda: self.clean_doc):
+            yield
+
+
 class AbstractAnnotator(metaclass=ABCMeta):
     """ Abstract class for Annotators """
     
@@ -72,16 +150,27 @@ class IntentClassificationAnnotator(AbstractAnnotator):
         :return: Updated annotation object
         """
         try:
-            classification_results = self.classifier.classify(annotation.annotations['original_text'])
-            annotation.annotations['stopwords'] = classification_results['stopwords']
-            annotation.annotations['entity_types'] = classification_results['entity_types']
-            annotation.annotations['results']['classification'] = classification_results['intents']
-            return annotation
+            classification_results = self.classifier.classify(annotation.annotations['original_text'],
+                                                              annotation.timings)
+            return self.apply_classification_results(annotation, classification_results)
         except ClassificationModelError as error:
             raise AnnotatorAnnotateError(error.value)
         except KeyError as error:
             raise AnnotatorAnnotateError(error.value)
 
+    @staticmethod
+    def apply_classification_results(annotation, classification_results):
+        """
+        Updates the Annotation object with the results of IntentClassifier.classify or IntentClassifier.classify_batch
+        :param annotation: Annotation object to be updated
+        :param classification_results: dict of intents, entity_types and stopwords
+        :return: Updated annotation object
+        """
+        annotation.annotations['stopwords'] = classification_results['stopwords']
+        annotation.annotations['entity_types'] = classification_results['entity_types']
+        annotation.annotations['results']['classification'] = classification_results['intents']
+        return annotation
+
 
 class BinaryClassificationAnnotator(AbstractAnnotator):
     def __init__(self, name, classifier):
@@ -135,14 +224,15 @@ class GazetteerAnnotator(AbstractAnnotator):
     def annotate(self, annotation):
         """
         Annotates the annotation object with the search results give the original text and the self.gazetteer gazetteer.
-        Appends the gazetteer result to the annotation.annotations['results']['entities] list
+        Appends the gazetteer result to the annotation.annotations['results']['entities] list, with 'match' set to
+        'exact' or 'fuzzy' depending on how it was found
         :param annotation: The annotation object to update
         :return: Returns the updated annotation object
         """
         stopwords = annotation.annotations['stopwords']
         text = annotation.annotations['original_text']
-        result = self.gazetteer.search_query(text, stopwords, self.max_edit_distance)
-        annotation.annotations['results']['entities'].append({"name": self.name, "value": result})
+        result, match = self.gazetteer.search_query_with_match(text, stopwords, self.max_edit_distance)
+        annotation.annotations['results']['entities'].append({"name": self.name, "value": result, "match": match})
         return annotation
 
 
@@ -230,7 +320,7 @@ class NaiveNumberAnnotator(AbstractAnnotator):
         :param annotation: The annotation object to update
         :return: Returns the updated annotation object
         """
-        result = self.parser.parse(annotation.annotations['original_text'])
+        result = self.parser.parse(annotation.annotations['original_text'], annotation.doc)
         annotation.annotations['results']['entities'].append({"name": self.name, "value": result})
         return annotation
 
@@ -287,7 +377,7 @@ class FuzzyMatcherAnnotator(AbstractAnnotator):
         :return: Returns the updated annotation object
         """
         original_text = annotation.annotations['original_text']
-        results = self.fuzzymatcher.find(original_text, self.search_list)
+        results = self.fuzzymatcher.find(original_text, self.search_list, annotation.doc)
         result = results[0] if len(results) > 0 else None
         annotation.annotations['results']['entities'].append({"name": self.name, "value": result})
         return annotation
\ No newline at end of file
@@ -7,22 +7,30 @@ Created on May 28, 2016
 Functions managing the prototype classifier.
 """
 
+import os
 import string
 import logging
 import pickle
+import threading
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 from abc import abstractmethod, ABCMeta
+from cachetools import LRUCache
 from sklearn import svm, naive_bayes
 from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
 from sklearn.pipeline import Pipeline, FeatureUnion
 from sklearn.calibration import CalibratedClassifierCV
 from sklearn import exceptions
-from models.spacy_model import load_spacy
+from models.spacy_model import load_spacy, get_shared_doc
 from transformers.clean_text_transformer import CleanTextTransformer
-from database.database import IntentsDatabaseEngine, EntitiesDatabaseEngine
+from nlp.clf.compiled import compile_pipeline
+from database.database import EntitiesDatabaseEngine, intent_metadata
 from utils import io
 from utils.string_cleaners import normalize_whitespace
 from utils.exceptions import ClassificationModelError, DatabaseError
+from utils.timing import Timings
 
 # load Spacy pipeline from cached model    
 spacy_nlp = load_spacy('en')
@@ -31,20 +39,81 @@ logger = logging.getLogger('BOLT.clf')
 # List of symbols we don't care about
 SYMBOLS = " ".join(string.punctuation).split(" ") + ["-----", "---", "...", "“", "”", "'ve"]
 
-# Dict referencing pickled classifiers.
+# Registry of live, fitted Scikit-learn pipelines keyed by classifier type and classifier name.
 CLASSIFIERS = {'multiclass': {}, 'binary_classifier': {}}
+# Compiled inference form of the pipelines in CLASSIFIERS, where the pipeline could be compiled and verified.
+COMPILED_CLASSIFIERS = {'multiclass': {}, 'binary_classifier': {}}
+# Serializes writers of CLASSIFIERS. Readers never take the lock.
+classifiers_lock = threading.Lock()
+# Incremented every time classifiers are published to CLASSIFIERS.
+CLASSIFIERS_GENERATION = 0
+
+
+class TokenizationCache:
+    """
+    Bounded, thread safe LRU memo of the tokens produced by ClassificationModelBuilder._tokenize_text, shared by the
+    intent and binary classification pipelines for both training and inference.
+    """
+    def __init__(self, maxsize):
+        """
+        :param maxsize: maximum number of tokenized texts kept in the cache
+        """
+        self.lock = threading.Lock()
+        self.cache = LRUCache(maxsize=maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :param key: tuple of the whitespace normalized text and the lemmatize flag
+        :return: tuple of tokens or None if the key is not cached
+        """
+        with self.lock:
+            tokens = self.cache.get(key)
+            if tokens is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return tokens
+
+    def set(self, key, tokens):
+        with self.lock:
+            self.cache[key] = tokens
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        :return: dict of the hits, misses, hit rate, current size and maximum size of the cache
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "size": len(self.cache), "maxsize": self.cache.maxsize}
+
+
+tokenization_cache = TokenizationCache(int(os.environ.get('TOKENIZE_CACHE_SIZE', 20000)))
+# Number of worker processes fitting binary classifiers. 1 fits them sequentially in the current process.
+training_processes = int(os.environ.get('TRAINING_PROCESSES', 1))
 
 
 class ClassificationModelBuilder:
     """
     Builds classification models stored in the global dict CLASSIFIERS
     """
-    def initialize_classification_models(self, multiclass=False, binary_classifier=False):
+    def initialize_classification_models(self, multiclass=False, binary_classifier=False, processes=None):
         """
-        Saves to the global dict CLASSIFIERS a pickled (serialized) fitted Scikit-learn model
+        Publishes to the global dict CLASSIFIERS freshly fitted Scikit-learn models
         :param skl_classifier: type of classifier used for intent classification (svm, nb)
         :param multiclass: true/false on whether to update multiclass classifiers stored in CLASSIFIERS
         :param multiclass: true/false on whether to update binary classifiers stored in CLASSIFIERS
+        :param processes: number of worker processes fitting the binary classifiers, defaults to TRAINING_PROCESSES
+        :return: dict of the fit time in seconds of each binary classifier
         """
         db = EntitiesDatabaseEngine()
         results = db.get_entities()
@@ -54,8 +123,7 @@ class ClassificationModelBuilder:
             if result[2] == 'binary_classifier':
                 binary_classifier_entities.append(result)
 
-        logger.debug("Updating serialized classifier.")
-        global CLASSIFIERS
+        logger.debug("Updating classifier registry.")
         """ Update globally stored classifier models"""
 
         if multiclass:
@@ -63,22 +131,25 @@ class ClassificationModelBuilder:
             logger.debug("INITIALIZING: all multiclass classifiers.")
             # TODO Work on default classifier algorithm choice. Perhaps remove choice entirely.
             fitted_intent_classification_pipeline = self._train_intent_classification_pipeline(None, None, None)
-            CLASSIFIERS['multiclass']['intent_classifier'] = pickle.dumps(fitted_intent_classification_pipeline)
+            self._publish_classifiers('multiclass', {'intent_classifier': fitted_intent_classification_pipeline})
 
         if binary_classifier:
-            """ Build, train, and save binary classification pipelines """
+            """ Build and train every binary classification pipeline, then publish them together """
             logger.debug("INITIALIZING: all binary classifiers.")
+            training_data = io.create_data_for_binary_classifiers_from_database()
+            jobs = []
             for binary_entity in binary_classifier_entities:
-                logger.debug("Building binary classifier for: {0}".format(binary_entity[1]))
-                pipeline = self._build_binary_classification_pipeline(binary_entity[4])
-                docs, labels = io.create_data_for_binary_classifier_from_database(binary_entity[1])
-                fitted_binary_classification_pipeline = self._train_binary_classification_pipeline(pipeline, docs, labels)
-                CLASSIFIERS['binary_classifier'][binary_entity[1]] = pickle.dumps(fitted_binary_classification_pipeline)
+                docs, labels = training_data.get(binary_entity[1], [[], []])
+                jobs.append((binary_entity[1], binary_entity[4], docs, labels))
+            fitted_binary_pipelines, fit_times = self._train_binary_classification_pipelines(jobs, processes)
+            self._publish_classifiers('binary_classifier', fitted_binary_pipelines)
+            return fit_times
+        return {}
 
     def update_classification_model(self, classifier_type, classifier_name):
         if classifier_type == 'multiclass':
             fitted_intent_classification_pipeline = self._train_intent_classification_pipeline(None, None, None)
-            CLASSIFIERS['multiclass']['intent_classifier'] = pickle.dumps(fitted_intent_classification_pipeline)
+            self._publish_classifiers('multiclass', {'intent_classifier': fitted_intent_classification_pipeline})
 
         if classifier_type == 'binary_classifier':
             db = EntitiesDatabaseEngine()
@@ -87,8 +158,33 @@ class ClassificationModelBuilder:
             pipeline = self._build_binary_classification_pipeline(entity_info[4])
             docs, labels = io.create_data_for_binary_classifier_from_database(classifier_name)
             fitted_binary_classification_pipeline = self._train_binary_classification_pipeline(pipeline, docs, labels)
-            CLASSIFIERS['binary_classifier'][entity_info[1]] = pickle.dumps(
-                        fitted_binary_classification_pipeline)
+            self._publish_classifiers('binary_classifier', {entity_info[1]: fitted_binary_classification_pipeline})
+
+    def _publish_classifiers(self, classifier_type, fitted_pipelines):
+        """
+        Atomically swaps fitted pipelines into the global CLASSIFIERS registry. A copy of the registry for the given
+        classifier type is updated and rebound in a single assignment, so readers either see all of the new pipelines
+        or none of them. Published pipelines are never refit in place; retraining always publishes new objects.
+        Each pipeline is also compiled for direct NumPy inference; pipelines that cannot be compiled or whose compiled
+        probabilities do not match Scikit-learn are served by the pipeline itself.
+        :param classifier_type: multiclass/binary_classifier the type of classifiers being published
+        :param fitted_pipelines: dict of classifier name to fitted Scikit-learn Pipeline object
+        """
+        global CLASSIFIERS, COMPILED_CLASSIFIERS, CLASSIFIERS_GENERATION
+        compiled_pipelines = {}
+        for classifier_name, pipeline in fitted_pipelines.items():
+            compiled = compile_pipeline(pipeline)
+            if compiled is not None:
+                compiled_pipelines[classifier_name] = compiled
+        with classifiers_lock:
+            updated_classifiers = dict(CLASSIFIERS[classifier_type])
+            updated_classifiers.update(fitted_pipelines)
+            updated_compiled = {name: compiled for name, compiled in COMPILED_CLASSIFIERS[classifier_type].items()
+                                if name not in fitted_pipelines}
+            updated_compiled.update(compiled_pipelines)
+            CLASSIFIERS[classifier_type] = updated_classifiers
+            COMPILED_CLASSIFIERS[classifier_type] = updated_compiled
+            CLASSIFIERS_GENERATION += 1
 
     def _train_intent_classification_pipeline(self, pipeline=None, training_data=None, skl_classifier=None):
         """
@@ -115,6 +211,33 @@ class ClassificationModelBuilder:
         except exceptions.FitFailedWarning as error:
             raise ClassificationModelError(repr(error))
 
+    def _train_binary_classification_pipelines(self, jobs, processes=None):
+        """
+        Fits binary classification pipelines sequentially or in a pool of worker processes. Fails as a whole if any
+        classifier fails to fit.
+        :param jobs: list of tuples (entity_name, keywords, docs, labels)
+        :param processes: number of worker processes, defaults to TRAINING_PROCESSES
+        :return: tuple of the dict of entity name to fitted pipeline and the dict of entity name to fit time in seconds
+        """
+        if processes is None:
+            processes = training_processes
+        start = time.perf_counter()
+        if processes > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=min(processes, len(jobs))) as executor:
+                futures = [executor.submit(fit_binary_classification_pipeline, *job) for job in jobs]
+                results = [future.result() for future in futures]
+        else:
+            results = [fit_binary_classification_pipeline(*job) for job in jobs]
+        fitted_pipelines = {}
+        fit_times = {}
+        for entity_name, pipeline, fit_time in results:
+            logger.info("Fitted binary classifier {0} in {1:.2f}s".format(entity_name, fit_time))
+            fitted_pipelines[entity_name] = pipeline
+            fit_times[entity_name] = fit_time
+        logger.info("Fitted {0} binary classifiers in {1:.2f}s using {2} process(es)".format(
+            len(jobs), time.perf_counter() - start, max(processes, 1)))
+        return fitted_pipelines, fit_times
+
     def _train_binary_classification_pipeline(self, pipeline, docs, labels):
         try:
             logger.debug("Training binary classifier")
@@ -184,12 +307,21 @@ class ClassificationModelBuilder:
         """
         Function that tokenizes, lemmatizes, removes potential stopwords/stop-symbols, and cleans whitespace.
         Lemmas may be useful only for intent classification but not other types of functionality (traits like plurality etc,.)
+        Lemmas are memoized in the shared tokenization_cache. Without lemmatization the spaCy tokens are returned, they
+        are not cached since they keep their whole Doc alive.
         :param sample: sample of text to be tokenized
-        :return: returns the tokens of the sample
+        :return: returns the lemmas of the sample, or its spaCy tokens if lemmatize is False
         """
         sample = normalize_whitespace(sample)
-        tokens = spacy_nlp(sample)
-            
+        cache_key = (sample, lemmatize)
+        if lemmatize:
+            cached_tokens = tokenization_cache.get(cache_key)
+            if cached_tokens is not None:
+                return list(cached_tokens)
+        tokens = get_shared_doc(sample)
+        if tokens is None:
+            tokens = spacy_nlp(sample)
+
         # lemmatize
         if lemmatize:
             lemmas = []
@@ -205,34 +337,91 @@ class ClassificationModelBuilder:
         # clean up whitespace and line breaks etc,.
         for tok in tokens:
             normalize_whitespace(tok)
+        if lemmatize:
+            tokenization_cache.set(cache_key, tuple(tokens))
         return tokens
 
 
+def fit_binary_classification_pipeline(entity_name, keywords, docs, labels):
+    """
+    Builds and fits the binary classification pipeline of one entity. Defined at module level so that it can be run
+    in worker processes.
+    :param entity_name: name of the binary_classifier entity
+    :param keywords: keywords of the entity used by the vocabulary vectorizer
+    :param docs: training documents
+    :param labels: 'true'/'false' training labels
+    :return: tuple of (entity_name, fitted pipeline, fit time in seconds)
+    """
+    start = time.perf_counter()
+    logger.debug("Building binary classifier for: {0}".format(entity_name))
+    builder = ClassificationModelBuilder()
+    pipeline = builder._build_binary_classification_pipeline(keywords)
+    pipeline = builder._train_binary_classification_pipeline(pipeline, docs, labels)
+    return entity_name, pipeline, time.perf_counter() - start
+
+
 class ClassificationModelAccessor:
     """
     Class providing methods to access classification models
     """
     def get_classification_pipeline(self, classifier_type, classifier_name):
         """
-        Loads the pickled classifier from the global CLASSIFIERS dict and returns a Classifier object
+        Wraps the live classifier stored in the global CLASSIFIERS dict in a Classifier object. The wrapped pipeline is
+        shared with every other request and must only be used for prediction.
         :param classifier_type: multiclass/binary the type of classifer to access from CLASSIFIERS
         :param classifier_name: name of classifier to access from CLASSIFIERS
-        :return: the Classifier object build from the pickled object from the CLASSIFIERS global dict
+        :return: the Classifier object wrapping the fitted pipeline from the CLASSIFIERS global dict
+        """
+        global CLASSIFIERS, COMPILED_CLASSIFIERS
+        pipeline = CLASSIFIERS.get(classifier_type, {}).get(classifier_name)
+        if pipeline is None:
+            return None
+        compiled = COMPILED_CLASSIFIERS.get(classifier_type, {}).get(classifier_name)
+        if compiled is not None and compiled.pipeline is not pipeline:
+            compiled = None
+        if classifier_name == 'intent_classifier':
+            return IntentClassifier(pipeline, compiled)
+        if classifier_type == 'binary_classifier':
+            return BinaryClassifier(pipeline, compiled)
+
+    def get_generation(self):
+        """
+        Returns a counter that changes whenever classifiers are published to the global CLASSIFIERS dict.
+        :return: int generation
+        """
+        return CLASSIFIERS_GENERATION
+
+    def export_classification_pipeline(self, classifier_type, classifier_name):
+        """
+        Serializes the live classifier stored in the global CLASSIFIERS dict.
+        :param classifier_type: multiclass/binary the type of classifer to access from CLASSIFIERS
+        :param classifier_name: name of classifier to access from CLASSIFIERS
+        :return: pickled bytes of the fitted pipeline or None if the classifier does not exist
         """
         global CLASSIFIERS
-        if classifier_type in CLASSIFIERS.keys() and classifier_name in CLASSIFIERS[classifier_type].keys():
-            pipeline = pickle.loads(CLASSIFIERS[classifier_type][classifier_name])
-            if classifier_name == 'intent_classifier':
-                return IntentClassifier(pipeline)
-            if classifier_type == 'binary_classifier':
-                return BinaryClassifier(pipeline)
-        else:
+        pipeline = CLASSIFIERS.get(classifier_type, {}).get(classifier_name)
+        if pipeline is None:
             return None
+        return pickle.dumps(pipeline)
 
 
 class AbstractClassifier(metaclass=ABCMeta):
-    def __init__(self, pipeline):
+    def __init__(self, pipeline, compiled=None):
+        """
+        :param pipeline: fitted Scikit-learn Pipeline object
+        :param compiled: optional CompiledCalibratedClassifier of the pipeline used in place of it for prediction
+        """
         self.pipeline = pipeline
+        self.compiled = compiled
+
+    def predict_proba(self, documents):
+        """
+        :param documents: list of documents
+        :return: ndarray of class probabilities, using the compiled model when available
+        """
+        if self.compiled is not None:
+            return self.compiled.predict_proba(documents)
+        return self.pipeline.predict_proba(documents)
 
     @abstractmethod
     def classify(self, document):
@@ -243,8 +432,8 @@ class BinaryClassifier(AbstractClassifier):
     """
     Class that implements AbstractClassifier and builds a object that provides binary classification results
     """
-    def __init__(self, pipeline):
-        super().__init__(pipeline)
+    def __init__(self, pipeline, compiled=None):
+        super().__init__(pipeline, compiled)
 
     def classify(self, document):
         """
@@ -254,7 +443,7 @@ class BinaryClassifier(AbstractClassifier):
         """
         try:
             classes = self.pipeline.classes_.tolist()
-            class_probabilities = self.pipeline.predict_proba([document]).tolist()
+            class_probabilities = self.predict_proba([document]).tolist()
             confidence_metrics = list(zip(classes, class_probabilities[0]))
             classification_results = sorted(confidence_metrics, key=lambda tup: tup[1], reverse=True)
             return classification_results
@@ -266,50 +455,67 @@ class IntentClassifier(AbstractClassifier):
     """
     Class that implements  returned from ClassificationBuilder to be used the the analysis and update modules to manage NLP
     """
-    def __init__(self, pipeline):
-        self.db = IntentsDatabaseEngine()
-        super().__init__(pipeline)
+    def __init__(self, pipeline, compiled=None):
+        super().__init__(pipeline, compiled)
 
-    def classify(self, document):
+    def classify(self, document, timings=None):
         """
         Classifies the document and provides additional data based on those classification results
         :param document: document to be classified
+        :param timings: optional Timings object recording the prediction and metadata lookup phases
         :return: Returns of a dict that contains the top3 classification results (which includes their confidences),
                  the entity types and stopwords associated with the top (highest confidence) classification result
         """
+        return self.classify_batch([document], timings)[0]
+
+    def classify_batch(self, documents, timings=None):
+        """
+        Classifies a list of documents with a single vectorized predict_proba call
+        :param documents: list of documents to be classified
+        :param timings: optional Timings object recording the prediction and metadata lookup phases
+        :return: list of classification result dicts (see classify) in the same order as the documents
+        """
+        if timings is None:
+            timings = Timings()
         try:
-            results = {}
-            top_3 = []
-            classes = self.pipeline.classes_.tolist()
-            class_probabilities = self.pipeline.predict_proba([document]).tolist()
-            confidence_metrics = list(zip(classes, class_probabilities[0]))
-            intents_results = sorted(confidence_metrics, key=lambda tup: tup[1], reverse=True)
-            for i in range(3):
-                tup = intents_results[i]
-                top_3.append({"intent": tup[0], "confidence": tup[1]})
-            top_intent_name = intents_results[0][0]
-            stopwords_db_results = self.db.get_intent_stopwords(top_intent_name)
-            intent_stopwords = stopwords_db_results[0][1]
-            intent_entities = self.db.get_intent_entities(top_intent_name)
-            self.db.release_database_connection()
-            entities = []
-            for result in intent_entities:
-                entity = {
-                    "entity_name": result[1],
-                    "entity_type": result[2],
-                    "regular_expressions": result[3],
-                    "keywords": result[4]
-                }
-                entities.append(entity)
-            results['intents'] = top_3
-            results['entity_types'] = entities
-            results['stopwords'] = intent_stopwords
-            return results
+            with timings.measure('intent_prediction'):
+                classes = self.pipeline.classes_.tolist()
+                class_probabilities = self.predict_proba(documents)
+            with timings.measure('intent_metadata'):
+                return [self._build_results(classes, probabilities) for probabilities in class_probabilities]
         except exceptions.NotFittedError as error:
             raise ClassificationModelError(repr(error))
         except DatabaseError as error:
             raise ClassificationModelError(error.value)
 
-
-
-
+    def _build_results(self, classes, probabilities):
+        """
+        Builds the classification results of a single document from its class probabilities
+        :param classes: list of intent names
+        :param probabilities: ndarray of probabilities of the document, aligned with classes
+        :return: dict of the top 3 intents, the entity types and the stopwords of the top intent
+        """
+        results = {}
+        top_3 = []
+        if len(probabilities) > 3:
+            candidates = np.sort(np.argpartition(-probabilities, 2)[:3])
+        else:
+            candidates = np.arange(len(probabilities))
+        ranked = candidates[np.argsort(-probabilities[candidates], kind='mergesort')]
+        for idx in ranked[:3]:
+            top_3.append({"intent": classes[idx], "confidence": float(probabilities[idx])})
+        top_intent_name = top_3[0]['intent']
+        intent_stopwords, intent_entities = intent_metadata.get_intent_metadata(top_intent_name)
+        entities = []
+        for result in intent_entities:
+            entity = {
+                "entity_name": result[1],
+                "entity_type": result[2],
+                "regular_expressions": result[3],
+                "keywords": result[4]
+            }
+            entities.append(entity)
+        results['intents'] = top_3
+        results['entity_types'] = entities
+        results['stopwords'] = intent_stopwords
+        return results
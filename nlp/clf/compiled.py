@@ -0,0 +1,171 @@
+"""
+Compiled inference for fitted Pipelines ending in a sigmoid CalibratedClassifierCV(LinearSVC). The coefficients,
+intercepts and sigmoid parameters of every cross validation fold are stacked into flat NumPy arrays so that a sparse
+feature matrix is scored with one matrix product and a handful of vectorized operations, instead of going through
+the generic predict_proba machinery of every calibrated sub-classifier.
+"""
+import logging
+import numpy as np
+import scipy.sparse as sp
+from scipy.special import expit
+from sklearn.feature_extraction.text import CountVectorizer
+from utils.exceptions import ClassificationModelError
+
+logger = logging.getLogger('BOLT.clf')
+
+# Absolute tolerance allowed between the compiled and the Scikit-learn probabilities.
+PROBABILITY_TOLERANCE = 1e-6
+# Number of synthetic samples used to verify a compiled model against its pipeline.
+VERIFICATION_SAMPLES = 20
+
+
+class CompiledCalibratedClassifier:
+    """
+    Inference-only form of a fitted Pipeline whose final step is a CalibratedClassifierCV wrapping LinearSVC models
+    with sigmoid calibration. Holds a reference to the pipeline it was compiled from.
+    """
+    def __init__(self, pipeline):
+        """
+        :param pipeline: fitted Scikit-learn Pipeline object
+        :raises ClassificationModelError: if the pipeline is not of a supported form
+        """
+        self.pipeline = pipeline
+        self.feature_steps = [step for name, step in pipeline.steps[:-1]]
+        calibrated = pipeline.steps[-1][1]
+        if not hasattr(calibrated, 'calibrated_classifiers_'):
+            raise ClassificationModelError("Final pipeline step is not a fitted CalibratedClassifierCV")
+        self.classes_ = calibrated.classes_
+        self.n_classes = len(self.classes_)
+        self.n_folds = len(calibrated.calibrated_classifiers_)
+
+        """ Stack one row per (fold, positive class) calibrated decision function """
+        coefficients, intercepts, slopes, offsets, folds, columns = [], [], [], [], [], []
+        for fold, calibrated_classifier in enumerate(calibrated.calibrated_classifiers_):
+            estimator = getattr(calibrated_classifier, 'estimator', None)
+            if estimator is None:
+                estimator = calibrated_classifier.base_estimator
+            calibrators = getattr(calibrated_classifier, 'calibrators', None)
+            if calibrators is None:
+                calibrators = calibrated_classifier.calibrators_
+            if not hasattr(estimator, 'coef_') or not hasattr(estimator, 'intercept_'):
+                raise ClassificationModelError("Calibrated estimator is not a linear model")
+            class_indices = np.searchsorted(self.classes_, estimator.classes_)
+            for row, calibrator in enumerate(calibrators):
+                if not hasattr(calibrator, 'a_') or not hasattr(calibrator, 'b_'):
+                    raise ClassificationModelError("Only sigmoid calibration can be compiled")
+                coefficients.append(np.asarray(estimator.coef_[row], dtype=np.float64))
+                intercepts.append(estimator.intercept_[row])
+                slopes.append(calibrator.a_)
+                offsets.append(calibrator.b_)
+                folds.append(fold)
+                """ Binary models only expose the decision function of the positive class """
+                columns.append(1 if self.n_classes == 2 else class_indices[row])
+        self.coef_t = np.ascontiguousarray(np.vstack(coefficients).T)
+        self.intercepts = np.asarray(intercepts, dtype=np.float64)
+        self.slopes = np.asarray(slopes, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.float64)
+        self.folds = np.asarray(folds, dtype=np.intp)
+        self.columns = np.asarray(columns, dtype=np.intp)
+
+        """ Intent pipelines end their feature steps with a CountVectorizer that can be applied directly """
+        self.vocabulary = None
+        last_step = self.feature_steps[-1] if self.feature_steps else None
+        if isinstance(last_step, CountVectorizer) and not last_step.binary:
+            self.vocabulary = last_step.vocabulary_
+            self.analyzer = last_step.build_analyzer()
+
+    def transform(self, documents):
+        """
+        Turns raw documents into the feature matrix expected by the calibrated classifiers.
+        :param documents: list of documents
+        :return: scipy sparse matrix of shape (n_documents, n_features)
+        """
+        if self.vocabulary is None:
+            features = documents
+            for step in self.feature_steps:
+                features = step.transform(features)
+            return features
+        for step in self.feature_steps[:-1]:
+            documents = step.transform(documents)
+        indices = []
+        indptr = [0]
+        values = []
+        for document in documents:
+            counts = {}
+            for term in self.analyzer(document):
+                index = self.vocabulary.get(term)
+                if index is not None:
+                    counts[index] = counts.get(index, 0) + 1
+            indices.extend(counts.keys())
+            values.extend(counts.values())
+            indptr.append(len(indices))
+        return sp.csr_matrix((np.asarray(values, dtype=np.float64), np.asarray(indices, dtype=np.intp), indptr),
+                             shape=(len(documents), self.coef_t.shape[0]))
+
+    def predict_proba_features(self, features):
+        """
+        Scores a feature matrix.
+        :param features: sparse or dense matrix of shape (n_samples, n_features)
+        :return: ndarray of shape (n_samples, n_classes) with the averaged calibrated probabilities
+        """
+        decisions = features.dot(self.coef_t) + self.intercepts
+        calibrated = expit(-(self.slopes * np.asarray(decisions) + self.offsets))
+        probabilities = np.zeros((calibrated.shape[0], self.n_folds, self.n_classes))
+        probabilities[:, self.folds, self.columns] = calibrated
+        if self.n_classes == 2:
+            probabilities[:, :, 0] = 1. - probabilities[:, :, 1]
+        else:
+            denominator = probabilities.sum(axis=2, keepdims=True)
+            probabilities = np.divide(probabilities, denominator,
+                                      out=np.full_like(probabilities, 1. / self.n_classes),
+                                      where=denominator != 0)
+        probabilities[(1.0 < probabilities) & (probabilities <= 1.0 + 1e-5)] = 1.0
+        return probabilities.mean(axis=1)
+
+    def predict_proba(self, documents):
+        """
+        :param documents: list of documents
+        :return: ndarray of shape (n_documents, n_classes) with the calibrated probabilities
+        """
+        return self.predict_proba_features(self.transform(documents))
+
+    def verify(self, documents=None, tolerance=PROBABILITY_TOLERANCE):
+        """
+        Checks the compiled probabilities against the Scikit-learn pipeline on random feature vectors and on
+        documents. If no documents are given they are generated from the vectorizer vocabulary.
+        :param documents: optional list of documents
+        :param tolerance: maximum absolute difference allowed
+        :return: True if every probability is within the tolerance
+        """
+        random_state = np.random.RandomState(0)
+        n_features = self.coef_t.shape[0]
+        features = sp.random(VERIFICATION_SAMPLES, n_features, density=min(1., 10. / max(n_features, 1)),
+                             format='csr', random_state=random_state)
+        expected = self.pipeline.steps[-1][1].predict_proba(features)
+        if not np.allclose(self.predict_proba_features(features), expected, rtol=0, atol=tolerance):
+            return False
+        if documents is None and self.vocabulary is not None:
+            terms = sorted(term for term in self.vocabulary if ' ' not in term)
+            documents = [" ".join(random_state.choice(terms, 5)) for _ in range(VERIFICATION_SAMPLES)] if terms else []
+        if not documents:
+            return True
+        expected = self.pipeline.predict_proba(documents)
+        return bool(np.allclose(self.predict_proba(documents), expected, rtol=0, atol=tolerance))
+
+
+def compile_pipeline(pipeline, documents=None):
+    """
+    Compiles and verifies a fitted pipeline.
+    :param pipeline: fitted Scikit-learn Pipeline object
+    :param documents: optional list of documents used for verification
+    :return: CompiledCalibratedClassifier or None if the pipeline cannot be compiled or does not match Scikit-learn
+    """
+    try:
+        compiled = CompiledCalibratedClassifier(pipeline)
+    except ClassificationModelError as error:
+        logger.warning("Pipeline not compiled: {0}".format(error.value))
+        return None
+    if not compiled.verify(documents):
+        logger.warning("Compiled pipeline does not match Scikit-learn probabilities, using the pipeline.")
+        return None
+    return compiled
@@ -0,0 +1,102 @@
+"""
+Token level Aho-Corasick automaton used by gazetteers to find the dictionary terms that occur verbatim in a query in
+one left to right scan of its tokens. Transitions are stored in a single dict keyed by state * vocabulary size +
+token id, and the failure and output links in flat arrays, to keep the automaton small next to the trie it is built
+alongside.
+"""
+import sys
+from array import array
+from collections import deque
+
+
+class TokenAutomaton:
+    """
+    Aho-Corasick automaton over phrases given as space separated tokens.
+    """
+    def __init__(self, phrases):
+        """
+        :param phrases: iterable of phrase strings, tokens separated by single spaces
+        """
+        token_phrases = [phrase.split(' ') for phrase in phrases]
+        self.vocabulary = {}
+        for tokens in token_phrases:
+            for token in tokens:
+                if token not in self.vocabulary:
+                    self.vocabulary[token] = len(self.vocabulary)
+        self.vocabulary_size = max(len(self.vocabulary), 1)
+
+        """ Build the goto function of the keyword trie, keeping the children of every state for the failure links """
+        self.goto = {}
+        children = [[]]
+        lengths = [0]
+        for tokens in token_phrases:
+            state = 0
+            for token in tokens:
+                transition = state * self.vocabulary_size + self.vocabulary[token]
+                next_state = self.goto.get(transition)
+                if next_state is None:
+                    next_state = len(lengths)
+                    self.goto[transition] = next_state
+                    children[state].append((self.vocabulary[token], next_state))
+                    children.append([])
+                    lengths.append(0)
+                state = next_state
+            lengths[state] = len(tokens)
+
+        """ Breadth first computation of the failure links and of the links to the nearest terminal suffix state """
+        self.lengths = array('i', lengths)
+        self.fail = array('i', [0]) * len(lengths)
+        self.output = array('i', [0]) * len(lengths)
+        queue = deque(next_state for token_id, next_state in children[0])
+        while queue:
+            state = queue.popleft()
+            for token_id, next_state in children[state]:
+                fail_state = self.fail[state]
+                while True:
+                    target = self.goto.get(fail_state * self.vocabulary_size + token_id)
+                    if target is not None or fail_state == 0:
+                        break
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = target if target is not None else 0
+                fallback = self.fail[next_state]
+                self.output[next_state] = fallback if self.lengths[fallback] else self.output[fallback]
+                queue.append(next_state)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def find_all(self, tokens):
+        """
+        Scans the tokens once and returns every phrase occurrence.
+        :param tokens: list of token strings
+        :return: list of (start, end) token spans, end exclusive, in order of their end then decreasing length
+        """
+        matches = []
+        state = 0
+        for position, token in enumerate(tokens):
+            token_id = self.vocabulary.get(token)
+            if token_id is None:
+                state = 0
+                continue
+            while True:
+                next_state = self.goto.get(state * self.vocabulary_size + token_id)
+                if next_state is not None or state == 0:
+                    break
+                state = self.fail[state]
+            state = next_state if next_state is not None else 0
+            match_state = state if self.lengths[state] else self.output[state]
+            while match_state:
+                matches.append((position + 1 - self.lengths[match_state], position + 1))
+                match_state = self.output[match_state]
+        return matches
+
+    def memory_size(self):
+        """
+        :return: approximate size in bytes of the automaton
+        """
+        size = sys.getsizeof(self.goto) + sys.getsizeof(self.vocabulary)
+        """ The transition keys and target states of goto and the token ids of the vocabulary are int objects too """
+        size += sum(sys.getsizeof(transition) + sys.getsizeof(state) for transition, state in self.goto.items())
+        size += sum(sys.getsizeof(token) + sys.getsizeof(token_id) for token, token_id in self.vocabulary.items())
+        return size + sum(memoryview(part).nbytes for part in (self.lengths, self.fail, self.output))
+
@@ -1,7 +1,10 @@
 import pprint
+import threading
 from duckling import Duckling
 loaded_duckling = Duckling(minimum_heap_size='64m', maximum_heap_size='128m')
 loaded_duckling.load()
+# Serializes parses of the single Duckling instance shared by every cached pipeline and annotator thread.
+duckling_lock = threading.Lock()
 
 
 class DucklingFactory:
@@ -18,7 +21,8 @@ class DucklingDatetimeParser:
         self.duckling = duckling_instance
 
     def parse(self, query):
-        results = self.duckling.parse(query, dim_filter="time")
+        with duckling_lock:
+            results = self.duckling.parse(query, dim_filter="time")
         results = list(filter(lambda x: self._latent_filter(x), results))
         values = results[0]['value'] if len(results) > 0 else None
         return values
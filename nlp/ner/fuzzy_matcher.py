@@ -7,10 +7,11 @@ class FuzzyMatcher():
     def __init__(self):
         self.nlp = load_spacy('en')
 
-    def find(self, query, search_list):
+    def find(self, query, search_list, query_doc=None):
 
         final_matches = []
-        query_doc = self.nlp(query)
+        if query_doc is None:
+            query_doc = self.nlp(query)
 
         for token in query_doc:
             match = process.extractOne(token.text, search_list, scorer=fuzz.ratio)
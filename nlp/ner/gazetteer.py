@@ -4,71 +4,743 @@ Created on October 26, 2016
 @author: Carl L. Mueller
 @copyright: Lightning in a Bot, Inc
 """
+import os
+import heapq
+import shutil
 import logging
+import threading
+import time
+from collections import OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor
+from cachetools import LRUCache
 from nltk.corpus import stopwords
 from nltk.stem.porter import PorterStemmer
 from utils.string_cleaners import remove_apostrophe, normalize_whitespace, remove_question_mark, dash_to_single_space, remove_foward_slash, remove_quotations, remove_commas
 from utils.exceptions import DatabaseError, DatabaseInputError, GazetteerModelError, UpdaterError
 from database.database import ExternalDatabaseEngine
-from nlp.ner.trie import GramTrieBuilder, SimpleTrieBuilder, DictionaryBuilder, TrieNode
+from nlp.ner.trie import GramTrieBuilder, SimpleTrieBuilder, DictionaryBuilder, TrieNode, CompactTrie, trie_memory_size, \
+    TERM_FAMILIES, BestFirstWalk
+from nlp.ner.snapshot import write_snapshot, load_snapshot, write_entities, load_entities, SNAPSHOT_EXTENSION, \
+    ENTITIES_EXTENSION
+from nlp.ner.symspell import SymSpellIndex
+from nlp.ner.shards import ShardedEngine, shard_entities
+from nlp.ner.aho_corasick import TokenAutomaton
 
 logger = logging.getLogger('BOLT.gaz')
 
 GAZETTEERS = {}
+# Incremented every time a gazetteer is created or replaced in GAZETTEERS.
+GAZETTEERS_GENERATION = 0
+# GAZETTEERS_GENERATION of the last change of each key, and of the last change of every key at once.
+GAZETTEER_KEY_GENERATIONS = {}
+GAZETTEERS_RESET_GENERATION = 0
+# Search engine of newly built gazetteers: 'trie' (TrieNode), 'compact' (CompactTrie), 'dawg' (minimized CompactTrie)
+# or 'symspell' (SymSpellIndex). Either a single engine or a default followed by per type choices, for example
+# 'compact,product_name:symspell'.
+GAZETTEER_ENGINE = os.environ.get('GAZETTEER_ENGINE', 'compact')
+GAZETTEER_ENGINES = ('trie', 'compact', 'dawg', 'symspell')
+# Directory of the binary gazetteer snapshots written on build and loaded on boot. Snapshots are disabled if unset.
+GAZETTEER_SNAPSHOT_DIR = os.environ.get('GAZETTEER_SNAPSHOT_DIR')
+# Suffix of the snapshot directories of sharded gazetteers, holding one numbered snapshot per shard.
+SHARD_DIR_SUFFIX = '.shards'
+# Build or load the gazetteers of a key on its first use instead of building every key at boot.
+GAZETTEER_LAZY_LOADING = os.environ.get('GAZETTEER_LAZY_LOADING', 'false').lower() == 'true'
+# Bytes of gazetteers kept in memory before the least recently used keys are evicted. 0 disables eviction.
+GAZETTEER_MEMORY_BUDGET = int(os.environ.get('GAZETTEER_MEMORY_BUDGET', 0))
+# Comma separated keys whose gazetteers are never evicted.
+GAZETTEER_PINNED_KEYS = os.environ.get('GAZETTEER_PINNED_KEYS', '')
+GAZETTEER_TYPES = ['product_name', 'product_type', 'vendor']
+# Number of worker processes building gazetteers during a full rebuild. 1 builds them in the current process.
+GAZETTEER_BUILD_PROCESSES = int(os.environ.get('GAZETTEER_BUILD_PROCESSES', 1))
+# An incrementally updated gazetteer is rebuilt once its added and removed terms exceed both the minimum and the
+# ratio of the terms of its search engine.
+OVERLAY_COMPACTION_MIN_TERMS = 1000
+OVERLAY_COMPACTION_RATIO = 0.1
+# Find the multi-token terms spelled exactly as in the dictionary with an Aho-Corasick scan before fuzzy searching.
+GAZETTEER_EXACT_MATCH = os.environ.get('GAZETTEER_EXACT_MATCH', 'true').lower() == 'true'
+# Comma separated term families of product name gazetteers, see nlp.ner.trie.TERM_FAMILIES. Leaving out skipgram
+# families shrinks the gazetteers at the cost of recall on reordered product names.
+GAZETTEER_TERM_FAMILIES = [family for family in os.environ.get('GAZETTEER_TERM_FAMILIES',
+                                                               ','.join(TERM_FAMILIES)).split(',') if family]
+# Frozen set of the NLTK english stopwords and their cleaned forms, loaded once and shared by all gazetteers.
+NLTK_STOPWORDS = None
+NLTK_STOPWORDS_LOCK = threading.Lock()
+
+
+def gazetteer_engine(gazetteer_type, engine_setting=None):
+    """
+    Returns the search engine configured for a gazetteer type.
+    :param gazetteer_type: the type of gazetteer. Example: product_name, product_type, vendor etc,.
+    :param engine_setting: engine setting string, defaults to GAZETTEER_ENGINE
+    :return: engine name
+    """
+    engine = 'compact'
+    for choice in (engine_setting or GAZETTEER_ENGINE).split(','):
+        choice = choice.strip()
+        if ':' in choice:
+            choice_type, choice_engine = choice.split(':', 1)
+            if choice_type.strip() == gazetteer_type:
+                return choice_engine.strip()
+        elif choice:
+            engine = choice
+    return engine
+
+
+def get_nltk_stopwords():
+    """
+    :return: frozenset of the NLTK english stopwords and their cleaned forms
+    """
+    global NLTK_STOPWORDS
+    if NLTK_STOPWORDS is None:
+        with NLTK_STOPWORDS_LOCK:
+            if NLTK_STOPWORDS is None:
+                NLTK_STOPWORDS = frozenset(clean_stopwords(stopwords.words('english')))
+    return NLTK_STOPWORDS
+
+
+def clean_stopwords(word_list):
+    """
+    :param word_list: list of stopwords
+    :return: list of the stopwords followed each by its cleaned form
+    """
+    processed_list = []
+    for word in word_list:
+        processed_list.append(word)
+        processed_list.append(Gazetteer._clean_query(word))
+    return processed_list
+
+
+class StemCache:
+    """
+    Bounded, thread safe LRU memo of the Porter stems of the query words searched by the single word phase of all
+    gazetteers.
+    """
+    def __init__(self, maxsize):
+        """
+        :param maxsize: maximum number of words whose stems are kept in the cache
+        """
+        self.lock = threading.Lock()
+        self.cache = LRUCache(maxsize=maxsize)
+        self.stemmer = PorterStemmer()
+        self.hits = 0
+        self.misses = 0
+
+    def stem(self, word):
+        """
+        :param word: query word
+        :return: Porter stem of the word
+        """
+        with self.lock:
+            stemmed_word = self.cache.get(word)
+            if stemmed_word is not None:
+                self.hits += 1
+                return stemmed_word
+            self.misses += 1
+        stemmed_word = self.stemmer.stem(word)
+        with self.lock:
+            self.cache[word] = stemmed_word
+        return stemmed_word
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        :return: dict of the hits, misses, hit rate, current size and maximum size of the cache
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "size": len(self.cache), "maxsize": self.cache.maxsize}
+
+
+stem_cache = StemCache(int(os.environ.get('GAZETTEER_STEM_CACHE_SIZE', 50000)))
+
+
+class CleanedQuery:
+    """
+    A query cleaned, split and filtered once per search and shared by the query gram and single word phases of
+    Gazetteer.search_query.
+    """
+    def __init__(self, query, custom_stopwords=None):
+        """
+        :param query: query string
+        :param custom_stopwords: Custom stopwords that should be ignored during gazetteer analysis.
+        """
+        custom_stopwords = frozenset(custom_stopwords) if custom_stopwords else frozenset()
+        self.text = Gazetteer._clean_query(query).lower()
+        self.tokens = [w for w in self.text.split(' ') if w.lower() not in custom_stopwords]
+        """ NLTK stopwords are only left out of single word searches when no custom stopwords are given """
+        if custom_stopwords:
+            self.single_words = list(self.tokens)
+        else:
+            nltk_stopwords = get_nltk_stopwords()
+            self.single_words = [w for w in self.tokens if w.lower() not in nltk_stopwords]
+        self._stems = None
+
+    @property
+    def stems(self):
+        """ Distinct memoized Porter stems of the single words, in query order """
+        if self._stems is None:
+            self._stems = list(OrderedDict.fromkeys(stem_cache.stem(word) for word in self.single_words))
+        return self._stems
+
+
+def engine_words(search_engine):
+    """
+    Iterates over the words of a search engine.
+    :param search_engine: TrieNode, CompactTrie, SymSpellIndex or ShardedEngine
+    :return: generator of words
+    """
+    if isinstance(search_engine, ShardedEngine):
+        for shard in search_engine.shards:
+            yield from engine_words(shard)
+    elif isinstance(search_engine, TrieNode):
+        stack = [search_engine]
+        while stack:
+            node = stack.pop()
+            if node.word is not None:
+                yield node.word
+            stack.extend(node.children.values())
+    elif isinstance(search_engine, SymSpellIndex):
+        yield from search_engine.words
+    else:
+        yield from search_engine.words()
+
+
+def bump_gazetteers_generation(key=None):
+    """
+    Increments GAZETTEERS_GENERATION after the gazetteers of a key, or of every key, were created, replaced or removed.
+    :param key: gazetteer key, None if the gazetteers of every key changed
+    """
+    global GAZETTEERS_GENERATION, GAZETTEERS_RESET_GENERATION
+    GAZETTEERS_GENERATION += 1
+    if key is None:
+        GAZETTEERS_RESET_GENERATION = GAZETTEERS_GENERATION
+    else:
+        GAZETTEER_KEY_GENERATIONS[key] = GAZETTEERS_GENERATION
+
+
+def gazetteer_memory_size(search_engine):
+    """
+    :param search_engine: TrieNode, CompactTrie, SymSpellIndex, ShardedEngine or Gazetteer
+    :return: approximate size in bytes of the search engine, and of the exact-match automaton of a Gazetteer
+    """
+    if isinstance(search_engine, Gazetteer):
+        return search_engine.memory_size()
+    if isinstance(search_engine, TrieNode):
+        return trie_memory_size(search_engine)
+    return search_engine.memory_size()
+
+
+class GazetteerCache:
+    """
+    Least recently used bookkeeping of the keys whose gazetteers are held in the global GAZETTEERS dict. Once the
+    gazetteers exceed the byte budget the least recently used unpinned keys are evicted from GAZETTEERS, to be built or
+    loaded again on their next use.
+    """
+    def __init__(self, budget=0, pinned=()):
+        """
+        :param budget: maximum bytes of gazetteers, 0 for no limit
+        :param pinned: keys that are never evicted
+        """
+        self.lock = threading.RLock()
+        """ Serializes the loading of keys, so a key missed by concurrent requests is loaded once """
+        self.load_lock = threading.Lock()
+        self.budget = budget
+        self.pinned = set(pinned)
+        """ key -> {gazetteer type: bytes}, least recently used first """
+        self.keys = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def touch(self, key):
+        """
+        Marks the key as most recently used.
+        :param key: gazetteer key
+        :return: True if the gazetteers of the key are held in memory
+        """
+        with self.lock:
+            if key in self.keys:
+                self.keys.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.keys
+
+    def record(self, gazetteer_type, key, search_engine):
+        """
+        Accounts for a gazetteer published in GAZETTEERS and evicts other keys if the budget is exceeded.
+        :param gazetteer_type: the type of gazetteer
+        :param key: gazetteer key
+        :param search_engine: Gazetteer or search engine of the gazetteer
+        """
+        size = gazetteer_memory_size(search_engine)
+        with self.lock:
+            sizes = self.keys.setdefault(key, {})
+            self.size += size - sizes.get(gazetteer_type, 0)
+            sizes[gazetteer_type] = size
+            self.keys.move_to_end(key)
+            self._enforce_budget(key)
+
+    def resize(self, gazetteer_type, key, size):
+        """
+        Accounts for memory a held gazetteer allocated after it was published, such as its lazily built exact-match
+        automaton. Evicted gazetteers are not accounted for again.
+        :param gazetteer_type: the type of gazetteer
+        :param key: gazetteer key
+        :param size: new size in bytes of the gazetteer
+        """
+        with self.lock:
+            sizes = self.keys.get(key)
+            if sizes is None or gazetteer_type not in sizes:
+                return
+            self.size += size - sizes[gazetteer_type]
+            sizes[gazetteer_type] = size
+            self._enforce_budget(key)
+
+    def record_loaded(self, key):
+        """
+        Marks every gazetteer of the key as loaded, including keys without any gazetteer.
+        :param key: gazetteer key
+        """
+        with self.lock:
+            self.keys.setdefault(key, {})
+            self.keys.move_to_end(key)
+            self.loads += 1
+
+    def pin(self, key):
+        with self.lock:
+            self.pinned.add(key)
+
+    def unpin(self, key):
+        with self.lock:
+            self.pinned.discard(key)
+            self._enforce_budget(None)
+
+    def evict(self, key):
+        """
+        Removes the gazetteers of the key from GAZETTEERS.
+        :param key: gazetteer key
+        :return: True if the key was held in memory
+        """
+        with self.lock:
+            sizes = self.keys.pop(key, None)
+            if sizes is None:
+                return False
+            self.size -= sum(sizes.values())
+            for gazetteers in GAZETTEERS.values():
+                gazetteers.pop(key, None)
+            bump_gazetteers_generation(key)
+            return True
+
+    def _enforce_budget(self, protected_key):
+        """
+        Evicts least recently used unpinned keys, other than the protected key, until the budget is met.
+        """
+        if not self.budget or self.size <= self.budget:
+            return
+        for key in list(self.keys):
+            if self.size <= self.budget:
+                break
+            if key == protected_key or key in self.pinned:
+                continue
+            self.evict(key)
+            self.evictions += 1
+            logger.debug("Evicted gazetteers of key {0}".format(key))
+        if self.size > self.budget:
+            logger.warning("Gazetteers use {0} bytes, above the budget of {1} bytes".format(self.size, self.budget))
+
+    def reset(self, gazetteers):
+        """
+        Replaces the bookkeeping with the gazetteers of a freshly built GAZETTEERS dict. Counters are kept.
+        :param gazetteers: dict {gazetteer type: {key: Gazetteer}}
+        """
+        with self.lock:
+            self.keys.clear()
+            self.size = 0
+            for gazetteer_type, type_gazetteers in gazetteers.items():
+                for key, gazetteer in type_gazetteers.items():
+                    size = gazetteer_memory_size(gazetteer)
+                    self.keys.setdefault(key, {})[gazetteer_type] = size
+                    self.size += size
+            self._enforce_budget(None)
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.loads = 0
+            self.evictions = 0
+
+    def stats(self):
+        """
+        :return: dict of the hits, misses, loads, evictions, held keys, pinned keys, bytes held and byte budget
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "loads": self.loads, "evictions": self.evictions,
+                    "keys": len(self.keys), "pinned": len(self.pinned), "bytes": self.size, "budget": self.budget}
+
+
+gazetteer_cache = GazetteerCache(GAZETTEER_MEMORY_BUDGET,
+                                 [key.strip() for key in GAZETTEER_PINNED_KEYS.split(',') if key.strip()])
 
 
 class GazetteerModelBuilder:
     """
     Class that provides methods to initializing and updating gazetteer models.
     """
-    def initialize_gazetteer_models(self):
+    def initialize_gazetteer_models(self, processes=None):
         """
-        Builds from scratch the entire GAZETTEERS dict
-
+        Builds from scratch the entire GAZETTEERS dict. The entities of every key are streamed from the external
+        database in a single query, the gazetteers are built in a pool of worker processes and the new dict replaces
+        GAZETTEERS at once, so searches never see a partially rebuilt dict.
+        :param processes: number of worker processes building gazetteers, defaults to GAZETTEER_BUILD_PROCESSES
         """
+        global GAZETTEERS
+        if processes is None:
+            processes = GAZETTEER_BUILD_PROCESSES
         try:
             logger.info('Building GAZETTEERS global dict.')
-            global GAZETTEERS
-            gazetteer_types = ['product_name', 'product_type', 'vendor']
+            start = time.perf_counter()
+            new_gazetteers = {}
+            keys = []
             db = ExternalDatabaseEngine()
-            keys = db.get_keys()
-            for key in keys:
-                # Restrict creation of gazetteers by product count.
-                if db.get_product_count_by_key(key) <= 8000:
-                    for gaz_type in gazetteer_types:
-                        self.create_new_gazetteer_model(gaz_type, key)
-            db.release_database_connection()
-            logger.info('Completed building GAZETTEERS global dict.')
+            try:
+                rows = db.iter_entities_by_key()
+                if processes > 1:
+                    with ProcessPoolExecutor(max_workers=processes) as executor:
+                        results = self._build_key_gazetteers_in_pool(executor, rows, processes, keys)
+                        self._add_key_gazetteers(new_gazetteers, results)
+                else:
+                    for key, entities_by_type in rows:
+                        keys.append(key)
+                        self._add_key_gazetteers(new_gazetteers, [
+                            (gaz_type, key, entities, build_gazetteer_search_engines(gaz_type, key, entities))
+                            for gaz_type, entities in entities_by_type.items()])
+            finally:
+                db.release_database_connection()
+            with gazetteer_cache.lock:
+                GAZETTEERS = new_gazetteers
+                bump_gazetteers_generation()
+                gazetteer_cache.reset(new_gazetteers)
+                for key in keys:
+                    gazetteer_cache.record_loaded(key)
+            logger.info('Completed building GAZETTEERS global dict for {0} keys in {1:.2f}s using {2} process(es).'
+                        .format(len(keys), time.perf_counter() - start, max(processes, 1)))
         except DatabaseError as error:
             raise GazetteerModelError(error.value)
 
-    def create_new_gazetteer_model(self, gazetteer_type, key, entity_data=None):
+    def _build_key_gazetteers_in_pool(self, executor, rows, processes, keys):
+        """
+        Submits the gazetteer builds of the streamed rows to the pool, keeping a bounded number of keys in flight so
+        that the entities of every key are not held in memory at once.
+        :param executor: ProcessPoolExecutor
+        :param rows: iterable of (key, {gazetteer type: entities}) from ExternalDatabaseEngine.iter_entities_by_key
+        :param processes: number of worker processes
+        :param keys: list the streamed keys are appended to
+        :return: generator of (gazetteer type, key, entities, list of search engines)
+        """
+        pending = []
+        for key, entities_by_type in rows:
+            keys.append(key)
+            for gaz_type, entities in entities_by_type.items():
+                pending.append((gaz_type, key, entities, executor.submit(build_gazetteer_search_engines, gaz_type,
+                                                                         key, entities)))
+            while len(pending) > 2 * processes * len(GAZETTEER_TYPES):
+                gaz_type, key, entities, future = pending.pop(0)
+                yield gaz_type, key, entities, future.result()
+        for gaz_type, key, entities, future in pending:
+            yield gaz_type, key, entities, future.result()
+
+    def _add_key_gazetteers(self, gazetteers, results):
+        """
+        Adds built gazetteers to a GAZETTEERS shaped dict.
+        :param gazetteers: dict {gazetteer type: {key: Gazetteer}}
+        :param results: iterable of (gazetteer type, key, entities, list of search engines), empty lists are skipped
+        """
+        for gazetteer_type, key, entities, search_engines in results:
+            if search_engines:
+                search_engine = search_engines[0] if len(search_engines) == 1 else ShardedEngine(search_engines)
+                gazetteers.setdefault(gazetteer_type, {})[key] = Gazetteer(
+                    search_engine, [x for x in entities if x is not None], gazetteer_type, key)
+
+    def create_new_gazetteer_model(self, gazetteer_type, key, entity_data=None, engine=None, shard_size=None):
         """
         Creates a single gazetteer in the global dictionary GAZETTEERS
         :param gazetteer_type: the type of gazetteer. Example: product_name, product_type, vendor etc,.
         :param key: the id used to access the specific gazetteer hashed within the dictionary.
         :param entity_data: list of entity strings to use as entiy source.
+        :param engine: 'trie', 'compact', 'dawg' or 'symspell' search engine, defaults to the GAZETTEER_ENGINE choice
+        :param shard_size: maximum number of entities per shard, defaults to GAZETTEER_SHARD_SIZE
         """
         global GAZETTEERS
         if entity_data and isinstance(entity_data, list):
             entities = entity_data
         else:
             entities = self._get_entities_from_external_database(gazetteer_type, key)
-        entities = [x for x in entities if x is not None]
-        if len(entities) > 0:
-            if gazetteer_type == 'product_name':
-                trie_builder = GramTrieBuilder()
-                new_trie = trie_builder.build_trie_from_dictionary(entities)
-            else:
-                trie_builder = SimpleTrieBuilder()
-                new_trie = trie_builder.build_simple_trie_from_dictionary(entities)
-            new_gazetteer = Gazetteer(new_trie)
+        search_engines = self._build_search_engines(gazetteer_type, key, entities, engine, shard_size)
+        if len(search_engines) > 0:
+            search_engine = search_engines[0] if len(search_engines) == 1 else ShardedEngine(search_engines)
+            new_gazetteer = Gazetteer(search_engine, [x for x in entities if x is not None], gazetteer_type, key)
 
             if gazetteer_type not in GAZETTEERS:
                 GAZETTEERS[gazetteer_type] = {}
                 GAZETTEERS[gazetteer_type][key] = new_gazetteer
             else:
                 GAZETTEERS[gazetteer_type][key] = new_gazetteer
+            bump_gazetteers_generation(key)
+            gazetteer_cache.record(gazetteer_type, key, new_gazetteer)
+
+    def _build_search_engines(self, gazetteer_type, key, entities, engine=None, shard_size=None):
+        """
+        Builds the search engines of a gazetteer, one per shard, and writes their snapshots and its entity list.
+        :param gazetteer_type: the type of gazetteer
+        :param key: the gazetteer key
+        :param entities: list of entity strings, None values are ignored
+        :param engine: search engine name, defaults to the GAZETTEER_ENGINE choice
+        :param shard_size: maximum number of entities per shard, defaults to GAZETTEER_SHARD_SIZE
+        :return: list of search engines, empty if there are no entities
+        """
+        entities = [x for x in entities if x is not None]
+        if len(entities) == 0:
+            return []
+        engine = engine or gazetteer_engine(gazetteer_type)
+        if GAZETTEER_SNAPSHOT_DIR:
+            self._write_gazetteer_entities(entities, gazetteer_type, key)
+        shards = shard_entities(entities, shard_size)
+        if len(shards) == 1:
+            new_trie = self._build_trie(gazetteer_type, entities)
+            search_engine = self._build_search_engine(new_trie, engine, gazetteer_type, key)
+            if GAZETTEER_SNAPSHOT_DIR:
+                self._write_gazetteer_snapshot(new_trie, search_engine, gazetteer_type, key)
+            return [search_engine]
+        shard_engines = []
+        staging_name = "{0}{1}.{2}.tmp".format(key, SHARD_DIR_SUFFIX, os.getpid())
+        for shard, shard_data in enumerate(shards):
+            new_trie = self._build_trie(gazetteer_type, shard_data)
+            shard_engines.append(self._build_search_engine(new_trie, engine, gazetteer_type,
+                                                           "{0}[{1}]".format(key, shard)))
+            if GAZETTEER_SNAPSHOT_DIR:
+                self._write_gazetteer_snapshot(new_trie, shard_engines[-1], gazetteer_type,
+                                               os.path.join(staging_name, str(shard)))
+        if GAZETTEER_SNAPSHOT_DIR:
+            self._publish_shard_snapshots(gazetteer_type, key, staging_name)
+        logger.info("Gazetteer {0}/{1}: {2} entities in {3} shards".format(
+            gazetteer_type, key, len(entities), len(shards)))
+        return shard_engines
+
+    def _build_trie(self, gazetteer_type, entities):
+        """
+        Builds the TrieNode trie of a gazetteer type: a gram trie for product names and a simple trie otherwise.
+        :param gazetteer_type: the type of gazetteer
+        :param entities: list of entity strings
+        :return: root TrieNode
+        """
+        if gazetteer_type == 'product_name':
+            return GramTrieBuilder(GAZETTEER_TERM_FAMILIES).build_trie_from_dictionary(entities)
+        return SimpleTrieBuilder().build_simple_trie_from_dictionary(entities)
+
+    def _build_search_engine(self, trie, engine, gazetteer_type, key):
+        """
+        Converts the freshly built TrieNode trie into the search structure of the given engine and logs the memory
+        used by compact tries.
+        :param trie: root TrieNode
+        :param engine: 'trie', 'compact', 'dawg' or 'symspell'
+        :param gazetteer_type: the type of gazetteer, used for logging
+        :param key: the gazetteer key, used for logging
+        :return: TrieNode, CompactTrie or SymSpellIndex
+        """
+        if engine not in GAZETTEER_ENGINES:
+            raise GazetteerModelError("Unknown gazetteer engine: {0}".format(engine))
+        if engine == 'symspell':
+            return SymSpellIndex.from_trie(trie)
+        if engine == 'trie':
+            return trie
+        compact_trie = CompactTrie.from_trie(trie, minimize=engine == 'dawg')
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Gazetteer {0}/{1}: TrieNode {2:.1f}KB, {3} {4:.1f}KB".format(
+                gazetteer_type, key, trie_memory_size(trie) / 1024., engine, compact_trie.memory_size() / 1024.))
+        return compact_trie
+
+    def load_gazetteer_snapshots(self, snapshot_dir=None):
+        """
+        Loads every gazetteer snapshot found in the snapshot directory into the global GAZETTEERS dict. The snapshots
+        are memory mapped, not deserialized.
+        :param snapshot_dir: directory of the snapshots, defaults to GAZETTEER_SNAPSHOT_DIR
+        :return: number of gazetteers loaded
+        """
+        global GAZETTEERS
+        snapshot_dir = snapshot_dir or GAZETTEER_SNAPSHOT_DIR
+        if not snapshot_dir or not os.path.isdir(snapshot_dir):
+            return 0
+        loaded = 0
+        for gazetteer_type in sorted(os.listdir(snapshot_dir)):
+            type_dir = os.path.join(snapshot_dir, gazetteer_type)
+            if not os.path.isdir(type_dir):
+                continue
+            for file_name in sorted(os.listdir(type_dir)):
+                if file_name.endswith(SHARD_DIR_SUFFIX):
+                    key = file_name[:-len(SHARD_DIR_SUFFIX)]
+                elif file_name.endswith(SNAPSHOT_EXTENSION):
+                    key = file_name[:-len(SNAPSHOT_EXTENSION)]
+                else:
+                    continue
+                if self._load_gazetteer_snapshot(snapshot_dir, gazetteer_type, key):
+                    gazetteer_cache.record_loaded(key)
+                    loaded += 1
+        if loaded:
+            bump_gazetteers_generation()
+            logger.info("Loaded {0} gazetteers from snapshots in {1}".format(loaded, snapshot_dir))
+        return loaded
+
+    def _load_gazetteer_snapshot(self, snapshot_dir, gazetteer_type, key):
+        """
+        Loads the snapshot, sharded or not, of a single gazetteer into the global GAZETTEERS dict.
+        :param snapshot_dir: directory of the snapshots
+        :param gazetteer_type: the type of gazetteer
+        :param key: the gazetteer key
+        :return: True if a snapshot was loaded
+        """
+        global GAZETTEERS
+        type_dir = os.path.join(snapshot_dir, gazetteer_type)
+        shard_dir = os.path.join(type_dir, key + SHARD_DIR_SUFFIX)
+        sharded = os.path.isdir(shard_dir)
+        if sharded:
+            shard_files = [name for name in os.listdir(shard_dir) if name.endswith(SNAPSHOT_EXTENSION)]
+            paths = [os.path.join(shard_dir, name) for name in
+                     sorted(shard_files, key=lambda name: int(name[:-len(SNAPSHOT_EXTENSION)]))]
+        elif os.path.isfile(os.path.join(type_dir, key + SNAPSHOT_EXTENSION)):
+            paths = [os.path.join(type_dir, key + SNAPSHOT_EXTENSION)]
+        else:
+            return False
+        try:
+            tries = [load_snapshot(path) for path in paths]
+            entities = load_entities(os.path.join(type_dir, key + ENTITIES_EXTENSION))
+        except (GazetteerModelError, OSError, ValueError) as error:
+            logger.warning("Skipping gazetteer snapshot {0}/{1}: {2}".format(gazetteer_type, key, error))
+            return False
+        if not tries:
+            return False
+        if gazetteer_engine(gazetteer_type) == 'symspell':
+            tries = [SymSpellIndex(list(trie.words())) for trie in tries]
+        search_engine = ShardedEngine(tries) if sharded else tries[0]
+        gazetteer = Gazetteer(search_engine, entities, gazetteer_type, key)
+        GAZETTEERS.setdefault(gazetteer_type, {})[key] = gazetteer
+        gazetteer_cache.record(gazetteer_type, key, gazetteer)
+        return True
+
+    def initialize_missing_gazetteer_models(self):
+        """
+        Builds the gazetteers of the keys in the external database that are not held in memory, such as the keys
+        without a snapshot once the snapshots are loaded.
+        :return: list of keys built
+        """
+        try:
+            db = ExternalDatabaseEngine()
+            try:
+                keys = db.get_keys()
+            finally:
+                db.release_database_connection()
+        except DatabaseError as error:
+            raise GazetteerModelError(error.value)
+        missing = [key for key in keys if key not in gazetteer_cache]
+        for key in missing:
+            self.load_gazetteers_by_key(key)
+        if missing:
+            logger.info("Built gazetteers of {0} keys without a snapshot".format(len(missing)))
+        return missing
+
+    def load_gazetteers_by_key(self, key):
+        """
+        Loads the gazetteers of every type for the key from their snapshots, building from the external database the
+        ones without a snapshot.
+        :param key: the key used to access the specific gazetteer hashed within the dictionary.
+        """
+        with gazetteer_cache.load_lock:
+            if key in gazetteer_cache:
+                return
+            for gazetteer_type in GAZETTEER_TYPES:
+                if GAZETTEER_SNAPSHOT_DIR and \
+                        self._load_gazetteer_snapshot(GAZETTEER_SNAPSHOT_DIR, gazetteer_type, key):
+                    continue
+                self.create_new_gazetteer_model(gazetteer_type, key)
+            gazetteer_cache.record_loaded(key)
+            bump_gazetteers_generation(key)
+            logger.debug("Loaded gazetteers of key {0}".format(key))
+
+    def _write_gazetteer_snapshot(self, trie, search_engine, gazetteer_type, key):
+        """
+        Writes the snapshot of a newly built gazetteer. Failures are logged and do not fail the build.
+        :param trie: root TrieNode the gazetteer was built from
+        :param search_engine: search engine of the gazetteer, written as is if it is a CompactTrie
+        :param gazetteer_type: the type of gazetteer
+        :param key: the gazetteer key
+        """
+        if isinstance(search_engine, CompactTrie):
+            trie = search_engine
+        else:
+            trie = CompactTrie.from_trie(trie)
+        path = os.path.join(GAZETTEER_SNAPSHOT_DIR, gazetteer_type, key + SNAPSHOT_EXTENSION)
+        try:
+            write_snapshot(path, trie)
+        except (GazetteerModelError, OSError) as error:
+            logger.warning("Could not write gazetteer snapshot {0}: {1}".format(path, error))
+            return
+        """ Remove the shard snapshots of a key that is no longer sharded """
+        shard_dir = os.path.join(GAZETTEER_SNAPSHOT_DIR, gazetteer_type, key + SHARD_DIR_SUFFIX)
+        if os.path.isdir(shard_dir):
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+    def _write_gazetteer_entities(self, entities, gazetteer_type, key):
+        """
+        Writes the entity list of a newly built gazetteer next to its snapshots. Failures are logged and do not fail
+        the build; the loaded gazetteer then has no postings and is rebuilt from the database on incremental updates.
+        :param entities: list of entity strings
+        :param gazetteer_type: the type of gazetteer
+        :param key: the gazetteer key
+        """
+        path = os.path.join(GAZETTEER_SNAPSHOT_DIR, gazetteer_type, key + ENTITIES_EXTENSION)
+        try:
+            write_entities(path, entities)
+        except OSError as error:
+            logger.warning("Could not write gazetteer entities {0}: {1}".format(path, error))
+
+    def _publish_shard_snapshots(self, gazetteer_type, key, staging_name):
+        """
+        Replaces the shard snapshot directory of a key with the freshly written staging directory and removes the
+        unsharded snapshot of the key.
+        :param gazetteer_type: the type of gazetteer
+        :param key: the gazetteer key
+        :param staging_name: name of the staging directory holding the new shard snapshots
+        """
+        type_dir = os.path.join(GAZETTEER_SNAPSHOT_DIR, gazetteer_type)
+        staging_dir = os.path.join(type_dir, staging_name)
+        shard_dir = os.path.join(type_dir, key + SHARD_DIR_SUFFIX)
+        old_dir = "{0}.{1}.old".format(shard_dir, os.getpid())
+        try:
+            if os.path.isdir(shard_dir):
+                os.rename(shard_dir, old_dir)
+            os.rename(staging_dir, shard_dir)
+            if os.path.exists(os.path.join(type_dir, key + SNAPSHOT_EXTENSION)):
+                os.remove(os.path.join(type_dir, key + SNAPSHOT_EXTENSION))
+        except OSError as error:
+            logger.warning("Could not publish gazetteer shard snapshots {0}: {1}".format(shard_dir, error))
+        shutil.rmtree(old_dir, ignore_errors=True)
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
     def update_gazetteer_models_by_key(self, key):
         """
@@ -76,8 +748,62 @@ class GazetteerModelBuilder:
         :param key: the key used to access the specific gazetteer hashed within the dictionary.
         """
         global GAZETTEERS
-        for gazetteer_type in GAZETTEERS.keys():
+        for gazetteer_type in sorted(set(GAZETTEER_TYPES) | set(GAZETTEERS.keys())):
             self.create_new_gazetteer_model(gazetteer_type, key)
+        gazetteer_cache.record_loaded(key)
+
+    def update_gazetteer_entries(self, gazetteer_type, key, added=None, removed=None):
+        """
+        Adds and removes entries of a gazetteer in time proportional to the change. Gazetteers loaded from snapshots
+        without an entity list are rebuilt from the external database instead, as are gazetteers whose incremental
+        changes have grown past the compaction threshold.
+        :param gazetteer_type: the type of gazetteer. Example: product_name, product_type, vendor etc,.
+        :param key: the key used to access the specific gazetteer hashed within the dictionary.
+        :param added: list of entity strings to add
+        :param removed: list of entity strings to remove
+        """
+        global GAZETTEERS
+        added = [x for x in (added or []) if x is not None]
+        removed = [x for x in (removed or []) if x is not None]
+        if GAZETTEER_SNAPSHOT_DIR:
+            """ The snapshot no longer matches the gazetteer; the key is rebuilt from the database on its next load """
+            self._remove_gazetteer_snapshot(gazetteer_type, key)
+        with gazetteer_cache.load_lock:
+            gazetteer = GAZETTEERS.get(gazetteer_type, {}).get(key)
+            if gazetteer is None:
+                """ Keys that are not loaded pick up the change when they are loaded """
+                if key in gazetteer_cache and added:
+                    self.create_new_gazetteer_model(gazetteer_type, key, added)
+                return
+            if gazetteer.entities is None:
+                self.create_new_gazetteer_model(gazetteer_type, key)
+                return
+            gazetteer.remove_entries(removed)
+            gazetteer.add_entries(added)
+            if gazetteer.overlay_size() > max(OVERLAY_COMPACTION_MIN_TERMS,
+                                              OVERLAY_COMPACTION_RATIO * gazetteer.base_size()):
+                entities = gazetteer.get_entities()
+                if entities:
+                    self.create_new_gazetteer_model(gazetteer_type, key, entities)
+                else:
+                    with gazetteer_cache.lock:
+                        GAZETTEERS[gazetteer_type].pop(key, None)
+                        bump_gazetteers_generation(key)
+
+    def _remove_gazetteer_snapshot(self, gazetteer_type, key):
+        """
+        Deletes the snapshot, sharded or not, and the entity list of a gazetteer.
+        :param gazetteer_type: the type of gazetteer
+        :param key: the gazetteer key
+        """
+        type_dir = os.path.join(GAZETTEER_SNAPSHOT_DIR, gazetteer_type)
+        try:
+            for extension in (SNAPSHOT_EXTENSION, ENTITIES_EXTENSION):
+                if os.path.exists(os.path.join(type_dir, key + extension)):
+                    os.remove(os.path.join(type_dir, key + extension))
+        except OSError as error:
+            logger.warning("Could not remove gazetteer snapshot {0}/{1}: {2}".format(gazetteer_type, key, error))
+        shutil.rmtree(os.path.join(type_dir, key + SHARD_DIR_SUFFIX), ignore_errors=True)
 
     def _get_entities_from_external_database(self, gazetteer_type, key):
         """
@@ -120,6 +846,18 @@ class GazetteerModelBuilder:
             return False
 
 
+def build_gazetteer_search_engines(gazetteer_type, key, entities):
+    """
+    Builds the search engines of a gazetteer. Module level so that it can run in a worker process; sharded gazetteers
+    are returned as their list of shard engines, which are wrapped in a ShardedEngine by the publishing process.
+    :param gazetteer_type: the type of gazetteer
+    :param key: the gazetteer key
+    :param entities: list of entity strings
+    :return: list of search engines, empty if there are no entities
+    """
+    return GazetteerModelBuilder()._build_search_engines(gazetteer_type, key, entities)
+
+
 class GazetteerModelAccessor:
     """
     Class providing methods to access gazetteer models.
@@ -133,30 +871,226 @@ class GazetteerModelAccessor:
         try:
             global GAZETTEERS
             gazetteers = {}
-            db = ExternalDatabaseEngine()
-            keys = db.get_keys()
-            db.release_database_connection()
-            if key not in keys:
-                return None
-            else:
+            """ Keys held in memory are not checked against the database, only keys to build or load are """
+            if not gazetteer_cache.touch(key):
+                db = ExternalDatabaseEngine()
+                keys = db.get_keys()
+                db.release_database_connection()
+                if key not in keys:
+                    return None
+                GazetteerModelBuilder().load_gazetteers_by_key(key)
+            with gazetteer_cache.lock:
                 for gazetteer in GAZETTEERS:
                     if key in GAZETTEERS[gazetteer].keys():
                         gazetteers[gazetteer] = GAZETTEERS[gazetteer][key]
-                return gazetteers
+            return gazetteers
         except DatabaseError as error:
             raise GazetteerModelError(error.value)
 
+    def touch(self, key):
+        """
+        Marks the gazetteers of the key as recently used without loading them.
+        :param key: The id that will differentiate entity lists in the database
+        :return: True if the gazetteers of the key are held in memory
+        """
+        return gazetteer_cache.touch(key)
+
+    def pin(self, key):
+        """
+        Keeps the gazetteers of the key in memory regardless of the memory budget.
+        :param key: The id that will differentiate entity lists in the database
+        """
+        gazetteer_cache.pin(key)
+
+    def unpin(self, key):
+        gazetteer_cache.unpin(key)
+
+    def get_generation(self, key=None):
+        """
+        Returns a counter that changes whenever a gazetteer is created or replaced in the global GAZETTEERS dict.
+        :param key: only count the changes of the gazetteers of this key, and of every key at once
+        :return: int generation
+        """
+        if key is None:
+            return GAZETTEERS_GENERATION
+        return max(GAZETTEERS_RESET_GENERATION, GAZETTEER_KEY_GENERATIONS.get(key, 0))
+
 
 class Gazetteer:
     """
     Gazetteer class creates objects that contain the search trie, dictionary builder stopwords and stemmer used to
-    search queries.
+    search queries. The trie is the search engine: a TrieNode, a CompactTrie, a SymSpellIndex or a ShardedEngine.
+    Entries added or removed after the search engine was built are kept in an overlay: a small trie of the added terms
+    and the set of the removed terms, both replaced as a whole on every update so that searches never observe a
+    partial update.
     """
-    def __init__(self, trie):
+    def __init__(self, trie, entities=None, gazetteer_type=None, key=None):
+        """
+        :param trie: search engine
+        :param entities: list of the entity strings the search engine was built from, required by incremental updates
+        :param gazetteer_type: the type of gazetteer the terms of the entities are generated for
+        :param key: key the gazetteer is held under in GAZETTEERS, its lazily built indexes are then accounted for in
+                    gazetteer_cache
+        """
         self.trie = trie
+        self.key = key
+        """ 
+        Token count of the longest term and automaton of the multi-token terms, built by walking the terms of the
+        search engine on the first search so that loading a memory-mapped snapshot stays cheap
+        """
+        self.max_term_tokens = None
+        self.exact_matcher = None
+        self.index_lock = threading.Lock()
+        self.entities = Counter(entities) if entities is not None else None
+        self.gazetteer_type = gazetteer_type
         self.dict_builder = DictionaryBuilder()
-        self.nltk_stopwords = stopwords.words('english')
-        self.stemmer = PorterStemmer()
+        self.nltk_stopwords = get_nltk_stopwords()
+        """ Term reference counts and the terms of the search engine, computed on the first incremental update """
+        self.term_counts = None
+        self.base_terms = None
+        self.added_terms = OrderedDict()
+        self.overlay = None
+        self.update_lock = threading.Lock()
+        """ Posting lists of the terms of product name gazetteers, built from the entities on first use """
+        self.postings = None
+
+    def add_entries(self, entries):
+        """
+        Adds entries to the gazetteer. Terms shared with other entries are reference counted.
+        :param entries: list of entity strings
+        """
+        with self.update_lock:
+            term_counts = self._get_term_counts()
+            removed_terms = set(self.overlay[1]) if self.overlay else set()
+            for entry in entries:
+                self.entities[entry] += 1
+                for term in self._entry_terms(entry):
+                    term_counts[term] += 1
+                    if term_counts[term] == 1:
+                        if term in self.base_terms:
+                            removed_terms.discard(term)
+                        else:
+                            self.added_terms[term] = None
+            self._publish_overlay(removed_terms)
+
+    def remove_entries(self, entries):
+        """
+        Removes entries from the gazetteer. A term is only removed once no remaining entry generates it. Entries that
+        are not in the gazetteer are ignored.
+        :param entries: list of entity strings
+        """
+        with self.update_lock:
+            term_counts = self._get_term_counts()
+            removed_terms = set(self.overlay[1]) if self.overlay else set()
+            for entry in entries:
+                if self.entities[entry] <= 0:
+                    continue
+                self.entities[entry] -= 1
+                if self.entities[entry] == 0:
+                    del self.entities[entry]
+                for term in self._entry_terms(entry):
+                    term_counts[term] -= 1
+                    if term_counts[term] == 0:
+                        del term_counts[term]
+                        if term in self.base_terms:
+                            removed_terms.add(term)
+                        else:
+                            self.added_terms.pop(term, None)
+            self._publish_overlay(removed_terms)
+
+    def get_entities(self):
+        """
+        :return: list of the current entity strings, or None if they are unknown
+        """
+        if self.entities is None:
+            return None
+        return list(self.entities.elements())
+
+    def overlay_size(self):
+        """
+        :return: number of terms added or removed since the search engine was built
+        """
+        overlay = self.overlay
+        return len(overlay[2]) + len(overlay[1]) if overlay else 0
+
+    def base_size(self):
+        """
+        :return: number of terms in the search engine
+        """
+        return len(self.base_terms) if self.base_terms is not None else 0
+
+    def memory_size(self):
+        """
+        :return: approximate size in bytes of the search engine and of the exact-match automaton once built
+        """
+        size = gazetteer_memory_size(self.trie)
+        exact_matcher = self.exact_matcher
+        return size + exact_matcher.memory_size() if exact_matcher is not None else size
+
+    def _get_term_index(self):
+        """
+        Walks the terms of the search engine once, on first use. Query grams of more tokens than the longest term can
+        not match any term, which bounds the query gram window, and only terms of at least two tokens are tagged from
+        the query grams, so only those are added to the exact-match automaton.
+        :return: tuple of the token count of the longest term and the automaton, None if exact matching is disabled
+        """
+        if self.max_term_tokens is None:
+            with self.index_lock:
+                if self.max_term_tokens is None:
+                    max_term_tokens = 1
+                    multi_token_terms = []
+                    for word in engine_words(self.trie):
+                        tokens = len(word.split(' '))
+                        if tokens > 1:
+                            multi_token_terms.append(word)
+                            max_term_tokens = max(max_term_tokens, tokens)
+                    self.exact_matcher = TokenAutomaton(multi_token_terms) if GAZETTEER_EXACT_MATCH else None
+                    self.max_term_tokens = max_term_tokens
+                    if self.key is not None and self.exact_matcher is not None:
+                        gazetteer_cache.resize(self.gazetteer_type, self.key, self.memory_size())
+        return self.max_term_tokens, self.exact_matcher
+
+    def get_postings(self):
+        """
+        Maps the terms of product name gazetteers back to the entities they were generated from.
+        :return: nlp.ner.trie.TermPostings of the current entities, or None for other gazetteer types or if the
+                 entities are unknown
+        """
+        postings = self.postings
+        if postings is None and self.gazetteer_type == 'product_name' and self.entities is not None:
+            postings = GramTrieBuilder(GAZETTEER_TERM_FAMILIES).build_postings_from_dictionary(list(self.entities))
+            self.postings = postings
+        return postings
+
+    def _get_term_counts(self):
+        if self.entities is None:
+            raise GazetteerModelError("Gazetteer entities are unknown, it must be rebuilt to be updated.")
+        if self.term_counts is None:
+            self.term_counts = Counter(self._terms(list(self.entities.elements())))
+            self.base_terms = frozenset(self.term_counts)
+        return self.term_counts
+
+    def _terms(self, entries):
+        if self.gazetteer_type == 'product_name':
+            return GramTrieBuilder(GAZETTEER_TERM_FAMILIES).terms_from_dictionary(entries)
+        return SimpleTrieBuilder().terms_from_dictionary(entries)
+
+    def _entry_terms(self, entry):
+        return self._terms([entry])
+
+    def _publish_overlay(self, removed_terms):
+        """
+        Replaces the overlay with a trie and an automaton of the added terms, a frozen set of the removed terms and the
+        token count of the longest added term.
+        """
+        added_trie = TrieNode()
+        for term in self.added_terms:
+            added_trie.insert(term)
+        added_matcher = TokenAutomaton(term for term in self.added_terms if ' ' in term) \
+            if GAZETTEER_EXACT_MATCH else None
+        added_max_tokens = max([len(term.split(' ')) for term in self.added_terms] + [1])
+        self.overlay = (added_trie, frozenset(removed_terms), list(self.added_terms), added_matcher, added_max_tokens)
+        self.postings = None
         
     def search_query(self, query, custom_stopwords=None, max_edit_distance=2):
         """
@@ -166,35 +1100,197 @@ class Gazetteer:
         :param max_edit_distance: Max edit distance used for the Levenshtein Damerau algorithm.
         :return: Returns the matching subsection/ngram of the query that meets the trie search criteria
         """
+        return self.search_query_with_match(query, custom_stopwords, max_edit_distance)[0]
+
+    def search_query_with_match(self, query, custom_stopwords=None, max_edit_distance=2):
+        """
+        Searches the query like search_query and reports whether the tag was matched exactly or by the fuzzy search.
+        Multi-token dictionary terms spelled exactly in the query are found first with one scan of the query tokens.
+        The query grams of as many tokens as the longest of them always yield a tag, so grams of fewer tokens are not
+        searched. The tag is the same as without the scan.
+        :param query: Query on which to run gazetteer analysis
+        :param custom_stopwords: Custom stopwords that should be ignored during gazetteer analysis.
+        :param max_edit_distance: Max edit distance used for the Levenshtein Damerau algorithm.
+        :return: tuple of the tag, or None, and 'exact', 'fuzzy' or None
+        """
         
         """ If a very small string, empty string, or null is passed as the query, return None """ 
         if len(query) < 2 or query is None or query == "":
-            return None
-        if custom_stopwords is None:
-            custom_stopwords = []
+            return None, None
 
         """ Create a list of the query ngrams to be searched in the Trie """
-        query = self._clean_query(query).lower()
-        logger.debug(query)
-        query = [w for w in query.split(' ') if w.lower() not in custom_stopwords]
-        query_grams = self.dict_builder.ngrammer(query, 2, len(query)+1)
-        query_grams = sorted(query_grams, key=lambda word: len(word), reverse=True)
-        logger.debug("Query grams")
-        logger.debug(query_grams)
-        tag = self._get_query_gram_tag(query_grams, max_edit_distance)
+        cleaned_query = CleanedQuery(query, custom_stopwords)
+        logger.debug(cleaned_query.text)
+        query = cleaned_query.tokens
+        exact_spans = self._get_exact_spans(query)
+        minimum = max([end - start for start, end in exact_spans] + [2])
+        tag = self._get_query_gram_tag(self._query_gram_levels(query, minimum), max_edit_distance)
+        if tag is not None and any(tag == ' '.join(query[start:end]) for start, end in exact_spans):
+            return tag, 'exact'
         """ Resort to single word searching if none of the query grams returns a tag """
         if tag is None:
-            tag = self._get_single_word_tag(query, custom_stopwords)
-        return tag
+            tag = self._get_single_word_tag(cleaned_query)
+        return tag, 'fuzzy' if tag is not None else None
+
+    def search_top_k(self, query, k=5, custom_stopwords=None, max_edit_distance=2, max_products=10):
+        """
+        Ranks the terms matching the query grams and the single words of the query, best first. The cost bound of the
+        searches is raised one edit at a time from exact matches up to max_edit_distance and the search stops at the
+        first bound at which k distinct terms are found. Tries are walked best first, so raising the bound resumes
+        the walk instead of searching the trie again.
+        :param query: Query on which to run gazetteer analysis
+        :param k: maximum number of candidates returned
+        :param custom_stopwords: Custom stopwords that should be ignored during gazetteer analysis.
+        :param max_edit_distance: Max edit distance used for the Levenshtein Damerau algorithm.
+        :param max_products: maximum number of canonical products listed per candidate
+        :return: list of dicts of the matched term 'value', its edit 'distance', the [start, end) token 'span' of the
+                 cleaned query it matched, the matched query 'text' and the gazetteer 'type', ranked by distance, then
+                 by decreasing number of tokens, then by position in the query. Candidates of product name gazetteers
+                 whose entities are known also list the canonical 'products' the term was generated from.
+        """
+        if query is None or len(query) < 2 or k < 1:
+            return []
+        cleaned_query = CleanedQuery(query, custom_stopwords)
+        tokens = cleaned_query.tokens
+        gram_spans = [(start, start + n) for n in range(min(self._query_gram_window(), len(tokens)), 1, -1)
+                      for start in range(len(tokens) - n + 1)]
+        grams = [' '.join(tokens[start:end]) for start, end in gram_spans]
+        """ Single words are searched by their stems within one edit, as in search_query """
+        single_words = set(cleaned_query.single_words)
+        word_spans = [(position, position + 1) for position, word in enumerate(tokens) if word in single_words]
+        stems = [stem_cache.stem(tokens[start]) for start, end in word_spans]
+        search_grams = self._bounded_search(grams, max_edit_distance)
+        search_stems = self._bounded_search(stems, min(max_edit_distance, 1))
+        candidates = {}
+        for bound in range(max_edit_distance + 1):
+            gram_results = search_grams(bound) if grams else []
+            for (start, end), results in zip(gram_spans, gram_results):
+                for value, distance in results:
+                    if len(value.split(' ')) >= end - start:
+                        self._rank_candidate(candidates, value, distance, start, end)
+            if bound <= 1 and stems:
+                for (start, end), results in zip(word_spans, search_stems(bound)):
+                    for value, distance in results:
+                        self._rank_candidate(candidates, value, distance, start, end)
+            """ Every term within the bound is found, so the k best are final once there are k candidates """
+            ranked = self._select_candidates(candidates, k)
+            if len(ranked) >= k:
+                break
+        postings = self.get_postings()
+        results = []
+        for distance, tokens_count, start, end, value in ranked:
+            result = {"value": value, "distance": distance, "span": [start, end], "text": ' '.join(tokens[start:end]),
+                      "type": self.gazetteer_type}
+            if postings is not None:
+                result['products'] = postings.products_for(value)[:max_products]
+            results.append(result)
+        return results
+
+    def _rank_candidate(self, candidates, value, distance, start, end):
+        """
+        Keeps the best ranking of a term matched by several query grams or words.
+        :param candidates: dict of the term to its (distance, negated token count, start, end, term) ranking
+        """
+        rank = (distance, -len(value.split(' ')), start, end, value)
+        if value not in candidates or rank < candidates[value]:
+            candidates[value] = rank
+
+    def _select_candidates(self, candidates, k):
+        """
+        Pops the best ranked candidates off a priority queue, leaving out the sub-grams of a better candidate matched
+        within its span, so that the candidates are distinct terms rather than pieces of the same one.
+        :param candidates: dict of the term to its (distance, negated token count, start, end, term) ranking
+        :param k: maximum number of candidates
+        :return: list of at most k rankings, best first
+        """
+        queue = list(candidates.values())
+        heapq.heapify(queue)
+        selected = []
+        while queue and len(selected) < k:
+            rank = heapq.heappop(queue)
+            distance, tokens_count, start, end, value = rank
+            if not any(best[2] <= start and end <= best[3] and ' {} '.format(value) in ' {} '.format(best[4])
+                       for best in selected):
+                selected.append(rank)
+        return selected
+
+    def _query_gram_window(self):
+        """
+        :return: token count of the longest term of the search engine and of the added terms
+        """
+        max_term_tokens = self._get_term_index()[0]
+        overlay = self.overlay
+        return max(max_term_tokens, overlay[4]) if overlay is not None else max_term_tokens
+
+    def _query_gram_levels(self, query, minimum=2):
+        """
+        Lazily generates the query grams one token count at a time, from the longest term of the gazetteer down to the
+        minimum, so that at most the window size times the query length grams are generated.
+        :param query: list of query tokens
+        :param minimum: token count of the shortest query grams
+        :return: generator of (token count, list of query grams sorted by decreasing length)
+        """
+        window = self._query_gram_window()
+        for n in range(min(window, len(query)), minimum - 1, -1):
+            query_grams = self.dict_builder.ngrammer(query, n, n + 1)
+            if query_grams:
+                yield n, sorted(query_grams, key=lambda word: len(word), reverse=True)
+
+    def _get_exact_spans(self, query):
+        """
+        Finds the multi-token dictionary terms spelled exactly in the query.
+        :param query: list of query tokens
+        :return: list of (start, end) token spans
+        """
+        exact_matcher = self._get_term_index()[1]
+        if exact_matcher is None:
+            return []
+        overlay = self.overlay
+        matches = exact_matcher.find_all(query)
+        if overlay is None:
+            return matches
+        removed_terms = overlay[1]
+        matches.extend(overlay[3].find_all(query))
+        return [(start, end) for start, end in matches if ' '.join(query[start:end]) not in removed_terms]
     
-    def _get_query_gram_tag(self, query_grams, max_edit_distance):
+    def _get_query_gram_tag(self, query_gram_levels, max_edit_distance):
         """
         Generate potential tags based on query grams searched against trie
-        :param query_grams: set up token n-grams created from the query
+        :param query_gram_levels: iterable of (token count, token n-grams created from the query), by decreasing token
+                                  count
         :param max_edit_distance: Max edit distance used for the Levenshtein Damerau algorithm.
         :return: Found tags, if any
         """
         tags = []
+        query_gram_levels = list(query_gram_levels)
+        logger.debug("Query grams")
+        logger.debug(query_gram_levels)
+        """ Search every query gram of the window in a single walk of the trie """
+        query_gram_results = self._search_multiple([gram for n, grams in query_gram_levels for gram in grams],
+                                                   max_edit_distance)
+        offset = 0
+        for n, query_grams in query_gram_levels:
+            """ 
+            A tag found from grams of n tokens has at least n tokens, so grams of fewer tokens would not be selected
+            """
+            if tags:
+                break
+            self._add_query_gram_tags(tags, query_grams, query_gram_results[offset:offset + len(query_grams)])
+            offset += len(query_grams)
+        """ sort and filter tags based on max ngram length """  
+        tags = sorted(tags, key=lambda tag: len(tag[0].split()), reverse=True)
+        if len(tags) != 0:
+            return tags[0][0]
+        else:
+            return None
+
+    def _add_query_gram_tags(self, tags, query_grams, query_gram_results):
+        """
+        Appends to tags the best result of every query gram not shorter than the query gram
+        :param tags: list of (tag, edit distance) tuples
+        :param query_grams: token n-grams created from the query
+        :param query_gram_results: search results aligned with query_grams
+        """
         for idx, target in enumerate(query_grams):
             """ 
             Do not search nor add to tags if the test query gram has less tokens than any tag existing in the tags list.
@@ -203,34 +1299,23 @@ class Gazetteer:
             """
             if len(tags) == 0 or not any(len(tag[0].split(' ')) > len(target.split(' ')) for tag in tags):
                 target_length = len(target.split(' '))
-                results = TrieNode.search(self.trie, target, max_edit_distance)
+                results = query_gram_results[idx]
                 if len(results) > 0:
                     """ Sort results by edit distance """
                     results = sorted(results, key=lambda result: result[1])
                     """ Append first result with best edit distance to tags list but not if length is shorter than target"""
                     if len(results[0][0].split(' ')) >= target_length :
                         tags.append((results[0][0], results[0][1]))
-        """ sort and filter tags based on max ngram length """  
-        tags = sorted(tags, key=lambda tag: len(tag[0].split()), reverse=True)
-        if len(tags) != 0:
-            return tags[0][0]
-        else:
-            return None
         
-    def _get_single_word_tag(self, query, custom_stopwords):
+    def _get_single_word_tag(self, cleaned_query):
         """
         Generate tags based on single word matches against trie
-        :param query: The query in which to find single word matches
-        :param custom_stopwords: Custom stopwords that should be ignored during gazetteer analysis.
+        :param cleaned_query: CleanedQuery in which to find single word matches
         :return: Found tags, if any
         """
         potential_single_words = set()
-        custom_stopwords = self._clean_stopwords(custom_stopwords)
-        nltk_stopwords = self._clean_stopwords(self.nltk_stopwords)
-        query = [x for x in query if x.lower() not in nltk_stopwords or custom_stopwords]
-        for word in query:
-            stemmed_word = self.stemmer.stem(word)
-            results = TrieNode.search(self.trie, stemmed_word, 1)
+        for stemmed_word in cleaned_query.stems:
+            results = self._search(stemmed_word, 1)
             if len(results) > 0:
                 for result in results:
                     potential_single_words.add(result)
@@ -240,15 +1325,77 @@ class Gazetteer:
         else:
             return None
 
-    def _clean_stopwords(self, word_list):
-        processed_list = []
-        for word in word_list:
-            processed_list.append(word)
-            cleaned_word = self._clean_query(word)
-            processed_list.append(cleaned_word)
-        return processed_list
+    def _search(self, word, max_edit_distance):
+        """
+        Searches the trie with the Levenshtein distance, whichever structure backs it
+        :param word: string to search
+        :param max_edit_distance: max edit distance
+        :return: list of tuples containing word and edit distance
+        """
+        overlay = self.overlay
+        if isinstance(self.trie, TrieNode):
+            results = TrieNode.search(self.trie, word, max_edit_distance)
+        else:
+            results = self.trie.search(word, max_edit_distance)
+        if overlay is None:
+            return results
+        return self._apply_overlay(overlay, results, TrieNode.search(overlay[0], word, max_edit_distance))
+
+    def _search_multiple(self, words, max_edit_distance):
+        """
+        Searches several words in a single walk of the trie, whichever structure backs it
+        :param words: list of strings to search
+        :param max_edit_distance: max edit distance
+        :return: list of lists of tuples containing word and edit distance, aligned with words
+        """
+        overlay = self.overlay
+        if isinstance(self.trie, TrieNode):
+            results = TrieNode.search_multiple(self.trie, words, max_edit_distance)
+        else:
+            results = self.trie.search_multiple(words, max_edit_distance)
+        if overlay is None:
+            return results
+        added_results = TrieNode.search_multiple(overlay[0], words, max_edit_distance)
+        return [self._apply_overlay(overlay, word_results, word_added_results)
+                for word_results, word_added_results in zip(results, added_results)]
+
+    def _bounded_search(self, words, max_edit_distance):
+        """
+        Prepares a search of several words whose bound is raised from 0 up to max_edit_distance. Tries are walked best
+        first and each bound resumes the walk of the previous one; other search engines are searched again at every
+        bound.
+        :param words: list of strings to search
+        :param max_edit_distance: highest bound searched
+        :return: function of the bound returning the results of _search_multiple at that bound
+        """
+        overlay = self.overlay
+        trie = self.trie
+        if not words or not isinstance(trie, (TrieNode, CompactTrie)):
+            return lambda bound: self._search_multiple(words, bound)
+        walk = BestFirstWalk(trie, words, max_edit_distance)
+        if overlay is None:
+            return walk.search
+        added_walk = BestFirstWalk(overlay[0], words, max_edit_distance)
+        return lambda bound: [self._apply_overlay(overlay, word_results, word_added_results) for
+                              word_results, word_added_results in zip(walk.search(bound), added_walk.search(bound))]
+
+    def _apply_overlay(self, overlay, results, added_results):
+        """
+        Drops the removed terms from the search engine results and appends the results of the added terms.
+        :param overlay: tuple of (added terms trie, removed terms, added terms)
+        :param results: list of tuples containing word and edit distance from the search engine
+        :param added_results: list of tuples containing word and edit distance from the added terms trie
+        :return: list of tuples containing word and edit distance
+        """
+        removed_terms = overlay[1]
+        results = [result for result in results if result[0] not in removed_terms]
+        if added_results:
+            found = set(result[0] for result in results)
+            results.extend(result for result in added_results if result[0] not in found)
+        return results
 
-    def _clean_query(self, query):
+    @staticmethod
+    def _clean_query(query):
         """
         Cleans the query based on a set up string cleaning functions
         :param query: query string to be cleaned
@@ -46,8 +46,15 @@ class NumberExtractor:
     def __init__(self):
         self.nlp = load_spacy('en')
 
-    def parse(self, doc):
-        parsed_doc = self.nlp(doc)
+    def parse(self, doc, parsed_doc=None):
+        """
+        Extracts the number contained in the text
+        :param doc: text to be parsed
+        :param parsed_doc: spaCy Doc of the text, if already parsed
+        :return: the extracted number or None
+        """
+        if parsed_doc is None:
+            parsed_doc = self.nlp(doc)
         numeric_tokens = []
         for token in parsed_doc:
             if token.ent_type_ == 'CARDINAL' or token.ent_type_ == 'MONEY':
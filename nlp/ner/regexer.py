@@ -4,6 +4,7 @@ import re
 class Regexer:
     def __init__(self, regex_list):
         self.regex_list = regex_list
+        self.compiled_regex_list = [re.compile(pattern) for pattern in regex_list] if regex_list is not None else None
 
     def get_matches(self, query):
         """
@@ -11,9 +12,8 @@ class Regexer:
         :param query: query to be searched
         :return: the first match that occurs else None
         """
-        if self.regex_list is not None:
-            for pattern in self.regex_list:
-                regex = re.compile(pattern)
+        if self.compiled_regex_list is not None:
+            for regex in self.compiled_regex_list:
                 result = regex.search(query)
                 if result is not None:
                     match = result.group(0)
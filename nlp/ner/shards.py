@@ -0,0 +1,195 @@
+"""
+Sharded gazetteer search engine for large catalogs. The entities of a gazetteer are split by a stable hash into
+shards of bounded size, each with its own search engine. A search fans out to every shard and the results are merged
+by edit distance, then by n-gram length.
+With GAZETTEER_SHARD_PROCESSES above 1 the shards are searched in a pool of forked worker processes. The workers
+inherit the registered shards when they are forked, so shards are never pickled. Forking is only safe at boot, before
+the process starts threads or the Duckling JVM: a child forked from a threaded process can inherit locks held by other
+threads. The pool is therefore forked once by start_shard_pool, right after the gazetteers are loaded at boot, and
+never again. Shards registered after the fork, by incremental updates and lazy loads, are searched in the current
+process.
+"""
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import weakref
+import zlib
+from nlp.ner.trie import TrieNode
+
+logger = logging.getLogger('BOLT.gaz')
+
+# Maximum number of entities per gazetteer shard. Gazetteers with more entities are sharded, 0 disables sharding.
+GAZETTEER_SHARD_SIZE = int(os.environ.get('GAZETTEER_SHARD_SIZE', 8000))
+# Number of worker processes searching shards. 1 searches the shards sequentially in the current process.
+GAZETTEER_SHARD_PROCESSES = int(os.environ.get('GAZETTEER_SHARD_PROCESSES', 1))
+
+""" Shard engines by shard id, inherited by the forked workers """
+_SHARDS = {}
+_shard_ids = iter(range(1, 2 ** 62))
+_last_shard_id = 0
+_shard_pool = None
+""" Last shard id registered when the pool was forked, the workers know every shard up to it """
+_shard_pool_last_id = 0
+_shard_lock = threading.Lock()
+
+
+def shard_entities(entities, shard_size=None):
+    """
+    Splits entities into shards by a stable hash of their lower cased text, so an entity always lands in the same shard.
+    :param entities: list of entity strings
+    :param shard_size: maximum average number of entities per shard, defaults to GAZETTEER_SHARD_SIZE
+    :return: list of lists of entities, a single list if no sharding is needed
+    """
+    if shard_size is None:
+        shard_size = GAZETTEER_SHARD_SIZE
+    if shard_size <= 0 or len(entities) <= shard_size:
+        return [entities]
+    shard_count = int(math.ceil(len(entities) / float(shard_size)))
+    shards = [[] for _ in range(shard_count)]
+    for entity in entities:
+        shards[zlib.crc32(entity.lower().encode('utf-8')) % shard_count].append(entity)
+    return [shard for shard in shards if shard]
+
+
+def merge_results(shard_results):
+    """
+    Merges the results of one word searched in every shard. Duplicate words keep their lowest distance and the results
+    are ordered by edit distance, then by decreasing number of tokens, then by shard and shard order.
+    :param shard_results: list of lists of tuples containing word and edit distance, one list per shard
+    :return: list of tuples containing word and edit distance
+    """
+    distances = {}
+    order = []
+    for results in shard_results:
+        for word, distance in results:
+            if word not in distances:
+                order.append(word)
+                distances[word] = distance
+            elif distance < distances[word]:
+                distances[word] = distance
+    return sorted(((word, distances[word]) for word in order),
+                  key=lambda result: (result[1], -len(result[0].split(' '))))
+
+
+def _search_multiple(shard, words, max_cost):
+    if isinstance(shard, TrieNode):
+        return TrieNode.search_multiple(shard, words, max_cost)
+    return shard.search_multiple(words, max_cost)
+
+
+def _search_shard(shard_id, words, max_cost):
+    """
+    Searches a registered shard. Runs in the worker processes.
+    :return: list of lists of tuples containing word and edit distance, None if the shard was registered after the
+             worker was forked
+    """
+    shard = _SHARDS.get(shard_id)
+    if shard is None:
+        return None
+    return _search_multiple(shard, words, max_cost)
+
+
+def _unregister_shards(shard_ids):
+    for shard_id in shard_ids:
+        _SHARDS.pop(shard_id, None)
+
+
+def start_shard_pool(processes=None):
+    """
+    Forks the worker pool if it is not running. Called once at boot, after the gazetteers are loaded and before the
+    process starts threads or the Duckling JVM; the pool is never forked while requests are served.
+    :param processes: number of worker processes, defaults to GAZETTEER_SHARD_PROCESSES
+    :return: multiprocessing Pool, None if a single process is configured or forking is not available
+    """
+    global _shard_pool, _shard_pool_last_id
+    processes = GAZETTEER_SHARD_PROCESSES if processes is None else processes
+    if processes <= 1:
+        return None
+    with _shard_lock:
+        if _shard_pool is not None:
+            return _shard_pool
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            logger.warning("Forked shard workers are not available, searching shards sequentially.")
+            return None
+        if threading.active_count() > 1:
+            logger.warning("Forking shard workers from a process running {0} threads".format(
+                threading.active_count()))
+        """ A Pool forks all of its workers at once, unlike ProcessPoolExecutor which forks them on demand """
+        _shard_pool = context.Pool(processes)
+        _shard_pool_last_id = _last_shard_id
+        return _shard_pool
+
+
+def stop_shard_pool():
+    """
+    Terminates the worker pool, if any, and waits for its workers to exit.
+    """
+    global _shard_pool
+    with _shard_lock:
+        pool = _shard_pool
+        _shard_pool = None
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
+
+class ShardedEngine:
+    """
+    Gazetteer engine searching a list of shard engines as one.
+    """
+    def __init__(self, shards, processes=None):
+        """
+        :param shards: list of TrieNode, CompactTrie or SymSpellIndex, one per shard
+        :param processes: number of worker processes searching the shards, defaults to GAZETTEER_SHARD_PROCESSES
+        """
+        self.shards = shards
+        self.processes = GAZETTEER_SHARD_PROCESSES if processes is None else processes
+        global _last_shard_id
+        with _shard_lock:
+            self.shard_ids = [next(_shard_ids) for _ in shards]
+            for shard_id, shard in zip(self.shard_ids, shards):
+                _SHARDS[shard_id] = shard
+            _last_shard_id = self.shard_ids[-1] if self.shard_ids else _last_shard_id
+        weakref.finalize(self, _unregister_shards, list(self.shard_ids))
+
+    def search(self, word, max_cost):
+        """
+        :param word: string to search
+        :param max_cost: max edit distance allowed
+        :return: returns a list of tuples containing word and edit distance
+        """
+        return self.search_multiple([word], max_cost)[0]
+
+    def search_multiple(self, words, max_cost):
+        """
+        Searches the words in every shard, in parallel if worker processes are configured. Shards registered after the
+        workers were forked are searched in the current process while the workers search the others.
+        :param words: list of strings to search
+        :param max_cost: max edit distance allowed for every word
+        :return: list of lists of tuples containing word and edit distance, aligned with words
+        """
+        pool = _shard_pool if self.processes > 1 and len(self.shards) > 1 else None
+        if pool is not None:
+            last_id = _shard_pool_last_id
+            futures = [pool.apply_async(_search_shard, (shard_id, words, max_cost)) if shard_id <= last_id else None
+                       for shard_id in self.shard_ids]
+            local_results = {idx: _search_multiple(shard, words, max_cost)
+                             for idx, (shard, future) in enumerate(zip(self.shards, futures)) if future is None}
+            shard_results = [local_results[idx] if future is None else future.get()
+                             for idx, future in enumerate(futures)]
+            """ Shards unregistered before the fork are unknown to the workers too """
+            shard_results = [_search_multiple(shard, words, max_cost) if results is None else results
+                             for shard, results in zip(self.shards, shard_results)]
+        else:
+            shard_results = [_search_multiple(shard, words, max_cost) for shard in self.shards]
+        return [merge_results([results[idx] for results in shard_results]) for idx in range(len(words))]
+
+    def memory_size(self):
+        """
+        :return: approximate memory used by the shards in bytes, if they report it
+        """
+        return sum(shard.memory_size() for shard in self.shards if hasattr(shard, 'memory_size'))
@@ -0,0 +1,152 @@
+"""
+Versioned binary snapshots of CompactTrie gazetteers. A snapshot is a fixed header followed by the raw CompactTrie
+arrays, each aligned to 8 bytes, so that loading only memory maps the file and casts memoryviews over it. Worker
+processes loading the same snapshot share its pages through the OS page cache. The entity list a gazetteer was built
+from is written next to its snapshot as JSON, so that loaded gazetteers keep their product postings and incremental
+updates.
+
+Layout (little-endian):
+    header: magic (8s), version (I), node count (I), edge count (I), root (I), label width in bytes (B), padding
+    first_edge: int32[node count + 1]
+    edge_targets: int32[edge count]
+    word_counts: int32[node count]
+    min_suffix: int32[node count]
+    max_suffix: int32[node count]
+    edge_labels: uint8 or uint32[edge count]
+    terminal: uint8[node count]
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from nlp.ner.trie import CompactTrie
+from utils.exceptions import GazetteerModelError
+
+SNAPSHOT_MAGIC = b'BOLTGAZ\x00'
+SNAPSHOT_VERSION = 2
+ENTITIES_EXTENSION = '.entities.json'
+SNAPSHOT_EXTENSION = '.gaz'
+HEADER = struct.Struct('<8sIIIIB7x')
+ALIGNMENT = 8
+
+
+def _padding(offset):
+    return -offset % ALIGNMENT
+
+
+def _sections(trie):
+    """
+    :return: list of (typecode, array) in file order, converted to fixed width arrays
+    """
+    label_typecode = 'B' if memoryview(trie.edge_labels).itemsize == 1 else 'I'
+    return [('i', array('i', trie.first_edge)),
+            ('i', array('i', trie.edge_targets)),
+            ('i', array('i', trie.word_counts)),
+            ('i', array('i', trie.min_suffix)),
+            ('i', array('i', trie.max_suffix)),
+            (label_typecode, array(label_typecode, trie.edge_labels)),
+            ('B', array('B', trie.terminal))]
+
+
+def write_snapshot(path, trie):
+    """
+    Atomically writes the snapshot of a CompactTrie. The file is written next to its destination and renamed, so
+    processes never map a partially written snapshot.
+    :param path: destination file path
+    :param trie: CompactTrie
+    """
+    if sys.byteorder != 'little':
+        raise GazetteerModelError("Gazetteer snapshots require a little-endian platform")
+    sections = _sections(trie)
+    for typecode, section in sections:
+        if section.itemsize not in (1, 4):
+            raise GazetteerModelError("Unsupported array item size for typecode {0}".format(typecode))
+    label_width = sections[5][1].itemsize
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(temporary_path, 'wb') as file_:
+        file_.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(trie.terminal), len(trie.edge_targets),
+                                trie.root, label_width))
+        offset = HEADER.size
+        for typecode, section in sections:
+            data = section.tobytes()
+            file_.write(data)
+            offset += len(data)
+            file_.write(b'\x00' * _padding(offset))
+            offset += _padding(offset)
+    os.replace(temporary_path, path)
+
+
+def load_snapshot(path):
+    """
+    Memory maps a snapshot and returns a CompactTrie searching it in place.
+    :param path: snapshot file path
+    :return: CompactTrie backed by the mapped file
+    :raises GazetteerModelError: if the file is not a snapshot of a supported version
+    """
+    if sys.byteorder != 'little':
+        raise GazetteerModelError("Gazetteer snapshots require a little-endian platform")
+    with open(path, 'rb') as file_:
+        try:
+            buffer = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise GazetteerModelError("Empty gazetteer snapshot: {0}".format(path))
+    if len(buffer) < HEADER.size:
+        raise GazetteerModelError("Truncated gazetteer snapshot: {0}".format(path))
+    magic, version, node_count, edge_count, root, label_width = HEADER.unpack_from(buffer, 0)
+    if magic != SNAPSHOT_MAGIC:
+        raise GazetteerModelError("Not a gazetteer snapshot: {0}".format(path))
+    if version != SNAPSHOT_VERSION:
+        raise GazetteerModelError("Unsupported gazetteer snapshot version {0}: {1}".format(version, path))
+    view = memoryview(buffer)
+    offset = HEADER.size
+    sections = []
+    for typecode, itemsize, count in [('i', 4, node_count + 1), ('i', 4, edge_count), ('i', 4, node_count),
+                                      ('i', 4, node_count), ('i', 4, node_count),
+                                      ('B' if label_width == 1 else 'I', label_width, edge_count),
+                                      ('B', 1, node_count)]:
+        end = offset + itemsize * count
+        if end > len(buffer):
+            raise GazetteerModelError("Truncated gazetteer snapshot: {0}".format(path))
+        sections.append(view[offset:end].cast(typecode))
+        offset = end + _padding(end)
+    first_edge, edge_targets, word_counts, min_suffix, max_suffix, edge_labels, terminal = sections
+    return CompactTrie(first_edge, edge_labels, edge_targets, terminal, word_counts, min_suffix, max_suffix, root,
+                       buffer)
+
+
+def write_entities(path, entities):
+    """
+    Atomically writes the entity list of a gazetteer.
+    :param path: destination file path
+    :param entities: list of entity strings
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(temporary_path, 'w') as file_:
+        json.dump(entities, file_)
+    os.replace(temporary_path, path)
+
+
+def load_entities(path):
+    """
+    :param path: entity list file path
+    :return: list of entity strings, None if the file does not exist
+    :raises GazetteerModelError: if the file is not an entity list
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path) as file_:
+        try:
+            entities = json.load(file_)
+        except ValueError:
+            raise GazetteerModelError("Not a gazetteer entity list: {0}".format(path))
+    if not isinstance(entities, list):
+        raise GazetteerModelError("Not a gazetteer entity list: {0}".format(path))
+    return entities
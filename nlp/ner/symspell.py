@@ -0,0 +1,146 @@
+"""
+Symmetric delete (SymSpell) index used as an alternative gazetteer search engine. Every word within Levenshtein
+distance k of a query shares with it a string reachable by at most k deletions from both, so looking up the
+deletions of the query in an index of the deletions of the dictionary words yields every candidate, which is then
+verified with a bounded Levenshtein distance.
+To bound the size of the index only the first prefix_length characters of each word are indexed. The query side
+compensates by looking up the deletions of each of its prefixes of length prefix_length - k to prefix_length + k,
+which keeps the candidate set complete.
+"""
+import logging
+import sys
+
+logger = logging.getLogger('BOLT.gaz')
+
+DEFAULT_MAX_DISTANCE = 2
+DEFAULT_PREFIX_LENGTH = 10
+
+
+def deletes(word, max_deletes):
+    """
+    Returns the set of strings obtained from the word by deleting up to max_deletes characters, including the word.
+    :param word: string
+    :param max_deletes: maximum number of deleted characters
+    :return: set of strings
+    """
+    results = {word}
+    frontier = {word}
+    for _ in range(max_deletes):
+        next_frontier = set()
+        for variant in frontier:
+            for idx in range(len(variant)):
+                next_frontier.add(variant[:idx] + variant[idx + 1:])
+        next_frontier -= results
+        results |= next_frontier
+        frontier = next_frontier
+    return results
+
+
+def bounded_levenshtein(source, target, max_cost):
+    """
+    Levenshtein distance restricted to the diagonal band of width max_cost.
+    :param source: string
+    :param target: string
+    :param max_cost: maximum distance of interest
+    :return: the distance, or None if it is greater than max_cost
+    """
+    if abs(len(source) - len(target)) > max_cost:
+        return None
+    cap = max_cost + 1
+    previous_row = [column if column < cap else cap for column in range(len(target) + 1)]
+    for row in range(1, len(source) + 1):
+        current_row = [cap] * (len(target) + 1)
+        current_row[0] = row if row < cap else cap
+        letter = source[row - 1]
+        for column in range(max(1, row - max_cost), min(len(target), row + max_cost) + 1):
+            cost = previous_row[column - 1] if target[column - 1] == letter else previous_row[column - 1] + 1
+            cost = min(cost, previous_row[column] + 1, current_row[column - 1] + 1)
+            current_row[column] = cost if cost < cap else cap
+        if min(current_row) > max_cost:
+            return None
+        previous_row = current_row
+    return previous_row[-1] if previous_row[-1] <= max_cost else None
+
+
+class SymSpellIndex:
+    """
+    Gazetteer engine answering search(word, max_cost) with the same (word, distance) tuples, in the same order, as
+    TrieNode.search on the trie it was built from.
+    """
+    def __init__(self, words, max_distance=DEFAULT_MAX_DISTANCE, prefix_length=DEFAULT_PREFIX_LENGTH):
+        """
+        :param words: list of distinct words in the depth first order of their trie
+        :param max_distance: largest edit distance the index answers from the deletion index
+        :param prefix_length: number of leading characters of each word that are indexed
+        """
+        self.words = words
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        index = {}
+        for word_id, word in enumerate(words):
+            for variant in deletes(word[:prefix_length], max_distance):
+                index.setdefault(variant, []).append(word_id)
+        self.index = {variant: tuple(word_ids) for variant, word_ids in index.items()}
+        logger.debug("SymSpell index: {0} words, {1} deletes".format(len(words), len(self.index)))
+
+    @staticmethod
+    def from_trie(trie, max_distance=DEFAULT_MAX_DISTANCE, prefix_length=DEFAULT_PREFIX_LENGTH):
+        """
+        Builds the index of the words of a TrieNode trie, numbered in the order TrieNode.search visits them.
+        :param trie: root TrieNode
+        :return: SymSpellIndex
+        """
+        words = []
+        stack = list(reversed(list(trie.children.values())))
+        while stack:
+            node = stack.pop()
+            if node.word is not None:
+                words.append(node.word)
+            stack.extend(reversed(list(node.children.values())))
+        return SymSpellIndex(words, max_distance, prefix_length)
+
+    def __len__(self):
+        return len(self.words)
+
+    def search(self, word, max_cost):
+        """
+        :param word: string to search
+        :param max_cost: max edit distance allowed
+        :return: returns a list of tuples containing word and edit distance
+        """
+        if max_cost > self.max_distance:
+            """ Beyond the indexed distance every word is a candidate """
+            candidates = range(len(self.words))
+        else:
+            candidates = set()
+            variants = set()
+            for length in range(max(self.prefix_length - max_cost, 0), self.prefix_length + max_cost + 1):
+                variants |= deletes(word[:length], max_cost)
+                if length >= len(word):
+                    break
+            for variant in variants:
+                candidates.update(self.index.get(variant, ()))
+            candidates = sorted(candidates)
+        results = []
+        for word_id in candidates:
+            distance = bounded_levenshtein(word, self.words[word_id], max_cost)
+            if distance is not None:
+                results.append((self.words[word_id], distance))
+        return results
+
+    def memory_size(self):
+        """
+        :return: approximate size in bytes of the deletion index and the words
+        """
+        size = sys.getsizeof(self.index) + sys.getsizeof(self.words)
+        for variant, word_ids in self.index.items():
+            size += sys.getsizeof(variant) + sys.getsizeof(word_ids)
+        return size + sum(sys.getsizeof(word) for word in self.words)
+
+    def search_multiple(self, words, max_cost):
+        """
+        :param words: list of strings to search
+        :param max_cost: max edit distance allowed for every word
+        :return: list of lists of tuples containing word and edit distance, aligned with words
+        """
+        return [self.search(word, max_cost) for word in words]
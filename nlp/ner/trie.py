@@ -4,39 +4,157 @@ Created on November 4th, 2016
 @author: Carl L. Mueller
 @copyright: Lightning in a Bot, Inc
 """
+import json
+import sys
+from array import array
+from collections import OrderedDict
 from nltk import ngrams
 from nltk.util import skipgrams
 from nltk.stem.porter import PorterStemmer
 from utils import string_cleaners
 
 
+# Families of the terms generated by GramTrieBuilder, in generation order: single words, n-grams and the skipgrams of
+# size n with skip distance k named skipgram_<n>_<k>.
+TERM_FAMILIES = ['vocab', 'ngram', 'skipgram_2_2', 'skipgram_3_3', 'skipgram_3_2', 'skipgram_2_3']
+
+
 class GramTrieBuilder:
 
+    def __init__(self, families=None):
+        """
+        :param families: list of the TERM_FAMILIES generated, all of them by default. Leaving out skipgram families
+                         trades recall of reordered queries for a smaller trie.
+        """
+        self.families = list(TERM_FAMILIES) if families is None else list(families)
+        for family in self.families:
+            if family not in TERM_FAMILIES:
+                raise ValueError("Unknown term family: {0}".format(family))
+
     def build_trie_from_dictionary(self, dictionary):
         """
         Returns the root TrieNode of a trie containing cleaned dictionary entries, and their associated
-        n-grams and skipgrams
+        n-grams and skipgrams. Terms are deduplicated before insertion.
         :param dictionary: list of tokens
         :return: TrieNode reference to root
         """
         trie = TrieNode()
-        dict_builder = DictionaryBuilder()
-        
-        cleaned_dictionary = dict_builder.clean_dictionary(dictionary)
-        word_list = dict_builder.extract_vocab_from_dictionary(cleaned_dictionary, stemmed=False)
-        word_list.extend(dict_builder.ngram_generator(cleaned_dictionary))
-        word_list.extend(dict_builder.skipgram_generator(cleaned_dictionary))
-        
-        for word in word_list:
-            word = word.lower()
+        for word in OrderedDict.fromkeys(self.terms_from_dictionary(dictionary)):
             trie.insert(word)
         return trie
+
+    def terms_from_dictionary(self, dictionary):
+        """
+        Returns the lower-cased words, n-grams and skipgrams inserted in the trie for the dictionary entries. A term
+        is repeated once for every time it is generated.
+        :param dictionary: list of tokens
+        :return: list of terms
+        """
+        dict_builder = DictionaryBuilder()
+        cleaned_dictionary = dict_builder.clean_dictionary(dictionary)
+        return [term for family in self.families for entry in cleaned_dictionary
+                for term in self._family_terms(dict_builder, family, entry)]
+
+    def build_postings_from_dictionary(self, dictionary):
+        """
+        Returns the distinct terms of the dictionary entries with the posting list of the entries each term was
+        generated from, and the number of terms generated by every family.
+        :param dictionary: list of tokens
+        :return: TermPostings
+        """
+        dict_builder = DictionaryBuilder()
+        cleaned_dictionary = dict_builder.clean_dictionary(dictionary)
+        postings = OrderedDict()
+        family_counts = OrderedDict()
+        for family in self.families:
+            generated = 0
+            distinct = len(postings)
+            for product_id, entry in enumerate(cleaned_dictionary):
+                for term in self._family_terms(dict_builder, family, entry):
+                    generated += 1
+                    product_ids = postings.setdefault(term, [])
+                    if not product_ids or product_ids[-1] != product_id:
+                        product_ids.append(product_id)
+            family_counts[family] = {"generated": generated, "distinct": len(postings) - distinct}
+        for term, product_ids in postings.items():
+            postings[term] = tuple(product_ids)
+        return TermPostings(list(dictionary), postings, family_counts)
+
+    def _family_terms(self, dict_builder, family, entry):
+        """
+        :param dict_builder: DictionaryBuilder
+        :param family: one of TERM_FAMILIES
+        :param entry: cleaned dictionary entry
+        :return: list of the lower-cased terms of the family generated from the entry
+        """
+        if family == 'vocab':
+            terms = dict_builder.extract_vocab_from_dictionary([entry], stemmed=False)
+        elif family == 'ngram':
+            terms = dict_builder.ngram_generator([entry])
+        else:
+            n, k = family.split('_')[1:]
+            terms = dict_builder.skipgrammer(entry.split(' '), int(n), int(k))
+        return [term.lower() for term in terms]
         
     def build_trie_from_serialized_json(self, json_string):
-        pass
+        """
+        Rebuilds a trie serialized by serialize_trie_to_json
+        :param json_string: JSON string
+        :return: TrieNode reference to root
+        """
+        return TrieNode.from_dict(json.loads(json_string))
     
     def serialize_trie_to_json(self, trie):
-        pass
+        """
+        Serializes a trie to JSON. Use nlp.ner.snapshot for snapshots that can be loaded without deserialization.
+        :param trie: TrieNode reference to root
+        :return: JSON string
+        """
+        return json.dumps(trie)
+
+
+class TermPostings:
+    """
+    Distinct terms of a gram trie with the ids of the dictionary entries each was generated from, so that a matched
+    term, which may be an n-gram or a skipgram, can be mapped back to the canonical entries.
+    """
+    def __init__(self, products, postings, family_counts):
+        """
+        :param products: list of the dictionary entries, indexed by product id
+        :param postings: OrderedDict of every term, in generation order, to the tuple of the ids of its entries
+        :param family_counts: OrderedDict of every term family to its number of generated and of new distinct terms
+        """
+        self.products = products
+        self.postings = postings
+        self.family_counts = family_counts
+
+    def __len__(self):
+        return len(self.postings)
+
+    def build_trie(self):
+        """
+        :return: root TrieNode of the distinct terms, equal to the trie of GramTrieBuilder.build_trie_from_dictionary
+        """
+        trie = TrieNode()
+        for term in self.postings:
+            trie.insert(term)
+        return trie
+
+    def products_for(self, term):
+        """
+        :param term: term of the trie
+        :return: list of the dictionary entries the term was generated from
+        """
+        return [self.products[product_id] for product_id in self.postings.get(term, ())]
+
+    def memory_size(self):
+        """
+        :return: approximate size in bytes of the posting lists
+        """
+        size = sys.getsizeof(self.postings)
+        for term, product_ids in self.postings.items():
+            size += sys.getsizeof(term) + sys.getsizeof(product_ids)
+        return size
 
 
 class SimpleTrieBuilder:
@@ -48,27 +166,40 @@ class SimpleTrieBuilder:
         :return: TrieNode reference to root
         """
         trie = TrieNode()
-        dict_builder = DictionaryBuilder()
-
+        for entry in self.terms_from_dictionary(dictionary):
+            trie.insert(entry)
+        return trie
 
+    def terms_from_dictionary(self, dictionary):
+        """
+        Returns the stemmed, lower-cased cleaned and uncleaned entries inserted in the trie for the dictionary entries.
+        A term is repeated once for every time it is generated.
+        :param dictionary: list of tokens
+        :return: list of terms
+        """
+        dict_builder = DictionaryBuilder()
         cleaned_dictionary = dict_builder.clean_dictionary(dictionary)
 
         stemmer = PorterStemmer()
-        for entry in cleaned_dictionary:
-            entry = entry.lower()
-            entry = stemmer.stem(entry)
-            trie.insert(entry)
-        for entry in dictionary:
-            entry = entry.lower()
-            entry = stemmer.stem(entry)
-            trie.insert(entry)
-        return trie
+        terms = [stemmer.stem(entry.lower()) for entry in cleaned_dictionary]
+        terms.extend(stemmer.stem(entry.lower()) for entry in dictionary)
+        return terms
 
     def build_trie_from_serialized_json(self, json_string):
-        pass
+        """
+        Rebuilds a trie serialized by serialize_trie_to_json
+        :param json_string: JSON string
+        :return: TrieNode reference to root
+        """
+        return TrieNode.from_dict(json.loads(json_string))
 
     def serialize_trie_to_json(self, trie):
-        pass
+        """
+        Serializes a trie to JSON. Use nlp.ner.snapshot for snapshots that can be loaded without deserialization.
+        :param trie: TrieNode reference to root
+        :return: JSON string
+        """
+        return json.dumps(trie)
 
 
 class DictionaryBuilder:
@@ -221,6 +352,29 @@ class TrieNode(dict):
     
         return results
 
+    @staticmethod
+    def search_multiple(trie, words, max_cost):
+        """
+        Searches several words in a single walk of the trie. Equivalent to calling TrieNode.search for every word:
+        each returned list holds the same tuples in the same order.
+        :param trie: root TrieNode on which to conduct the search
+        :param words: list of strings to search
+        :param max_cost: max edit distance allowed for every word
+        :return: list of lists of tuples containing word and edit distance, aligned with words
+        """
+        columns = PatternColumns(words, max_cost)
+        results = [[] for _ in words]
+        stack = [(child, letter, 1, columns.first_row) for letter, child in reversed(list(trie.children.items()))]
+        while stack:
+            node, letter, depth, previous_row = stack.pop()
+            current_row = columns.next_row(previous_row, letter, depth)
+            if node.word is not None:
+                columns.collect(current_row, node.word, max_cost, results)
+            if min(current_row) <= max_cost:
+                for child_letter, child in reversed(list(node.children.items())):
+                    stack.append((child, child_letter, depth + 1, current_row))
+        return results
+
     @staticmethod
     def search_recursive(node, letter, word, previous_row, results, max_cost):
         """
@@ -265,3 +419,415 @@ class TrieNode(dict):
         if min(current_row) <= max_cost:
             for letter in node.children:
                 TrieNode.search_recursive(node.children[letter], letter, word, current_row, results, max_cost)
+
+
+class PatternColumns:
+    """
+    Columns of a Levenshtein row shared by several search words. The words are laid out as a trie of their prefixes:
+    column 0 is the empty prefix and every other column is one prefix, linked to the column of the prefix one
+    character shorter. Words sharing a prefix share its columns, so one row per trie node carries the distances to
+    every word at once.
+    Distances are capped at max_cost + 1, which leaves every comparison against max_cost unchanged. At trie depth d
+    a prefix of length l is at least |d - l| edits away, so only the columns with |d - l| <= max_cost are computed.
+    """
+    def __init__(self, words, max_cost):
+        """
+        :param words: list of strings to search
+        :param max_cost: max edit distance of the search
+        """
+        self.cap = max_cost + 1
+        self.parents = [0]
+        self.letters = ['']
+        self.columns_by_length = [[0]]
+        self.finals = []
+        prefixes = {'': 0}
+        for word in words:
+            column = 0
+            for end in range(1, len(word) + 1):
+                prefix = word[:end]
+                child = prefixes.get(prefix)
+                if child is None:
+                    child = len(self.parents)
+                    prefixes[prefix] = child
+                    self.parents.append(column)
+                    self.letters.append(word[end - 1])
+                    if len(self.columns_by_length) <= end:
+                        self.columns_by_length.append([])
+                    self.columns_by_length[end].append(child)
+                column = child
+            self.finals.append(column)
+        self.first_row = [self.cap] * len(self.parents)
+        for length in range(min(self.cap, len(self.columns_by_length))):
+            for column in self.columns_by_length[length]:
+                self.first_row[column] = length
+
+    def next_row(self, previous_row, letter, depth):
+        """
+        Computes the row of a trie node from the row of its parent node and the letter of the edge between them.
+        :param previous_row: row of the parent node
+        :param letter: edge letter
+        :param depth: depth of the node, 1 for children of the root
+        :return: row of the node
+        """
+        cap = self.cap
+        parents = self.parents
+        letters = self.letters
+        current_row = [cap] * len(parents)
+        if depth < cap:
+            current_row[0] = depth
+        for length in range(max(depth - cap + 1, 1), min(depth + cap, len(self.columns_by_length))):
+            for column in self.columns_by_length[length]:
+                parent = parents[column]
+                insert_cost = current_row[parent] + 1
+                delete_cost = previous_row[column] + 1
+                if letters[column] != letter:
+                    replace_cost = previous_row[parent] + 1
+                else:
+                    replace_cost = previous_row[parent]
+                cost = min(insert_cost, delete_cost, replace_cost)
+                if cost < cap:
+                    current_row[column] = cost
+        return current_row
+
+    def collect(self, row, word, max_cost, results):
+        """
+        Appends the word to the results of every search word within max_cost of it.
+        :param row: row of the terminal node of word
+        :param word: word of the terminal node
+        :param max_cost: max edit distance
+        :param results: list of result lists, aligned with the search words
+        """
+        for idx, final in enumerate(self.finals):
+            if row[final] <= max_cost:
+                results[idx].append((word, row[final]))
+
+
+class BestFirstWalk:
+    """
+    Levenshtein search of several words over a TrieNode or CompactTrie whose cost bound can be raised without walking
+    the trie again. Edges waiting to be visited are kept in a bucket queue indexed by a lower bound of the distance of
+    the words below them: the lowest distance of the row of their parent node and, in a CompactTrie, the difference
+    between the remaining word lengths and the lengths of the search words. Searching at a bound visits the buckets up
+    to it, so raising the bound resumes the walk where the previous bound stopped and no node is visited twice.
+    """
+    def __init__(self, trie, words, max_cost):
+        """
+        :param trie: root TrieNode or CompactTrie
+        :param words: list of strings to search, not empty
+        :param max_cost: highest bound the walk will be searched at
+        """
+        self.trie = trie
+        self.max_cost = max_cost
+        self.columns = PatternColumns(words, max_cost)
+        self.results = [[] for _ in words]
+        self.shortest = min(len(word) for word in words)
+        self.longest = max(len(word) for word in words)
+        self.buckets = [[] for _ in range(max_cost + 1)]
+        self.level = 0
+        if isinstance(trie, TrieNode):
+            self._push_children = self._push_trie_node_children
+            self._push_children(trie, 0, '', self.columns.first_row, 0)
+        else:
+            self._push_children = self._push_compact_trie_children
+            self._push_children(trie.root, 0, '', self.columns.first_row, 0)
+
+    def search(self, bound):
+        """
+        :param bound: max edit distance, at most the max_cost of the walk
+        :return: list of lists of tuples containing word and edit distance, aligned with words, holding the same
+                 tuples as search_multiple at the bound in no particular order
+        """
+        columns = self.columns
+        while self.level <= bound:
+            stack = self.buckets[self.level]
+            while stack:
+                node, letter, depth, prefix, previous_row, word = stack.pop()
+                row = columns.next_row(previous_row, letter, depth)
+                if word is not None:
+                    columns.collect(row, word, self.max_cost, self.results)
+                lowest = min(row)
+                if lowest <= self.max_cost:
+                    self._push_children(node, depth, prefix, row, lowest)
+            self.level += 1
+        return [[result for result in results if result[1] <= bound] for results in self.results]
+
+    def _push_trie_node_children(self, node, depth, prefix, row, lowest):
+        bucket = self.buckets[lowest]
+        for letter, child in node.children.items():
+            bucket.append((child, letter, depth + 1, prefix, row, child.word))
+
+    def _push_compact_trie_children(self, node, depth, prefix, row, lowest):
+        """
+        Queues the edges of a CompactTrie node by the larger of the lowest distance of its row and the length
+        difference between the words below the edge and the search words, skipping edges beyond max_cost.
+        """
+        trie = self.trie
+        buckets = self.buckets
+        depth += 1
+        for edge in range(trie.first_edge[node], trie.first_edge[node + 1]):
+            target = trie.edge_targets[edge]
+            priority = max(lowest, depth + trie.min_suffix[target] - self.longest,
+                           self.shortest - depth - trie.max_suffix[target])
+            if priority <= self.max_cost:
+                letter = chr(trie.edge_labels[edge])
+                buckets[priority].append((target, letter, depth, prefix + letter, row,
+                                          prefix + letter if trie.terminal[target] else None))
+
+
+class CompactTrie:
+    """
+    Frozen, array backed form of a TrieNode trie. Nodes are integer ids, the edges of node n are the slice
+    first_edge[n]:first_edge[n + 1] of the flat edge_labels (character code points) and edge_targets arrays, and
+    terminal marks the nodes ending a word. The arrays may be any buffer indexable by int, such as memoryviews of a
+    memory mapped snapshot (see nlp.ner.snapshot).
+    Words are not stored; they are rebuilt from the path during search. Each word has an interned integer id, its
+    rank in depth first order, derived from the number of words below each node. min_suffix and max_suffix hold the
+    shortest and longest remaining word length below each node, so that searches skip subtrees whose words are all
+    too short or too long to be within the edit distance. Optionally identical subtrees are merged into a
+    minimized DAWG.
+    Children keep the insertion order of the source trie so that search results come out in the same order as
+    TrieNode.search.
+    """
+    def __init__(self, first_edge, edge_labels, edge_targets, terminal, word_counts, min_suffix, max_suffix, root,
+                 buffer=None):
+        """
+        :param buffer: optional object owning the memory of the arrays, kept alive with the trie
+        """
+        self.buffer = buffer
+        self.first_edge = first_edge
+        self.edge_labels = edge_labels
+        self.edge_targets = edge_targets
+        self.terminal = terminal
+        self.word_counts = word_counts
+        self.min_suffix = min_suffix
+        self.max_suffix = max_suffix
+        self.root = root
+
+    @staticmethod
+    def from_trie(trie, minimize=False):
+        """
+        Compacts a TrieNode trie.
+        :param trie: root TrieNode
+        :param minimize: merge identical subtrees into a DAWG
+        :return: CompactTrie
+        """
+        node_edges = []
+        node_terminal = []
+        registry = {}
+        root = None
+        stack = [(trie, None, iter(list(trie.children.items())), [])]
+        while stack:
+            node, letter, children, edges = stack[-1]
+            child = next(children, None)
+            if child is not None:
+                stack.append((child[1], child[0], iter(list(child[1].children.items())), []))
+                continue
+            stack.pop()
+            """ Children are registered before their parent, so node ids are in post order """
+            is_terminal = node.word is not None and node is not trie
+            signature = (is_terminal, tuple(edges))
+            node_id = registry.get(signature) if minimize else None
+            if node_id is None:
+                node_id = len(node_edges)
+                node_edges.append(signature[1])
+                node_terminal.append(is_terminal)
+                if minimize:
+                    registry[signature] = node_id
+            if stack:
+                stack[-1][3].append((letter, node_id))
+            else:
+                root = node_id
+
+        first_edge = array('i', [0])
+        labels = array('I')
+        edge_targets = array('i')
+        word_counts = array('i')
+        min_suffix = array('i')
+        max_suffix = array('i')
+        for node_id, edges in enumerate(node_edges):
+            count = 1 if node_terminal[node_id] else 0
+            shortest = 0 if node_terminal[node_id] else None
+            longest = 0
+            for letter, target in edges:
+                labels.append(ord(letter))
+                edge_targets.append(target)
+                count += word_counts[target]
+                if shortest is None or min_suffix[target] + 1 < shortest:
+                    shortest = min_suffix[target] + 1
+                longest = max(longest, max_suffix[target] + 1)
+            word_counts.append(count)
+            min_suffix.append(shortest or 0)
+            max_suffix.append(longest)
+            first_edge.append(len(edge_targets))
+        if all(label < 256 for label in labels):
+            labels = array('B', labels)
+        return CompactTrie(first_edge, labels, edge_targets, bytearray(node_terminal), word_counts, min_suffix,
+                           max_suffix, root)
+
+    def __len__(self):
+        return self.word_counts[self.root]
+
+    def search(self, word, max_cost):
+        """
+        Same Levenshtein search and result order as TrieNode.search, run iteratively over the flat arrays with a
+        bit-parallel automaton instead of a row of distances.
+        Bit i of the bit vector state[d] is set when the first i letters of the word are within d edits of the
+        current trie path. Each edge updates the k + 1 bit vectors with a few shifts and masks (Wu-Manber), a word
+        matches when bit len(word) is set in state[max_cost], and a branch is pruned when state[max_cost] is empty,
+        which is the same condition as min(row) > max_cost. Branches whose remaining word lengths cannot come within
+        max_cost of len(word) are skipped before being visited.
+        :param word: string to search
+        :param max_cost: max edit distance allowed
+        :return: returns a list of tuples containing word and edit distance
+        """
+        if max_cost < 0:
+            return []
+        first_edge = self.first_edge
+        edge_labels = self.edge_labels
+        edge_targets = self.edge_targets
+        terminal = self.terminal
+        min_suffix = self.min_suffix
+        max_suffix = self.max_suffix
+        length = len(word)
+        shortest = length - max_cost
+        longest = length + max_cost
+        final_bit = 1 << length
+        mask = (final_bit << 1) - 1
+        """ Bit i of letter_masks[code] is set when word[i - 1] is the letter """
+        letter_masks = {}
+        for idx, letter in enumerate(word):
+            code = ord(letter)
+            letter_masks[code] = letter_masks.get(code, 0) | (2 << idx)
+        costs = range(1, max_cost + 1)
+        first_state = tuple(((2 << cost) - 1) & mask for cost in range(max_cost + 1))
+        results = []
+        path = []
+        stack = []
+        for edge in range(first_edge[self.root + 1] - 1, first_edge[self.root] - 1, -1):
+            target = edge_targets[edge]
+            if 1 + min_suffix[target] <= longest and 1 + max_suffix[target] >= shortest:
+                stack.append((target, edge_labels[edge], 0, first_state))
+        while stack:
+            node, letter, depth, previous_state = stack.pop()
+            del path[depth:]
+            path.append(letter)
+            letter_mask = letter_masks.get(letter, 0)
+            previous = previous_state[0]
+            current = ((previous << 1) & letter_mask) & mask
+            state = [current]
+            for cost in costs:
+                below = previous
+                previous = previous_state[cost]
+                current = (((previous << 1) & letter_mask) | below | (below << 1) | current | (current << 1)) & mask
+                state.append(current)
+            if not current:
+                continue
+            if current & final_bit and terminal[node]:
+                for cost, bits in enumerate(state):
+                    if bits & final_bit:
+                        results.append((''.join(map(chr, path)), cost))
+                        break
+            depth += 1
+            for edge in range(first_edge[node + 1] - 1, first_edge[node] - 1, -1):
+                target = edge_targets[edge]
+                if depth + 1 + min_suffix[target] <= longest and depth + 1 + max_suffix[target] >= shortest:
+                    stack.append((target, edge_labels[edge], depth, state))
+        return results
+
+    def search_multiple(self, words, max_cost):
+        """
+        Searches several words in a single walk of the trie, see TrieNode.search_multiple. Branches whose remaining
+        word lengths cannot come within max_cost of the length of any of the words are skipped.
+        :param words: list of strings to search
+        :param max_cost: max edit distance allowed for every word
+        :return: list of lists of tuples containing word and edit distance, aligned with words
+        """
+        if not words:
+            return []
+        first_edge = self.first_edge
+        edge_labels = self.edge_labels
+        edge_targets = self.edge_targets
+        terminal = self.terminal
+        min_suffix = self.min_suffix
+        max_suffix = self.max_suffix
+        shortest = min(len(word) for word in words) - max_cost
+        longest = max(len(word) for word in words) + max_cost
+        columns = PatternColumns(words, max_cost)
+        results = [[] for _ in words]
+        path = []
+        stack = []
+        for edge in range(first_edge[self.root + 1] - 1, first_edge[self.root] - 1, -1):
+            target = edge_targets[edge]
+            if 1 + min_suffix[target] <= longest and 1 + max_suffix[target] >= shortest:
+                stack.append((target, edge_labels[edge], 0, columns.first_row))
+        while stack:
+            node, letter, depth, previous_row = stack.pop()
+            del path[depth:]
+            path.append(letter)
+            current_row = columns.next_row(previous_row, chr(letter), depth + 1)
+            if terminal[node]:
+                columns.collect(current_row, ''.join(map(chr, path)), max_cost, results)
+            if min(current_row) <= max_cost:
+                depth += 1
+                for edge in range(first_edge[node + 1] - 1, first_edge[node] - 1, -1):
+                    target = edge_targets[edge]
+                    if depth + 1 + min_suffix[target] <= longest and depth + 1 + max_suffix[target] >= shortest:
+                        stack.append((target, edge_labels[edge], depth, current_row))
+        return results
+
+    def word_id(self, word):
+        """
+        :param word: word to look up
+        :return: interned id of the word or None if the word is not in the trie
+        """
+        node = self.root
+        word_id = 0
+        for letter in word:
+            code = ord(letter)
+            if self.terminal[node]:
+                word_id += 1
+            for edge in range(self.first_edge[node], self.first_edge[node + 1]):
+                if self.edge_labels[edge] == code:
+                    node = self.edge_targets[edge]
+                    break
+                word_id += self.word_counts[self.edge_targets[edge]]
+            else:
+                return None
+        return word_id if self.terminal[node] else None
+
+    def words(self):
+        """
+        :return: generator of the words of the trie in id order
+        """
+        stack = [(self.root, '')]
+        while stack:
+            node, prefix = stack.pop()
+            if self.terminal[node]:
+                yield prefix
+            for edge in range(self.first_edge[node + 1] - 1, self.first_edge[node] - 1, -1):
+                stack.append((self.edge_targets[edge], prefix + chr(self.edge_labels[edge])))
+
+    def memory_size(self):
+        """
+        :return: size in bytes of the arrays backing the trie
+        """
+        return sum(memoryview(part).nbytes for part in (self.first_edge, self.edge_labels, self.edge_targets,
+                                                         self.terminal, self.word_counts, self.min_suffix,
+                                                         self.max_suffix))
+
+
+def trie_memory_size(trie):
+    """
+    Approximates the size in bytes of a TrieNode trie, counting every node dict, child dict and word string.
+    :param trie: root TrieNode
+    :return: size in bytes
+    """
+    size = 0
+    stack = [trie]
+    while stack:
+        node = stack.pop()
+        size += sys.getsizeof(node) + sys.getsizeof(node.children)
+        if node.word is not None:
+            size += sys.getsizeof(node.word)
+        stack.extend(node.children.values())
+    return size
@@ -4,6 +4,7 @@ Created on Jul 27, 2016
 @author: Carl Mueller
 '''
 import os
+import time
 import unittest
 import json
 import settings
@@ -69,6 +70,58 @@ class NLPTest(unittest.TestCase):
         NLPTest.expressions_db.delete_unlabeled_expression_by_id(id)
         logger.info("TEST PASS: 'POST' '/nlp/analyze'")
     
+    def test_analyze_batch_route(self):
+        logger.debug("TEST: 'POST' '/nlp/analyze/batch'")
+        test_headers = Headers()
+        test_headers.add('Content-Type', 'application/json')
+        test_headers.add('Authorization', 'Token ' + self.access_token)
+        queries = ['What is order 2313?', 'What is the best selling item of all time?'] * 25
+
+        start = time.time()
+        single_results = []
+        for query in queries:
+            response = NLPTest.app.post('/nlp/analyze',
+                                        data=json.dumps(dict(query=query, key='1234', save_expression=False)),
+                                        headers=test_headers)
+            single_results.append(json.loads(response.get_data(as_text=True)))
+        single_elapsed = time.time() - start
+
+        start = time.time()
+        response = NLPTest.app.post('/nlp/analyze/batch',
+                                    data=json.dumps(dict(queries=queries, key='1234', save_expression=False)),
+                                    headers=test_headers)
+        batch_elapsed = time.time() - start
+        self.assertEqual(response.status_code, 200)
+        batch_results = json.loads(response.get_data(as_text=True))['results']
+        self.assertEqual(len(batch_results), len(queries))
+        self.assertEqual(batch_results[0]['classification'][0]['intent'], u"get_order")
+        for single_result, batch_result in zip(single_results, batch_results):
+            self.assertEqual(single_result['classification'][0]['intent'], batch_result['classification'][0]['intent'])
+            self.assertEqual(single_result['entities'], batch_result['entities'])
+        logger.info("Single query throughput: {0:.1f} queries/s".format(len(queries) / single_elapsed))
+        logger.info("Batch query throughput: {0:.1f} queries/s".format(len(queries) / batch_elapsed))
+        logger.info("TEST PASS: 'POST' '/nlp/analyze/batch'")
+
+    def test_analyze_timings(self):
+        logger.debug("TEST: 'POST' '/nlp/analyze' timings and 'GET' '/nlp/timings'")
+        test_headers = Headers()
+        test_headers.add('Content-Type', 'application/json')
+        test_headers.add('Authorization', 'Token ' + self.access_token)
+        response = NLPTest.app.post('/nlp/analyze',
+                                    data=json.dumps(dict(query='What is order 2313?', key='1234',
+                                                         save_expression=False, timings=True)),
+                                    headers=test_headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('analysis;dur=', response.headers['Server-Timing'])
+        timings = json.loads(response.get_data(as_text=True))['timings']
+        self.assertIn('intent_prediction', timings)
+        self.assertIn('annotator.clf', timings)
+        response = NLPTest.app.get('/nlp/timings', headers=test_headers)
+        self.assertEqual(response.status_code, 200)
+        histograms = json.loads(response.get_data(as_text=True))['histograms']
+        self.assertGreaterEqual(histograms['analysis']['count'], 1)
+        logger.info("TEST PASS: 'POST' '/nlp/analyze' timings and 'GET' '/nlp/timings'")
+
     def test_train_route(self):
         logger.debug("TEST: 'GET' '/nlp/train'")
         test_headers = Headers()
@@ -131,6 +184,18 @@ class NLPTest(unittest.TestCase):
         self.assertEqual(result['message']['gazetteer'],
                          "Gazetteers for the key 8b10af10-011b-11e6-896c-6924b93e8186 updated")
 
+        train_gazetteer_delta_response = NLPTest.app.post('/nlp/train',
+                                                          data=json.dumps(dict(all=False, gazetteer={
+                                                              "all": False,
+                                                              "key": "8b10af10-011b-11e6-896c-6924b93e8186",
+                                                              "add": {"product_name": ["Test Delta Product"]},
+                                                              "remove": {"product_name": ["Test Delta Product"]}})),
+                                                          headers=test_headers)
+        self.assertEqual(train_gazetteer_delta_response.status_code, 200)
+        result = json.loads(train_gazetteer_delta_response.get_data(as_text=True))
+        self.assertEqual(result['message']['gazetteer'],
+                         "Gazetteer entries for the key 8b10af10-011b-11e6-896c-6924b93e8186 updated")
+
 
         logger.info("TEST PASS: 'GET' '/nlp/train'")
 
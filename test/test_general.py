@@ -11,10 +11,29 @@ import settings
 import logging
 import json
 import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import numpy
+from collections import OrderedDict
 from utils.custom_assertions import CustomAssertions
-from nlp.clf.classification import ClassificationModelBuilder, ClassificationModelAccessor, IntentClassifier, BinaryClassifier
-from nlp.ner.gazetteer import GazetteerModelBuilder, GazetteerModelAccessor, Gazetteer
-from database.database import ExpressionsDatabaseEngine, IntentsDatabaseEngine, EntitiesDatabaseEngine
+from nlp.clf.classification import ClassificationModelBuilder, ClassificationModelAccessor, IntentClassifier, BinaryClassifier, \
+    tokenization_cache
+from nlp.clf.compiled import compile_pipeline
+from nlp import AnalysisPipeline, AnalysisPipelineCache
+from nlp.annotation import Annotation, AbstractAnnotator
+from nlp.ner.gazetteer import GazetteerModelBuilder, GazetteerModelAccessor, Gazetteer, gazetteer_engine, \
+    GazetteerCache, CleanedQuery, stem_cache, gazetteer_cache
+from nlp.ner.symspell import SymSpellIndex
+from nlp.ner.shards import ShardedEngine, shard_entities, start_shard_pool, stop_shard_pool
+from nlp.ner.aho_corasick import TokenAutomaton
+from nlp.ner.trie import CompactTrie, GramTrieBuilder, DictionaryBuilder, TrieNode, TERM_FAMILIES, BestFirstWalk
+from nlp.ner.snapshot import write_snapshot, write_entities
+from database.database import ExpressionsDatabaseEngine, IntentsDatabaseEngine, EntitiesDatabaseEngine, intent_metadata, \
+    ExternalDatabaseEngine
+from spacy.tokens import Token
 from builtins import int, str
 
 logger = logging.getLogger('BOLT.test')
@@ -254,6 +273,21 @@ class StopwordsDatabaseTest(unittest.TestCase, CustomAssertions):
         db.release_database_connection()
         logger.info("TEST PASS: delete_stopwords_from_intent()")
 
+    def test_intent_metadata_cache(self):
+        logger.info("TEST: intent_metadata cache invalidation")
+        db = IntentsDatabaseEngine()
+        db.add_intent('test_intent')
+        intent_metadata.load()
+        stopwords, entities = intent_metadata.get_intent_metadata('test_intent')
+        self.assertNotIn('stop_one', stopwords or [])
+        db.add_stopwords_to_intent('test_intent', ['stop_one'])
+        stopwords, entities = intent_metadata.get_intent_metadata('test_intent')
+        self.assertIn('stop_one', stopwords)
+        self.assertEqual([], entities)
+        db.delete_intent('test_intent')
+        db.release_database_connection()
+        logger.info("TEST PASS: intent_metadata cache invalidation")
+
 
 class IntentsDatabaseTest(unittest.TestCase, CustomAssertions):
     """
@@ -504,6 +538,26 @@ class ClassifierTest(unittest.TestCase):
         self.assertListEqual(test, actual)
         logger.info("TEST PASS: _tokenize_text()")
 
+    def test_tokenization_cache(self):
+        logger.debug("TEST: tokenization_cache")
+        builder = ClassificationModelBuilder()
+        tokenization_cache.clear()
+        first = builder._tokenize_text("What is the best selling item of  all  time?")
+        second = builder._tokenize_text("What is the best selling item of all time?")
+        self.assertListEqual(first, second)
+        first.append('mutated')
+        self.assertNotIn('mutated', builder._tokenize_text("What is the best selling item of all time?"))
+        stats = tokenization_cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['size'], 1)
+        """ Without lemmatization the spaCy tokens are returned and not cached """
+        tokens = builder._tokenize_text("What is the best selling item of all time?", lemmatize=False)
+        self.assertIsInstance(tokens[0], Token)
+        self.assertListEqual([tok.text for tok in tokens][:2], [u"What", u"is"])
+        self.assertEqual(tokenization_cache.stats()['size'], 1)
+        logger.info("TEST PASS: tokenization_cache")
+
     def test_build_binary_classification_pipeline(self):
         logger.debug("TEST: build_classification_pipeline")
         builder = ClassificationModelBuilder()
@@ -553,6 +607,171 @@ class ClassifierTest(unittest.TestCase):
         self.assertEqual("true", result[0][0])
         logger.info("TEST PASS: classify()")
 
+    def test_export_classification_pipeline(self):
+        logger.debug("TEST: export_classification_pipeline()")
+        builder = ClassificationModelBuilder()
+        accesor = ClassificationModelAccessor()
+        builder.initialize_classification_models(multiclass=True)
+        first = accesor.get_classification_pipeline('multiclass', 'intent_classifier')
+        second = accesor.get_classification_pipeline('multiclass', 'intent_classifier')
+        self.assertIs(first.pipeline, second.pipeline)
+        exported = accesor.export_classification_pipeline('multiclass', 'intent_classifier')
+        self.assertIsInstance(pickle.loads(exported), sklearn.pipeline.Pipeline)
+        self.assertIsNone(accesor.export_classification_pipeline('multiclass', 'missing_classifier'))
+        logger.info("TEST PASS: export_classification_pipeline()")
+
+    def test_parallel_binary_classifier_training(self):
+        logger.debug("TEST: initialize_classification_models(binary_classifier=True, processes=2)")
+        builder = ClassificationModelBuilder()
+        accesor = ClassificationModelAccessor()
+        binary_entities = [entity[1] for entity in EntitiesDatabaseEngine().get_entities()
+                           if entity[2] == 'binary_classifier']
+        fit_times = builder.initialize_classification_models(binary_classifier=True, processes=2)
+        self.assertSetEqual(set(fit_times.keys()), set(binary_entities))
+        for entity_name in binary_entities:
+            self.assertIsInstance(accesor.get_classification_pipeline('binary_classifier', entity_name),
+                                  BinaryClassifier)
+        logger.info("TEST PASS: initialize_classification_models(binary_classifier=True, processes=2)")
+
+    def test_compiled_classification_pipeline(self):
+        logger.debug("TEST: compile_pipeline()")
+        builder = ClassificationModelBuilder()
+        pipeline = builder._train_intent_classification_pipeline()
+        compiled = compile_pipeline(pipeline)
+        self.assertIsNotNone(compiled)
+        documents = ["What is order 2313?", "What is the best selling item of all time?", "hello"]
+        self.assertTrue(numpy.allclose(compiled.predict_proba(documents), pipeline.predict_proba(documents), atol=1e-6))
+        compiled_results = IntentClassifier(pipeline, compiled).classify_batch(documents)
+        pipeline_results = IntentClassifier(pipeline).classify_batch(documents)
+        for compiled_result, pipeline_result in zip(compiled_results, pipeline_results):
+            self.assertListEqual([x['intent'] for x in compiled_result['intents']],
+                                 [x['intent'] for x in pipeline_result['intents']])
+        logger.info("TEST PASS: compile_pipeline()")
+
+    def test_shared_doc_classification(self):
+        logger.debug("TEST: Annotation.share_doc()")
+        builder = ClassificationModelBuilder()
+        classifier = IntentClassifier(builder._train_intent_classification_pipeline())
+        for text in ["What is Order 2313?", "  What is the BEST selling item of  all time?", "Hello"]:
+            annotation = Annotation(text)
+            tokenization_cache.clear()
+            unshared = classifier.classify(text)
+            unshared_tokens = builder._tokenize_text(annotation.clean_text())
+            tokenization_cache.clear()
+            with annotation.share_doc():
+                shared = classifier.classify(text)
+            self.assertListEqual(shared['intents'], unshared['intents'])
+            self.assertListEqual(builder._tokenize_text(annotation.clean_text()), unshared_tokens)
+            self.assertIsNotNone(annotation._clean_doc)
+        logger.info("TEST PASS: Annotation.share_doc()")
+
+
+class SlowAnnotator(AbstractAnnotator):
+    """ Annotator adding a single entity once its release event is set """
+    def __init__(self, name, release):
+        super().__init__(name)
+        self.release = release
+        self.runs = 0
+
+    def validate(self, annotation):
+        pass
+
+    def annotate(self, annotation):
+        self.runs += 1
+        self.release.wait()
+        annotation.annotations['results']['entities'].append({"name": self.name, "value": self.runs})
+        return annotation
+
+
+class AnalysisPipelineTest(unittest.TestCase):
+    """
+    Class for unit testing the AnalysisPipeline and AnalysisPipelineCache classes of nlp.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        logger.info("TEST SUITE: AnalysisPipelineTest")
+
+    @classmethod
+    def tearDownClass(cls):
+        logger.info("TEST SUITE: AnalysisPipelineTest\n")
+
+    def test_analysis_pipeline_cache(self):
+        logger.debug("TEST: AnalysisPipelineCache")
+        cache = AnalysisPipelineCache()
+        generations = {('intent', 'key_a'): (0, 0, 1), ('intent', 'key_b'): (0, 0, 1)}
+        pipeline_a = cache.get(('intent', 'key_a'), generations[('intent', 'key_a')], AnalysisPipeline)
+        pipeline_b = cache.get(('intent', 'key_b'), generations[('intent', 'key_b')], AnalysisPipeline)
+        self.assertIs(cache.get(('intent', 'key_a'), (0, 0, 1), AnalysisPipeline), pipeline_a)
+        """ A change to the gazetteers of key_b only drops the pipelines of key_b """
+        generations[('intent', 'key_b')] = (0, 0, 2)
+        cache.sweep((0, 0, 2), generations.get)
+        self.assertIs(cache.get(('intent', 'key_a'), (0, 0, 1), AnalysisPipeline), pipeline_a)
+        self.assertNotIn(('intent', 'key_b'), cache.pipelines)
+        self.assertIsNot(cache.get(('intent', 'key_b'), (0, 0, 2), AnalysisPipeline), pipeline_b)
+        cache.invalidate('key_a')
+        self.assertListEqual(list(cache.pipelines), [('intent', 'key_b')])
+        cache.invalidate()
+        self.assertDictEqual(cache.pipelines, {})
+        logger.info("TEST PASS: AnalysisPipelineCache")
+
+    def test_concurrent_annotators(self):
+        logger.debug("TEST: AnalysisPipeline concurrent mode")
+        released = threading.Event()
+        released.set()
+        pipeline = AnalysisPipeline(SlowAnnotator('first', released), SlowAnnotator('second', released),
+                                    concurrent=True, deadline=5)
+        annotation = pipeline.analyze(Annotation("test query"))
+        self.assertListEqual(annotation.annotations['results']['entities'],
+                             [{"name": 'first', "value": 1}, {"name": 'second', "value": 1}])
+        logger.info("TEST PASS: AnalysisPipeline concurrent mode")
+
+    def test_concurrent_annotator_deadline(self):
+        logger.debug("TEST: AnalysisPipeline deadline")
+        released = threading.Event()
+        fast = threading.Event()
+        fast.set()
+        slow_annotator = SlowAnnotator('slow', released)
+        pipeline = AnalysisPipeline(SlowAnnotator('fast', fast), slow_annotator, concurrent=True, deadline=0.2)
+        try:
+            annotation = pipeline.analyze(Annotation("test query"))
+            self.assertListEqual(annotation.annotations['results']['entities'], [{"name": 'fast', "value": 1}])
+            self.assertListEqual(annotation.annotations['results']['timed_out'], ['slow'])
+            """ The overrunning annotator is not run again until it returns """
+            annotation = pipeline.analyze(Annotation("test query"))
+            self.assertListEqual(annotation.annotations['results']['entities'], [{"name": 'fast', "value": 2}])
+            self.assertListEqual(annotation.annotations['results']['timed_out'], ['slow'])
+            self.assertEqual(slow_annotator.runs, 1)
+            """ The deadline also applies to a pipeline of a single annotator """
+            single_pipeline = AnalysisPipeline(SlowAnnotator('single', released), concurrent=True, deadline=0.2)
+            annotation = single_pipeline.analyze(Annotation("test query"))
+            self.assertListEqual(annotation.annotations['results']['entities'], [])
+            self.assertListEqual(annotation.annotations['results']['timed_out'], ['single'])
+        finally:
+            released.set()
+        for _ in range(50):
+            if not pipeline._is_overrunning(slow_annotator):
+                break
+            time.sleep(0.1)
+        annotation = pipeline.analyze(Annotation("test query"))
+        self.assertListEqual(annotation.annotations['results']['entities'],
+                             [{"name": 'fast', "value": 3}, {"name": 'slow', "value": 2}])
+        self.assertNotIn('timed_out', annotation.annotations['results'])
+        logger.info("TEST PASS: AnalysisPipeline deadline")
+
+    def test_gazetteer_generation_by_key(self):
+        logger.debug("TEST: GazetteerModelAccessor.get_generation()")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/entities_for_testing.json')) as file_:
+            entities = json.load(file_)['test_entities']
+        accessor = GazetteerModelAccessor()
+        other_generation = accessor.get_generation('pipeline_test_other_key')
+        generation = accessor.get_generation('pipeline_test_key')
+        GazetteerModelBuilder().create_new_gazetteer_model('product_name', 'pipeline_test_key', entities)
+        self.assertGreater(accessor.get_generation('pipeline_test_key'), generation)
+        self.assertEqual(accessor.get_generation('pipeline_test_other_key'), other_generation)
+        gazetteer_cache.evict('pipeline_test_key')
+        logger.info("TEST PASS: GazetteerModelAccessor.get_generation()")
+
 
 class GazetteerTest(unittest.TestCase):
     """
@@ -581,6 +800,308 @@ class GazetteerTest(unittest.TestCase):
             self.assertIsInstance(test_gazetteer, Gazetteer)
         logger.info("TEST PASS: create_new_gazetteer_model()")
 
+    def test_compact_gazetteer_engines(self):
+        logger.debug("TEST: create_new_gazetteer_model() engines")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/entities_for_testing.json')) as file_:
+            entities = json.load(file_)['test_entities']
+        builder = GazetteerModelBuilder()
+        accessor = GazetteerModelAccessor()
+        queries = [entity.lower() for entity in entities[:10]] + ["do you have the " + entities[0][:-1].lower()]
+        results = {}
+        for engine in ['trie', 'compact', 'dawg', 'symspell']:
+            builder.create_new_gazetteer_model('product_name', GazetteerTest.key, entities, engine)
+            gazetteer = accessor.get_gazeteers(GazetteerTest.key)['product_name']
+            results[engine] = [gazetteer.search_query(query) for query in queries]
+        self.assertIsInstance(gazetteer.trie, CompactTrie)
+        self.assertListEqual(results['trie'], results['compact'])
+        self.assertListEqual(results['trie'], results['dawg'])
+        self.assertListEqual(results['trie'], results['symspell'])
+        logger.info("TEST PASS: create_new_gazetteer_model() engines")
+
+    def test_gazetteer_snapshot(self):
+        logger.debug("TEST: write_snapshot() and load_gazetteer_snapshots()")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/entities_for_testing.json')) as file_:
+            entities = json.load(file_)['test_entities']
+        trie = CompactTrie.from_trie(GramTrieBuilder().build_trie_from_dictionary(entities))
+        snapshot_dir = tempfile.mkdtemp()
+        write_snapshot(os.path.join(snapshot_dir, 'product_name', GazetteerTest.key + '.gaz'), trie)
+        builder = GazetteerModelBuilder()
+        accessor = GazetteerModelAccessor()
+        self.assertEqual(builder.load_gazetteer_snapshots(snapshot_dir), 1)
+        loaded_trie = accessor.get_gazeteers(GazetteerTest.key)['product_name'].trie
+        self.assertListEqual(list(loaded_trie.words()), list(trie.words()))
+        query = entities[0].lower()[:-1]
+        self.assertListEqual(loaded_trie.search(query, 2), trie.search(query, 2))
+        """ With its entity list, a loaded gazetteer ranks candidates and finds their products like a fresh one """
+        write_entities(os.path.join(snapshot_dir, 'product_name', GazetteerTest.key + '.entities.json'), entities)
+        self.assertEqual(builder.load_gazetteer_snapshots(snapshot_dir), 1)
+        loaded = accessor.get_gazeteers(GazetteerTest.key)['product_name']
+        fresh = Gazetteer(trie, entities, 'product_name')
+        self.assertCountEqual(loaded.get_entities(), entities)
+        for entity in entities:
+            self.assertListEqual(loaded.search_top_k("do you have " + entity.lower()[:-1], k=3),
+                                 fresh.search_top_k("do you have " + entity.lower()[:-1], k=3))
+        shutil.rmtree(snapshot_dir)
+        logger.info("TEST PASS: write_snapshot() and load_gazetteer_snapshots()")
+
+    def test_initialize_missing_gazetteer_models(self):
+        logger.debug("TEST: initialize_missing_gazetteer_models()")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/entities_for_testing.json')) as file_:
+            entities = json.load(file_)['test_entities']
+        trie = CompactTrie.from_trie(GramTrieBuilder().build_trie_from_dictionary(entities))
+        snapshot_dir = tempfile.mkdtemp()
+        write_snapshot(os.path.join(snapshot_dir, 'product_name', 'snapshot_test_key.gaz'), trie)
+        builder = GazetteerModelBuilder()
+        accessor = GazetteerModelAccessor()
+        """ One key is loaded from its snapshot, the key without a snapshot is built from the database """
+        gazetteer_cache.evict(GazetteerTest.key)
+        self.assertEqual(builder.load_gazetteer_snapshots(snapshot_dir), 1)
+        self.assertIn('snapshot_test_key', gazetteer_cache)
+        self.assertNotIn(GazetteerTest.key, gazetteer_cache)
+        missing = builder.initialize_missing_gazetteer_models()
+        self.assertIn(GazetteerTest.key, missing)
+        self.assertNotIn('snapshot_test_key', missing)
+        self.assertIn(GazetteerTest.key, gazetteer_cache)
+        self.assertIsInstance(accessor.get_gazeteers(GazetteerTest.key)['product_name'], Gazetteer)
+        gazetteer_cache.evict('snapshot_test_key')
+        shutil.rmtree(snapshot_dir)
+        logger.info("TEST PASS: initialize_missing_gazetteer_models()")
+
+    def test_search_multiple(self):
+        logger.debug("TEST: search_multiple()")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/entities_for_testing.json')) as file_:
+            entities = json.load(file_)['test_entities']
+        trie = GramTrieBuilder().build_trie_from_dictionary(entities)
+        compact_trie = CompactTrie.from_trie(trie)
+        tokens = ("do you have the " + entities[0].lower()).split(' ')
+        words = DictionaryBuilder().ngrammer(tokens, 1, len(tokens) + 1)
+        for max_cost in [1, 2]:
+            expected = [TrieNode.search(trie, word, max_cost) for word in words]
+            self.assertListEqual(TrieNode.search_multiple(trie, words, max_cost), expected)
+            self.assertListEqual(compact_trie.search_multiple(words, max_cost), expected)
+        """ Raising the bound of a best first walk finds the same results as searching again at every bound """
+        for engine in [trie, compact_trie]:
+            walk = BestFirstWalk(engine, words, 2)
+            for bound in [0, 1, 2]:
+                expected = [sorted(results) for results in TrieNode.search_multiple(trie, words, bound)]
+                self.assertListEqual([sorted(results) for results in walk.search(bound)], expected)
+        logger.info("TEST PASS: search_multiple()")
+
+    def test_compact_trie_search(self):
+        logger.debug("TEST: CompactTrie.search()")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/entities_for_testing.json')) as file_:
+            entities = json.load(file_)['test_entities']
+        trie = GramTrieBuilder().build_trie_from_dictionary(entities)
+        compact_tries = [CompactTrie.from_trie(trie), CompactTrie.from_trie(trie, minimize=True)]
+        tokens = ("do you have the " + entities[0][:-1].lower() + "x").split(' ')
+        for word in DictionaryBuilder().ngrammer(tokens, 1, len(tokens) + 1) + ['', entities[-1].lower()]:
+            for max_cost in [0, 1, 2, 3]:
+                expected = TrieNode.search(trie, word, max_cost)
+                for compact_trie in compact_tries:
+                    self.assertListEqual(compact_trie.search(word, max_cost), expected)
+        logger.info("TEST PASS: CompactTrie.search()")
+
+    def test_sharded_gazetteer(self):
+        logger.debug("TEST: create_new_gazetteer_model() shards")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/entities_for_testing.json')) as file_:
+            entities = json.load(file_)['test_entities']
+        shards = shard_entities(entities, 1)
+        self.assertGreater(len(shards), 1)
+        self.assertListEqual(sorted(entity for shard in shards for entity in shard), sorted(entities))
+        trie = GramTrieBuilder().build_trie_from_dictionary(entities)
+        engine = ShardedEngine([CompactTrie.from_trie(GramTrieBuilder().build_trie_from_dictionary(shard))
+                                for shard in shards])
+        query = entities[0].lower()[:-1]
+        results = engine.search(query, 2)
+        self.assertListEqual(sorted(results), sorted(TrieNode.search(trie, query, 2)))
+        self.assertListEqual(results, sorted(results, key=lambda result: (result[1], -len(result[0].split(' ')))))
+        """ Shards registered after the workers were forked are searched in process, the pool is never reforked """
+        pool = start_shard_pool(2)
+        try:
+            engine.processes = 2
+            self.assertListEqual(engine.search(query, 2), results)
+            late_engine = ShardedEngine([CompactTrie.from_trie(GramTrieBuilder().build_trie_from_dictionary(shard))
+                                         for shard in shards], processes=2)
+            self.assertListEqual(late_engine.search(query, 2), results)
+            self.assertIs(start_shard_pool(2), pool)
+        finally:
+            stop_shard_pool()
+        builder = GazetteerModelBuilder()
+        accessor = GazetteerModelAccessor()
+        builder.create_new_gazetteer_model('product_name', GazetteerTest.key, entities)
+        expected = accessor.get_gazeteers(GazetteerTest.key)['product_name'].search_query(entities[0].lower())
+        builder.create_new_gazetteer_model('product_name', GazetteerTest.key, entities, shard_size=1)
+        gazetteer = accessor.get_gazeteers(GazetteerTest.key)['product_name']
+        self.assertIsInstance(gazetteer.trie, ShardedEngine)
+        self.assertEqual(gazetteer.search_query(entities[0].lower()), expected)
+        logger.info("TEST PASS: create_new_gazetteer_model() shards")
+
+    def test_gazetteer_cache_eviction(self):
+        logger.debug("TEST: GazetteerCache eviction")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/entities_for_testing.json')) as file_:
+            entities = json.load(file_)['test_entities']
+        trie = CompactTrie.from_trie(GramTrieBuilder().build_trie_from_dictionary(entities))
+        cache = GazetteerCache(budget=2 * trie.memory_size(), pinned=['cache_test_a'])
+        for key in ['cache_test_a', 'cache_test_b', 'cache_test_c']:
+            cache.record('product_name', key, trie)
+        self.assertIn('cache_test_a', cache)
+        self.assertNotIn('cache_test_b', cache)
+        self.assertIn('cache_test_c', cache)
+        self.assertTrue(cache.touch('cache_test_c'))
+        self.assertFalse(cache.touch('cache_test_b'))
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['bytes'], 2 * trie.memory_size())
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        """ Memory allocated after a gazetteer is recorded counts against the budget, evicted keys stay evicted """
+        cache.resize('product_name', 'cache_test_c', trie.memory_size() + 1)
+        cache.resize('product_name', 'cache_test_b', trie.memory_size() + 1)
+        self.assertNotIn('cache_test_b', cache)
+        self.assertEqual(cache.stats()['bytes'], 2 * trie.memory_size() + 1)
+        logger.info("TEST PASS: GazetteerCache eviction")
+
+    def test_incremental_gazetteer_update(self):
+        logger.debug("TEST: update_gazetteer_entries()")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/entities_for_testing.json')) as file_:
+            entities = json.load(file_)['test_entities']
+        builder = GazetteerModelBuilder()
+        builder.create_new_gazetteer_model('product_name', GazetteerTest.key, entities[:-1])
+        gazetteer = GazetteerModelAccessor().get_gazeteers(GazetteerTest.key)['product_name']
+        builder.update_gazetteer_entries('product_name', GazetteerTest.key, [entities[-1]], [entities[0]])
+        self.assertCountEqual(gazetteer.get_entities(), entities[1:])
+        expected = GramTrieBuilder().build_trie_from_dictionary(entities[1:])
+        for query in [entity.lower() for entity in entities] + [entities[0].lower()[:-1]]:
+            for max_cost in [1, 2]:
+                self.assertCountEqual(gazetteer._search(query, max_cost), TrieNode.search(expected, query, max_cost))
+        logger.info("TEST PASS: update_gazetteer_entries()")
+
+    def test_exact_match_fast_path(self):
+        logger.debug("TEST: Gazetteer.search_query_with_match()")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/product_lists/productList1k.json')) as file_:
+            products = [product for product in json.load(file_)['products'] if product][:100]
+        automaton = TokenAutomaton(['boxeo adidas', 'adidas', 'guantes de boxeo adidas'])
+        self.assertCountEqual(automaton.find_all('los guantes de boxeo adidas'.split(' ')), [(1, 5), (3, 5), (4, 5)])
+        gazetteer = Gazetteer(GramTrieBuilder().build_trie_from_dictionary(products))
+        """ The automaton is only built by the first search """
+        self.assertIsNone(gazetteer.exact_matcher)
+        engine_size = gazetteer.memory_size()
+        fuzzy_gazetteer = Gazetteer(gazetteer.trie)
+        fuzzy_gazetteer._get_term_index()
+        fuzzy_gazetteer.exact_matcher = None
+        for product in products:
+            query = "do you have the " + product
+            tag, match = gazetteer.search_query_with_match(query)
+            self.assertEqual(tag, fuzzy_gazetteer.search_query(query))
+            if ' ' in tag:
+                self.assertEqual(match, 'exact')
+            misspelled = "do you have the " + ' '.join(word + word[-1] for word in product.split(' '))
+            self.assertEqual(gazetteer.search_query(misspelled), fuzzy_gazetteer.search_query(misspelled))
+        self.assertEqual(gazetteer.memory_size(), engine_size + gazetteer.exact_matcher.memory_size())
+        logger.info("TEST PASS: Gazetteer.search_query_with_match()")
+
+    def test_query_gram_window(self):
+        logger.debug("TEST: Gazetteer._query_gram_levels()")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/product_lists/productList1k.json')) as file_:
+            products = [product for product in json.load(file_)['products'] if product][:100]
+        gazetteer = Gazetteer(GramTrieBuilder().build_trie_from_dictionary(products))
+        terms = GramTrieBuilder().terms_from_dictionary(products)
+        self.assertEqual(gazetteer._get_term_index()[0], max(len(term.split(' ')) for term in terms))
+        tokens = ("hi i was wondering if you could tell me whether you have the " + products[0].lower()).split(' ') * 3
+        levels = list(gazetteer._query_gram_levels(tokens))
+        self.assertListEqual([n for n, grams in levels], list(range(gazetteer.max_term_tokens, 1, -1)))
+        self.assertLessEqual(sum(len(grams) for n, grams in levels), gazetteer.max_term_tokens * len(tokens))
+        unbounded = [(n, DictionaryBuilder().ngrammer(tokens, n, n + 1)) for n in range(len(tokens), 1, -1)]
+        self.assertEqual(gazetteer._get_query_gram_tag(levels, 2), gazetteer._get_query_gram_tag(unbounded, 2))
+        logger.info("TEST PASS: Gazetteer._query_gram_levels()")
+
+    def test_query_preprocessing_cache(self):
+        logger.debug("TEST: CleanedQuery and stem_cache")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/entities_for_testing.json')) as file_:
+            entities = json.load(file_)['test_entities']
+        trie = GramTrieBuilder().build_trie_from_dictionary(entities)
+        gazetteer = Gazetteer(trie)
+        self.assertIs(gazetteer.nltk_stopwords, Gazetteer(trie).nltk_stopwords)
+        cleaned_query = CleanedQuery("Do you have the " + entities[0] + "?", ['have'])
+        self.assertListEqual(cleaned_query.tokens, ['do', 'you', 'the', entities[0].lower()])
+        self.assertListEqual(CleanedQuery("do you have the " + entities[0]).single_words, [entities[0].lower()])
+        stem_cache.clear()
+        for _ in range(2):
+            self.assertEqual(gazetteer.search_query("I want " + entities[0]), entities[0].lower())
+        self.assertEqual(stem_cache.stats()['hits'], stem_cache.stats()['misses'])
+        logger.info("TEST PASS: CleanedQuery and stem_cache")
+
+    def test_search_top_k(self):
+        logger.debug("TEST: Gazetteer.search_top_k()")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/entities_for_testing.json')) as file_:
+            entities = json.load(file_)['test_entities']
+        gazetteer = Gazetteer(GramTrieBuilder().build_trie_from_dictionary(entities), gazetteer_type='product_name')
+        candidates = gazetteer.search_top_k("do you have " + entities[0], k=3)
+        self.assertEqual(len(candidates), 3)
+        self.assertDictEqual(candidates[0], {"value": entities[0].lower(), "distance": 0, "span": [3, 4],
+                                             "text": entities[0].lower(), "type": 'product_name'})
+        self.assertListEqual([candidate['distance'] for candidate in candidates], [0, 1, 1])
+        self.assertEqual(len(set(candidate['value'] for candidate in candidates)), 3)
+        self.assertListEqual(gazetteer.search_top_k("do you have " + entities[0], k=0), [])
+        logger.info("TEST PASS: Gazetteer.search_top_k()")
+
+    def test_term_postings(self):
+        logger.debug("TEST: GramTrieBuilder.build_postings_from_dictionary()")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/product_lists/productList1k.json')) as file_:
+            products = [product for product in json.load(file_)['products'] if product][:100]
+        terms = GramTrieBuilder().terms_from_dictionary(products)
+        postings = GramTrieBuilder().build_postings_from_dictionary(products)
+        self.assertListEqual(list(postings.postings), list(OrderedDict.fromkeys(terms)))
+        self.assertListEqual(list(postings.family_counts), TERM_FAMILIES)
+        self.assertEqual(sum(counts['generated'] for counts in postings.family_counts.values()), len(terms))
+        self.assertEqual(sum(counts['distinct'] for counts in postings.family_counts.values()), len(postings))
+        for term in terms[:50]:
+            self.assertTrue(all(set(term.split(' ')) <= set(DictionaryBuilder().clean_dictionary([product])[0]
+                                                               .lower().split(' '))
+                                for product in postings.products_for(term)))
+        without_skipgrams = GramTrieBuilder(['vocab', 'ngram']).build_postings_from_dictionary(products)
+        self.assertLess(len(without_skipgrams), len(postings))
+        self.assertRaises(ValueError, GramTrieBuilder, ['trigram'])
+        gazetteer = Gazetteer(postings.build_trie(), products, 'product_name')
+        candidate = gazetteer.search_top_k(products[0], k=1)[0]
+        self.assertIn(products[0], candidate['products'])
+        logger.info("TEST PASS: GramTrieBuilder.build_postings_from_dictionary()")
+
+    def test_parallel_gazetteer_build(self):
+        logger.debug("TEST: initialize_gazetteer_models() in worker processes")
+        db = ExternalDatabaseEngine()
+        rows = dict(db.iter_entities_by_key())
+        product_names = db.get_product_names_by_key(GazetteerTest.key)
+        """ Stopping early ends the transaction of the server side cursor, the connection stays usable """
+        first_rows = db.iter_entities_by_key()
+        next(first_rows)
+        first_rows.close()
+        self.assertIn(GazetteerTest.key, db.get_keys())
+        db.release_database_connection()
+        self.assertCountEqual(rows[GazetteerTest.key]['product_name'], [x for x in product_names if x is not None])
+        for entities_by_type in rows.values():
+            for entities in entities_by_type.values():
+                self.assertNotIn(None, entities)
+        builder = GazetteerModelBuilder()
+        accessor = GazetteerModelAccessor()
+        builder.initialize_gazetteer_models(processes=2)
+        gazetteers = accessor.get_gazeteers(GazetteerTest.key)
+        self.assertIsInstance(gazetteers['product_name'], Gazetteer)
+        logger.info("TEST PASS: initialize_gazetteer_models() in worker processes")
+
+    def test_symspell_search(self):
+        logger.debug("TEST: SymSpellIndex.search()")
+        with open(os.path.join(os.path.dirname(__file__), '../resources/entities_for_testing.json')) as file_:
+            entities = json.load(file_)['test_entities']
+        trie = GramTrieBuilder().build_trie_from_dictionary(entities)
+        index = SymSpellIndex.from_trie(trie)
+        tokens = ("do you have the " + entities[0].lower()).split(' ')
+        for word in DictionaryBuilder().ngrammer(tokens, 1, len(tokens) + 1):
+            for max_cost in [0, 1, 2, 3]:
+                self.assertListEqual(index.search(word, max_cost), TrieNode.search(trie, word, max_cost))
+        self.assertEqual(gazetteer_engine('product_name', 'compact,product_name:symspell'), 'symspell')
+        self.assertEqual(gazetteer_engine('vendor', 'compact,product_name:symspell'), 'compact')
+        logger.info("TEST PASS: SymSpellIndex.search()")
+
     def test_gazetteer_model_by_key(self):
         logger.debug("TEST: create_new_gazetteer_model()")
         with open(os.path.join(os.path.dirname(__file__), '../resources/entities_for_testing.json')) as file_:
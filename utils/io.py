@@ -83,6 +83,28 @@ def create_data_for_binary_classifier_from_database(entity_name):
         return [docs, labels]
 
 
+def create_data_for_binary_classifiers_from_database():
+    """
+    Function that returns the labeled training data of every binary classifier fetched from the database in one pass
+    :return: {entity_name: [[docs],[labels]], ...} or empty dict if exception occurs
+    """
+    training_data = {}
+    try:
+        db = EntitiesDatabaseEngine()
+        data = db.get_all_binary_entity_expressions()
+        db.release_database_connection()
+        for entity_name, expressions in data.items():
+            docs = [datum[1] for datum in expressions]
+            labels = ['true' if datum[2] else 'false' for datum in expressions]
+            training_data[entity_name] = [docs, labels]
+        return training_data
+    except Exception as e:
+        logger.error("Exception occurred importing database data.")
+        logger.exception(e)
+        logger.debug("returning empty dict")
+        return training_data
+
+
 def get_intents_from_JSON_data(fileAddress):
     """
     Gets data from a JSON file.
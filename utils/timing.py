@@ -0,0 +1,109 @@
+"""
+Wall and CPU time instrumentation for the analysis pipelines. Timings collects the measurements of a single request
+while TIMING_HISTOGRAMS aggregates the measurements of every request of the process.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+# CPU time of the current thread where available, so concurrently running annotators are not charged for each other.
+cpu_time = getattr(time, 'thread_time', time.process_time)
+
+# Upper bounds in milliseconds of the histogram buckets. The last bucket is unbounded.
+HISTOGRAM_BUCKETS = [1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf')]
+
+
+class Timings:
+    """
+    Collects the wall and CPU time of the named phases and annotators of a single request.
+    """
+    def __init__(self):
+        self.records = []
+
+    @contextmanager
+    def measure(self, name):
+        """
+        Context manager measuring the wall and CPU time of the enclosed block under the given name.
+        :param name: name of the phase or annotator
+        """
+        wall_start = time.perf_counter()
+        cpu_start = cpu_time()
+        try:
+            yield
+        finally:
+            self.records.append((name, (time.perf_counter() - wall_start) * 1000, (cpu_time() - cpu_start) * 1000))
+
+    def to_dict(self):
+        """
+        Sums the measurements by name.
+        :return: dict of {name: {"wall_ms": float, "cpu_ms": float, "count": int}} in order of first measurement
+        """
+        totals = {}
+        order = []
+        for name, wall_ms, cpu_ms in list(self.records):
+            if name not in totals:
+                totals[name] = {"wall_ms": 0.0, "cpu_ms": 0.0, "count": 0}
+                order.append(name)
+            totals[name]["wall_ms"] += wall_ms
+            totals[name]["cpu_ms"] += cpu_ms
+            totals[name]["count"] += 1
+        return {name: totals[name] for name in order}
+
+    def server_timing_header(self):
+        """
+        Formats the measurements as the value of a Server-Timing HTTP header.
+        :return: header string such as 'intent_classifier;dur=12.31;desc="cpu 11.90ms", ...'
+        """
+        metrics = []
+        for name, total in self.to_dict().items():
+            metrics.append('{0};dur={1:.2f};desc="cpu {2:.2f}ms"'.format(name, total['wall_ms'], total['cpu_ms']))
+        return ', '.join(metrics)
+
+
+class TimingHistograms:
+    """
+    Process wide histograms of wall and CPU times per phase and annotator name, kept for scraping.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self, timings):
+        """
+        Adds every measurement of a request to the histograms.
+        :param timings: Timings object of a finished request
+        """
+        with self.lock:
+            for name, wall_ms, cpu_ms in list(timings.records):
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = {"count": 0, "wall_ms_sum": 0.0, "cpu_ms_sum": 0.0,
+                                 "wall_ms_buckets": [0] * len(HISTOGRAM_BUCKETS),
+                                 "cpu_ms_buckets": [0] * len(HISTOGRAM_BUCKETS)}
+                    self.histograms[name] = histogram
+                histogram["count"] += 1
+                histogram["wall_ms_sum"] += wall_ms
+                histogram["cpu_ms_sum"] += cpu_ms
+                histogram["wall_ms_buckets"][self._bucket_index(wall_ms)] += 1
+                histogram["cpu_ms_buckets"][self._bucket_index(cpu_ms)] += 1
+
+    def to_dict(self):
+        """
+        Returns a copy of the histograms with the bucket upper bounds.
+        :return: dict of {"buckets_ms": [...], "histograms": {name: histogram}}
+        """
+        with self.lock:
+            histograms = {name: {field: list(value) if isinstance(value, list) else value
+                                 for field, value in histogram.items()}
+                          for name, histogram in self.histograms.items()}
+        buckets = [str(bound) if bound != float('inf') else '+Inf' for bound in HISTOGRAM_BUCKETS]
+        return {"buckets_ms": buckets, "histograms": histograms}
+
+    def _bucket_index(self, value):
+        for idx, bound in enumerate(HISTOGRAM_BUCKETS):
+            if value <= bound:
+                return idx
+        return len(HISTOGRAM_BUCKETS) - 1
+
+
+TIMING_HISTOGRAMS = TimingHistograms()